@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import httpx
+
+# robots.txt rules for web crawls, with `urllib.robotparser` semantics: a 200 is parsed, 401/403
+# disallow everything, any other answer (or no answer) allows everything. Parsed rules are shared
+# by all users and jobs, per origin, for `CRAWL_ROBOTS_TTL_SEC`; origins whose robots.txt could
+# not be fetched (5xx, network errors) are retried sooner.
+
+AGENT = "autonomy-labs"
+
+_DEFAULT_TTL_SEC = 3600.0
+_FAILURE_TTL_SEC = 300.0
+_MAX_ORIGINS = 1024
+# RFC 9309 asks crawlers to parse at least the first 500 KiB.
+_MAX_BYTES = 500 * 1024
+
+_LOCK = threading.Lock()
+_CACHE: OrderedDict[str, tuple[float, RobotRules]] = OrderedDict()
+
+
+def _ttl() -> float:
+    raw = (os.environ.get("CRAWL_ROBOTS_TTL_SEC") or "").strip()
+    try:
+        return max(0.0, float(raw)) if raw else _DEFAULT_TTL_SEC
+    except ValueError:
+        return _DEFAULT_TTL_SEC
+
+
+class RobotRules:
+    """
+    The rules that apply to this crawler for one origin.
+    """
+
+    def __init__(self, parser: RobotFileParser) -> None:
+        self._parser = parser
+
+    def allowed(self, url: str) -> bool:
+        return self._parser.can_fetch(AGENT, url)
+
+    @property
+    def crawl_delay(self) -> float | None:
+        """
+        Seconds between requests asked for by `Crawl-delay` (or `Request-rate`), if any.
+        """
+        delay = self._parser.crawl_delay(AGENT)
+        if delay is not None:
+            return float(delay)
+        rate = self._parser.request_rate(AGENT)
+        if rate is not None and rate.requests > 0:
+            return rate.seconds / rate.requests
+        return None
+
+
+def _rules(*, body: str | None = None, allow_all: bool = False, disallow_all: bool = False) -> RobotRules:
+    parser = RobotFileParser()
+    if body is not None:
+        parser.parse(body.splitlines())
+    parser.allow_all = allow_all
+    parser.disallow_all = disallow_all
+    parser.modified()
+    return RobotRules(parser)
+
+
+def origin(url: str) -> str:
+    p = urlparse(url)
+    return f"{p.scheme}://{p.netloc}".lower()
+
+
+def clear_cache() -> None:
+    with _LOCK:
+        _CACHE.clear()
+
+
+async def rules_for(client: httpx.AsyncClient, url: str) -> RobotRules:
+    """
+    Rules for `url`'s origin, from the cache or fetched with `client` (redirects are not followed).
+    """
+    key = origin(url)
+    now = time.monotonic()
+    with _LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None and hit[0] > now:
+            _CACHE.move_to_end(key)
+            return hit[1]
+
+    ttl = _ttl()
+    try:
+        resp = await client.get(f"{key}/robots.txt")
+        if resp.status_code == 200:
+            rules = _rules(body=resp.content[:_MAX_BYTES].decode("utf-8", errors="replace"))
+        elif resp.status_code in {401, 403}:
+            rules = _rules(disallow_all=True)
+        else:
+            if resp.status_code >= 500:
+                ttl = min(ttl, _FAILURE_TTL_SEC)
+            rules = _rules(allow_all=True)
+    except httpx.HTTPError:
+        ttl = min(ttl, _FAILURE_TTL_SEC)
+        rules = _rules(allow_all=True)
+
+    with _LOCK:
+        _CACHE[key] = (time.monotonic() + ttl, rules)
+        _CACHE.move_to_end(key)
+        while len(_CACHE) > _MAX_ORIGINS:
+            _CACHE.popitem(last=False)
+    return rules
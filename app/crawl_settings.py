@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from typing import Any
+
+from app.storage import global_data_dir
+from app.web_crawler import ThrottleLimits
+
+_LOCK = threading.Lock()
+_CACHE_AT: float = 0.0
+_CACHE: dict[str, float] = {}
+_TTL_SEC = 3.0
+_PATH = global_data_dir() / "crawl-throttle.json"
+
+DEFAULTS: dict[str, float] = {"minDelaySec": 0.05, "maxDelaySec": 30.0, "maxConcurrency": 4}
+_MAX_DELAY_SEC = 300.0
+_MAX_CONCURRENCY = 16
+
+
+def _clean(values: dict[str, Any]) -> dict[str, float]:
+    out = dict(DEFAULTS)
+    for key in DEFAULTS:
+        v = values.get(key)
+        if isinstance(v, bool) or not isinstance(v, int | float):
+            continue
+        out[key] = float(v)
+    out["minDelaySec"] = min(max(0.0, out["minDelaySec"]), _MAX_DELAY_SEC)
+    out["maxDelaySec"] = min(max(out["minDelaySec"], out["maxDelaySec"]), _MAX_DELAY_SEC)
+    out["maxConcurrency"] = int(min(max(1, out["maxConcurrency"]), _MAX_CONCURRENCY))
+    return out
+
+
+def load_crawl_throttle() -> dict[str, float]:
+    """
+    Loads the admin bounds for auto-throttled web crawls.
+
+    Shape: {"version": 1, "limits": {"minDelaySec": 0.05, "maxDelaySec": 30, "maxConcurrency": 4}}
+    """
+    global _CACHE_AT, _CACHE
+    now = time.monotonic()
+    if _CACHE and now - _CACHE_AT < _TTL_SEC:
+        return dict(_CACHE)
+
+    with _LOCK:
+        now = time.monotonic()
+        if _CACHE and now - _CACHE_AT < _TTL_SEC:
+            return dict(_CACHE)
+        try:
+            data = json.loads(_PATH.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            data = {}
+        except Exception:
+            data = {"limits": _CACHE}
+        limits = data.get("limits") if isinstance(data, dict) else None
+        _CACHE = _clean(limits if isinstance(limits, dict) else {})
+        _CACHE_AT = now
+        return dict(_CACHE)
+
+
+def save_crawl_throttle(values: dict[str, Any]) -> dict[str, float]:
+    """
+    Persists the bounds; missing or invalid fields fall back to the defaults.
+    """
+    global _CACHE_AT, _CACHE
+    out = _clean(values or {})
+    payload = {"version": 1, "limits": out}
+    _PATH.parent.mkdir(parents=True, exist_ok=True)
+    _PATH.write_text(json.dumps(payload, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+
+    with _LOCK:
+        _CACHE = dict(out)
+        _CACHE_AT = time.monotonic()
+    return out
+
+
+def throttle_limits() -> ThrottleLimits:
+    limits = load_crawl_throttle()
+    return ThrottleLimits(
+        min_delay=limits["minDelaySec"],
+        max_delay=limits["maxDelaySec"],
+        max_concurrency=int(limits["maxConcurrency"]),
+    )
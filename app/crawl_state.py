@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+
+from app.storage import user_data_dir
+
+# What a web crawl leaves behind for `recrawl` jobs, one gzip'd JSON file per user and start URL:
+#   {"version": 1, "startUrl": ..., "jobId": ..., "pages": {url: {"etag", "lastModified"}}}
+# Each page is its own RAG document (`source` = its URL), so a page answering 304 is simply left
+# as it is in the index.
+
+
+def _state_path(user_id: str, start_url: str) -> Path:
+    key = hashlib.sha256(start_url.encode("utf-8")).hexdigest()[:24]
+    return user_data_dir(user_id) / "crawl-state" / f"{key}.json.gz"
+
+
+def load(user_id: str, start_url: str) -> dict[str, Any] | None:
+    try:
+        data = json.loads(gzip.decompress(_state_path(user_id, start_url).read_bytes()).decode("utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("startUrl") != start_url or not isinstance(data.get("pages"), dict):
+        return None
+    return data
+
+
+def save(user_id: str, start_url: str, *, job_id: str, pages: dict[str, dict[str, Any]]) -> None:
+    path = _state_path(user_id, start_url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {"version": 1, "startUrl": start_url, "jobId": job_id, "pages": pages}
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(gzip.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), 6))
+    tmp.replace(path)
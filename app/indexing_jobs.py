@@ -5,17 +5,19 @@ import json
 import os
 import re
 import uuid
+from collections.abc import Awaitable, Callable
 from dataclasses import asdict, dataclass, field
 from datetime import UTC, datetime
 from html import unescape
 from pathlib import Path
 from typing import Any
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urlparse
 
 import httpx
 from fastapi import HTTPException
 
-from app.net_safety import is_public_host, validate_public_http_url
+from app import crawl_robots, crawl_settings, crawl_state, rag_dedup, rag_index, rag_store, web_crawler
+from app.net_safety import validate_public_http_url
 from app.storage import user_data_dir
 
 
@@ -31,6 +33,10 @@ def _normalize_url(url: str) -> str:
     return validate_public_http_url(url)
 
 
+def _rate_limit(value: float) -> float:
+    return min(max(float(value), 0.0), 5.0)
+
+
 def _extract_links(html: str) -> list[str]:
     # Best-effort: handle common href patterns; ignore javascript:, mailto:, etc.
     out: list[str] = []
@@ -60,73 +66,56 @@ def _html_to_text(html: str) -> str:
     return s.strip()
 
 
-def _chunk_text(text: str, *, max_chars: int = 1200, overlap: int = 120) -> list[dict[str, str]]:
-    t = (text or "").strip()
-    if not t:
-        return []
-    chunks: list[dict[str, str]] = []
-    i = 0
-    n = len(t)
-    while i < n:
-        j = min(n, i + max_chars)
-        chunk = t[i:j].strip()
-        if chunk:
-            chunks.append({"id": str(uuid.uuid4()), "text": chunk})
-        if j >= n:
-            break
-        i = max(0, j - overlap)
-    return chunks
-
-
-def _rag_dir(user_id: str) -> Path:
-    root = user_data_dir(user_id) / "rag"
-    root.mkdir(parents=True, exist_ok=True)
-    return root
+_DEFAULT_COMMIT_PAGES = 8
 
 
-def _rag_index_path(user_id: str) -> Path:
-    return _rag_dir(user_id) / "rag-index.json"
-
-
-def _load_rag_index(path: Path) -> dict[str, Any]:
+def _commit_pages() -> int:
+    raw = (os.environ.get("CRAWL_COMMIT_PAGES") or "").strip()
     try:
-        return json.loads(path.read_text(encoding="utf-8"))
-    except FileNotFoundError:
-        return {"version": 1, "documents": []}
-
-
-def _save_rag_index(path: Path, data: dict[str, Any]) -> None:
-    path.write_text(json.dumps(data, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
-
-
-def add_rag_document(user_id: str, *, name: str, text: str, source: str | None = None) -> dict[str, Any]:
-    doc_id = str(uuid.uuid4())
-    chunks = _chunk_text(text)
-    rag_root = _rag_dir(user_id)
-    doc_path = rag_root / f"{doc_id}.txt"
-    doc_path.write_text(text, encoding="utf-8")
-
-    idx_path = _rag_index_path(user_id)
-    idx = _load_rag_index(idx_path)
-    docs = idx.get("documents")
-    if not isinstance(docs, list):
-        docs = []
-        idx["documents"] = docs
-
-    entry: dict[str, Any] = {
-        "id": doc_id,
-        "name": name,
-        "createdAt": _now_iso(),
-        "bytes": len(text.encode("utf-8")),
-        "path": doc_path.name,
-        "chunks": chunks,
-    }
-    if source:
-        entry["source"] = source
-
-    docs.append(entry)
-    _save_rag_index(idx_path, idx)
-    return {"id": doc_id, "chunks": len(chunks)}
+        return max(1, int(raw)) if raw else _DEFAULT_COMMIT_PAGES
+    except ValueError:
+        return _DEFAULT_COMMIT_PAGES
+
+
+def _page_title(html: str) -> str:
+    m = re.search(r"(?is)<title[^>]*>(.*?)</title>", html or "")
+    return re.sub(r"\s+", " ", unescape(m.group(1))).strip()[:200] if m else ""
+
+
+def store_pages(user_id: str, *, collection: str, pages: list[tuple[str, str, str]]) -> list[dict[str, Any]]:
+    """
+    Stores crawled `(url, title, text)` pages as one RAG document each, committed together.
+    Documents are keyed by `source` = page URL, so a page crawled again is re-ingested in place.
+    """
+    docs = [
+        rag_index.prepare_document(title or url, f"URL: {url}\n\n{text}", source=url, collection=collection)
+        for url, title, text in pages
+    ]
+    return rag_store.add_documents(user_id, docs)
+
+
+def _is_legacy_crawl(doc: dict[str, Any], start_url: str) -> bool:
+    return (
+        not doc.get("collection")
+        and doc.get("source") == start_url
+        and str(doc.get("name") or "").startswith("Website: ")
+    )
+
+
+def add_rag_document(user_id: str, *, name: str, sections: list[str], source: str | None = None) -> dict[str, Any]:
+    """
+    Stores one RAG document made of `sections` (pages/files). Each section is chunked on its
+    own, so re-running a job for the same `source` only re-indexes the sections that changed.
+    """
+    writer = rag_store.begin_document(user_id, name=name, source=source)
+    try:
+        for i, section in enumerate(sections):
+            writer.write(section if i == 0 else "\n" + section)
+            writer.end_section()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
 
 
 def _parse_github_repo(repo: str) -> tuple[str, str]:
@@ -271,15 +260,12 @@ class IndexJobStore:
         max_depth: int = 2,
         rate_limit_sec: float = 0.25,
         respect_robots: bool = True,
+        auto_throttle: bool = False,
     ) -> IndexJob:
         url = _normalize_url(start_url)
         max_pages = max(1, min(int(max_pages), 150))
         max_depth = max(0, min(int(max_depth), 6))
-        rate_limit_sec = float(rate_limit_sec)
-        if rate_limit_sec < 0:
-            rate_limit_sec = 0.0
-        if rate_limit_sec > 5:
-            rate_limit_sec = 5.0
+        rate_limit_sec = _rate_limit(rate_limit_sec)
 
         job = IndexJob(
             id=str(uuid.uuid4()),
@@ -291,6 +277,43 @@ class IndexJobStore:
                 "maxDepth": max_depth,
                 "rateLimitSec": rate_limit_sec,
                 "respectRobots": bool(respect_robots),
+                "autoThrottle": bool(auto_throttle),
+            },
+        )
+        await self._update_job(user_id, job)
+
+        task = asyncio.create_task(self._run_web_crawl(user_id, job))
+        self._task_map(user_id)[job.id] = task
+        return job
+
+    async def create_recrawl_job(
+        self,
+        user_id: str,
+        *,
+        start_url: str,
+        rate_limit_sec: float = 0.25,
+        respect_robots: bool = True,
+        auto_throttle: bool = False,
+    ) -> IndexJob:
+        url = _normalize_url(start_url)
+        state = await asyncio.to_thread(crawl_state.load, user_id, url)
+        if state is None:
+            raise HTTPException(
+                status_code=404,
+                detail={"code": "not_found", "message": "No previous crawl of this URL"},
+            )
+
+        job = IndexJob(
+            id=str(uuid.uuid4()),
+            type="recrawl",
+            createdAt=_now_iso(),
+            params={
+                "startUrl": url,
+                "sourceJobId": state.get("jobId"),
+                "pages": len(state["pages"]),
+                "rateLimitSec": _rate_limit(rate_limit_sec),
+                "respectRobots": bool(respect_robots),
+                "autoThrottle": bool(auto_throttle),
             },
         )
         await self._update_job(user_id, job)
@@ -337,148 +360,183 @@ class IndexJobStore:
         return job
 
     async def _run_web_crawl(self, user_id: str, job: IndexJob) -> None:
+        """
+        Runs `web_crawl` jobs and `recrawl` jobs. Pages are indexed while the crawl goes on, one
+        document each under the collection of the start URL, committed every `CRAWL_COMMIT_PAGES`
+        pages; a canceled or failed crawl keeps what was committed. A recrawl fetches the URL set of
+        the last crawl of its start URL conditionally and leaves pages answering 304 untouched.
+        Once a crawl completes, the collection's documents for pages it no longer has are deleted.
+        """
         job.status = "running"
         job.progress = {"visited": 0, "indexedPages": 0, "queued": 0}
         await self._update_job(user_id, job)
 
         start_url = job.params.get("startUrl") or ""
-        max_pages = int(job.params.get("maxPages") or 25)
-        max_depth = int(job.params.get("maxDepth") or 2)
-        rate_limit_sec = float(job.params.get("rateLimitSec") or 0.25)
+        recrawl = job.type == "recrawl"
+        max_depth = 0 if recrawl else int(job.params.get("maxDepth") or 2)
+        rate_limit_sec = float(job.params.get("rateLimitSec", 0.25) or 0.0)
         respect_robots = bool(job.params.get("respectRobots") is True)
+        # Admin bounds are read when the job starts; the rate limit is then only the first pace.
+        limits = crawl_settings.throttle_limits() if job.params.get("autoThrottle") is True else None
 
-        origin = urlparse(start_url)
-        allowed_netloc = origin.netloc
-        base = f"{origin.scheme}://{origin.netloc}"
-
-        robots_disallow_all = False
-        if respect_robots:
-            try:
-                async with httpx.AsyncClient(
-                    timeout=10.0,
-                    follow_redirects=False,
-                    headers={"User-Agent": "autonomy-labs/1.0"},
-                ) as c:
-                    r = await c.get(f"{base}/robots.txt")
-                if r.status_code == 200:
-                    txt = (r.text or "")
-                    # Very small parser: disallow all if user-agent * has Disallow: /
-                    in_star = False
-                    for line in txt.splitlines():
-                        line = line.strip()
-                        if not line or line.startswith("#"):
-                            continue
-                        if line.lower().startswith("user-agent:"):
-                            ua = line.split(":", 1)[1].strip()
-                            in_star = ua == "*"
-                        if in_star and line.lower().startswith("disallow:"):
-                            val = line.split(":", 1)[1].strip()
-                            if val == "/":
-                                robots_disallow_all = True
-                                break
-            except Exception:
-                robots_disallow_all = False
-
-        if robots_disallow_all:
-            job.status = "failed"
-            job.error = "robots.txt disallows crawling"
+        previous: dict[str, dict[str, Any]] = {}
+        if recrawl:
+            state = await asyncio.to_thread(crawl_state.load, user_id, start_url)
+            if state is None:
+                job.status = "failed"
+                job.error = "No previous crawl of this URL"
+                await self._update_job(user_id, job)
+                return
+            previous = state["pages"]
+        max_pages = len(previous) if recrawl else int(job.params.get("maxPages") or 25)
+
+        commit_pages = _commit_pages()
+        dedup = await asyncio.to_thread(rag_dedup.PageFilter, user_id, collection=start_url, keep=previous)
+        pending: list[tuple[str, str, str]] = []
+        fetched: list[str] = []
+        stored: list[str] = []
+        duplicates: list[dict[str, str]] = []
+        commit_lock = asyncio.Lock()
+
+        async def flush() -> None:
+            async with commit_lock:
+                batch = pending[:]
+                pending.clear()
+                if not batch:
+                    return
+                # Pagination, print views and tag pages repeat content already crawled; store one copy.
+                kept, dropped = await asyncio.to_thread(dedup.filter, [(url, text) for url, _title, text in batch])
+                duplicates.extend(dropped)
+                keep = {url for url, _text in kept}
+                pages = [page for page in batch if page[0] in keep]
+                if pages:
+                    await asyncio.to_thread(store_pages, user_id, collection=start_url, pages=pages)
+                    stored.extend(url for url, _title, _text in pages)
+
+        async def on_page(url: str, depth: int, html: str) -> list[str]:
+            text = _html_to_text(html)
+            if text:
+                fetched.append(url)
+                pending.append((url, _page_title(html), text))
+                if len(pending) >= commit_pages:
+                    await flush()
+            return _extract_links(html) if depth < max_depth else []
+
+        async def on_progress() -> None:
+            job.progress = {
+                "visited": crawler.visited,
+                "indexedPages": len(stored),
+                "queued": crawler.queued,
+                "effectiveRate": crawler.effective_rate(),
+            }
+            if recrawl:
+                job.progress["unchangedPages"] = len(crawler.unchanged)
             await self._update_job(user_id, job)
-            return
-
-        queue: list[tuple[str, int]] = [(start_url, 0)]
-        visited: set[str] = set()
-        pages: list[tuple[str, str]] = []
 
         async with httpx.AsyncClient(
             timeout=15.0,
             follow_redirects=False,
-            headers={"User-Agent": "autonomy-labs/1.0"},
+            headers={"User-Agent": web_crawler.USER_AGENT},
+            limits=httpx.Limits(max_connections=web_crawler.crawl_workers()),
         ) as client:
             try:
-                while queue and len(visited) < max_pages:
-                    url, depth = queue.pop(0)
-                    if url in visited:
-                        continue
-                    visited.add(url)
-                    job.progress = {"visited": len(visited), "indexedPages": len(pages), "queued": len(queue)}
+                robots = await crawl_robots.rules_for(client, start_url) if respect_robots else None
+                if robots is not None and not robots.allowed(start_url):
+                    job.status = "failed"
+                    job.error = "robots.txt disallows crawling"
                     await self._update_job(user_id, job)
-
-                    parsed = urlparse(url)
-                    if parsed.scheme not in {"https", "http"}:
-                        continue
-                    if parsed.netloc != allowed_netloc:
-                        continue
-                    if not is_public_host(parsed.hostname or ""):
-                        continue
-
-                    resp = await client.get(url)
-                    if resp.status_code in {301, 302, 303, 307, 308}:
-                        loc = resp.headers.get("location") or ""
-                        if loc:
-                            nxt = urljoin(url, loc)
-                            nxtp = urlparse(nxt)
-                            if nxtp.netloc == allowed_netloc and nxt not in visited:
-                                queue.append((nxt, depth))
-                        await asyncio.sleep(rate_limit_sec)
-                        continue
-                    if resp.status_code != 200:
-                        await asyncio.sleep(rate_limit_sec)
-                        continue
-
-                    ctype = (resp.headers.get("content-type") or "").lower()
-                    if "text/html" not in ctype:
-                        await asyncio.sleep(rate_limit_sec)
-                        continue
-                    content = resp.text
-                    if len(content) > 1_000_000:
-                        content = content[:1_000_000]
-
-                    text = _html_to_text(content)
-                    if text:
-                        pages.append((url, text))
-
-                    if depth < max_depth:
-                        for href in _extract_links(content):
-                            nxt = urljoin(url, href)
-                            try:
-                                nxt = _normalize_url(nxt)
-                            except HTTPException:
-                                continue
-                            nxtp = urlparse(nxt)
-                            if nxtp.netloc != allowed_netloc:
-                                continue
-                            if nxt not in visited:
-                                queue.append((nxt, depth + 1))
-
-                    await asyncio.sleep(rate_limit_sec)
+                    return
+                crawler = web_crawler.Crawler(
+                    client,
+                    start_url=start_url,
+                    max_pages=max_pages,
+                    max_depth=max_depth,
+                    interval=rate_limit_sec,
+                    limits=limits,
+                    robots=robots,
+                    seeds=list(previous) if recrawl else None,
+                    validators=previous,
+                )
+                await crawler.run(on_page, on_progress)
+                await flush()
             except asyncio.CancelledError:
+                await self._flush_partial(flush)
                 job.status = "canceled"
                 job.error = None
+                job.progress["indexedPages"] = len(stored)
                 await self._update_job(user_id, job)
                 return
             except Exception as e:
+                await self._flush_partial(flush)
+                # TaskGroup wraps worker failures; report the first one.
                 job.status = "failed"
-                job.error = str(e)
+                job.error = str(e.exceptions[0] if isinstance(e, ExceptionGroup) else e)
+                job.progress["indexedPages"] = len(stored)
                 await self._update_job(user_id, job)
                 return
 
-        # Build a single RAG doc
-        combined = []
-        for url, text in pages:
-            combined.append(f"URL: {url}\n\n{text}\n\n---\n")
-        combined_text = "\n".join(combined).strip()
-        if not combined_text:
+        # Only a 404/410 proves a page is gone; pages fetched again whose text is no longer stored
+        # (now empty, or a near-duplicate of another page) are stale too. Anything else, including
+        # pages that failed this time (transport errors, 5xx, 429, ...) or were not reached, stays.
+        gone = set(crawler.gone)
+        drop = gone | (crawler.validators.keys() - set(stored))
+        refreshed = set(fetched)
+        kept = [url for url in previous if url not in drop and url not in refreshed]
+        if not fetched and not crawler.unchanged and not gone:
             job.status = "failed"
             job.error = "No indexable pages found"
             await self._update_job(user_id, job)
             return
 
-        result = add_rag_document(user_id, name=f"Website: {start_url}", text=combined_text, source=start_url)
+        docs = await asyncio.to_thread(rag_store.list_documents, user_id)
+        members = [d for d in docs if d.get("collection") == start_url]
+        stale = [str(d.get("id") or "") for d in members if d.get("source") in drop]
+        current = {str(d["source"]) for d in members if d.get("source") and d.get("source") not in drop}
+        if current:
+            # Before pages were stored one by one, a crawl was a single "Website: ..." document with
+            # the start URL as source and no collection; the page documents supersede it.
+            stale += [str(d.get("id") or "") for d in docs if _is_legacy_crawl(d, start_url)]
+        for doc_id in stale:
+            await asyncio.to_thread(rag_store.delete_document, user_id, doc_id)
+        await asyncio.to_thread(dedup.finish, current | set(stored))
+        # Every surviving document's URL goes into the state, so the next recrawl revalidates it.
+        pages = {url: previous.get(url, {}) for url in current}
+        pages.update({url: previous[url] for url in kept})
+        pages.update({url: crawler.validators.get(url, {}) for url in fetched})
+        await asyncio.to_thread(crawl_state.save, user_id, start_url, job_id=job.id, pages=pages)
+
         job.status = "succeeded"
-        job.result = {"pages": len(pages), "ragDoc": result}
-        job.progress = {"visited": len(visited), "indexedPages": len(pages), "queued": 0}
+        job.result = {
+            "pages": len(stored),
+            "duplicatePages": len(duplicates),
+            "duplicates": duplicates[:50],
+            "collection": start_url,
+            "removedDocuments": len(stale),
+        }
+        if recrawl:
+            job.result.update(
+                {
+                    "changedPages": len(fetched),
+                    "unchangedPages": len(crawler.unchanged),
+                    "removedPages": len(gone & previous.keys()),
+                }
+            )
+        job.progress = {
+            "visited": crawler.visited,
+            "indexedPages": len(stored),
+            "queued": 0,
+            "errors": crawler.errors,
+            "robotsBlocked": crawler.blocked,
+            "effectiveRate": crawler.effective_rate(),
+        }
         await self._update_job(user_id, job)
 
+    async def _flush_partial(self, flush: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await flush()
+        except Exception:
+            pass  # The job already failed or was canceled; keep whatever was committed.
+
     async def _run_github_repo(self, user_id: str, job: IndexJob) -> None:
         job.status = "running"
         job.progress = {"files": 0, "indexedFiles": 0, "bytes": 0}
@@ -631,14 +689,11 @@ class IndexJobStore:
             await self._update_job(user_id, job)
             return
 
-        combined = []
-        for path, text in files_text:
-            combined.append(f"FILE: {path}\n\n{text}\n\n---\n")
-        combined_text = "\n".join(combined).strip()
-        result = add_rag_document(
+        result = await asyncio.to_thread(
+            add_rag_document,
             user_id,
             name=f"GitHub: {owner}/{repo}@{ref}",
-            text=combined_text,
+            sections=[f"FILE: {path}\n\n{text}\n\n---\n" for path, text in files_text],
             source=f"https://github.com/{owner}/{repo}",
         )
         job.status = "succeeded"
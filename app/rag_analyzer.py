@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from typing import NamedTuple
+
+import numpy as np
+
+# Text analysis shared by RAG indexing and querying.
+#
+# `tokenize` is the plain form (Unicode word split + case/accent folding) used for query
+# validation, excerpts and the hashing embedder. `Analyzer.terms` additionally drops stopwords
+# and optionally applies a light plural stemmer; it defines the terms stored in the inverted
+# index, so postings record `Analyzer.signature` and are rebuilt when it changes.
+#
+# Terms are identified by a 64-bit hash ("token id"). `Analyzer.analyze` returns them as arrays
+# together with each token's ordinal position and character span in the original text, and is
+# cached per chunk text. Positions count stopwords, so phrase adjacency survives their removal.
+
+_TOKEN_RE = re.compile(r"\w+")
+_PHRASE_RE = re.compile(r'"([^"]+)"')
+_ANALYZER_VERSION = 1
+
+STOPWORDS = frozenset(
+    """
+    a an and are as at be but by for from has have he her his i if in into is it its me my no
+    not of on or our she so than that the their them then there these they this to us was we
+    were what when where which who will with you your
+    """.split()
+)
+
+
+def fold(text: str) -> str:
+    """
+    Case-folds and strips combining marks ("Café" -> "cafe"); ASCII input takes a fast path.
+    """
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokens_with_spans(text: str) -> list[tuple[str, int, int]]:
+    """
+    `(token, start, end)` with offsets into `text`. Words are split before folding so offsets
+    stay valid when folding changes the length of the text.
+    """
+    text = text or ""
+    if text.isascii():
+        return [(m.group().lower(), m.start(), m.end()) for m in _TOKEN_RE.finditer(text)]
+    return [(t, m.start(), m.end()) for m in _TOKEN_RE.finditer(text) for t in _TOKEN_RE.findall(fold(m.group()))]
+
+
+def tokenize(text: str) -> list[str]:
+    text = text or ""
+    if text.isascii():
+        return _TOKEN_RE.findall(text.lower())
+    return [t for t, _start, _end in tokens_with_spans(text)]
+
+
+def phrases(query: str) -> list[str]:
+    """
+    Double-quoted segments of a query that contain more than one token.
+    """
+    return [p for p in _PHRASE_RE.findall(query or "") if len(tokenize(p)) > 1]
+
+
+def stem(token: str) -> str:
+    """
+    Harman's "S" stemmer: only conflates regular English plurals, so it never over-stems.
+    """
+    if len(token) <= 3 or not token.endswith("s"):
+        return token
+    if token.endswith("ies") and not token.endswith(("eies", "aies")):
+        return token[:-3] + "y"
+    if token.endswith("es") and not token.endswith(("aes", "ees", "oes")):
+        return token[:-1]
+    if not token.endswith(("us", "ss")):
+        return token[:-1]
+    return token
+
+
+@functools.lru_cache(maxsize=65536)
+def term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class Analysis(NamedTuple):
+    ids: np.ndarray  # uint64 term hashes, stopwords removed
+    pos: np.ndarray  # uint32 token ordinal (stopwords counted)
+    start: np.ndarray  # uint32 character span in the original text
+    end: np.ndarray
+
+
+class Analyzer:
+    def __init__(self, *, stopwords: frozenset[str] = STOPWORDS, stemming: bool = False) -> None:
+        self.stopwords = stopwords
+        self.stemming = stemming
+        words = hashlib.blake2b(" ".join(sorted(stopwords)).encode("utf-8"), digest_size=4).hexdigest()
+        self.signature = f"v{_ANALYZER_VERSION}:stop-{words}:{'stem' if stemming else 'nostem'}"
+        self.analyze = functools.lru_cache(maxsize=4096)(self._analyze)
+
+    def _term(self, token: str) -> str:
+        return stem(token) if self.stemming else token
+
+    def terms(self, text: str) -> list[str]:
+        return [self._term(t) for t in tokenize(text) if t not in self.stopwords]
+
+    def term_ids(self, text: str) -> np.ndarray:
+        return self.analyze(text).ids
+
+    def _analyze(self, text: str) -> Analysis:
+        spans = tokens_with_spans(text)
+        kept = [(term_hash(self._term(t)), i, a, b) for i, (t, a, b) in enumerate(spans) if t not in self.stopwords]
+        cols = list(zip(*kept, strict=True)) or [(), (), (), ()]
+        out = Analysis(
+            np.array(cols[0], dtype=np.uint64),
+            np.array(cols[1], dtype=np.uint32),
+            np.array(cols[2], dtype=np.uint32),
+            np.array(cols[3], dtype=np.uint32),
+        )
+        for a in out:
+            a.flags.writeable = False
+        return out
+
+
+_ANALYZERS_LOCK = threading.Lock()
+_ANALYZERS: dict[bool, Analyzer] = {}
+
+
+def stemming_enabled() -> bool:
+    return (os.environ.get("RAG_STEMMING") or "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_analyzer(*, stemming: bool | None = None) -> Analyzer:
+    """
+    Shared analyzer instance; `stemming` defaults to `RAG_STEMMING`.
+    """
+    key = stemming_enabled() if stemming is None else stemming
+    with _ANALYZERS_LOCK:
+        analyzer = _ANALYZERS.get(key)
+        if analyzer is None:
+            analyzer = _ANALYZERS[key] = Analyzer(stemming=key)
+        return analyzer
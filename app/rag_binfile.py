@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+# Fixed-layout container for derived RAG search structures (postings, embeddings).
+#
+# Files are read through a shared read-only mmap, so opening one costs a header parse and
+# every uvicorn worker serves from the same OS page cache instead of holding a private copy.
+#
+# Layout (little-endian):
+#   header:      4s magic "RAGB" | u32 version | u32 array count | u64 generation
+#   descriptors: per array, 16s name | 8s numpy dtype str | u64 element count | u64 byte offset
+#   data:        each array's raw bytes, 64-byte aligned
+#
+# Arrays are one-dimensional; callers reshape. Files are written to a temp path and renamed,
+# so readers holding an old mapping keep a consistent snapshot.
+
+_MAGIC = b"RAGB"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIIQ")
+_DESC = struct.Struct("<16s8sQQ")
+_ALIGN = 64
+_MAX_OPEN = 128
+
+
+class ArrayFile:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, count, generation = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"Unsupported array file: {path.name}")
+        self.generation = int(generation)
+        # Scratch space for values derived from the (immutable) arrays.
+        self.memo: dict[Any, Any] = {}
+        self.arrays: dict[str, np.ndarray] = {}
+        for i in range(count):
+            raw_name, raw_dtype, n, offset = _DESC.unpack_from(self._mm, _HEADER.size + i * _DESC.size)
+            dtype = np.dtype(raw_dtype.rstrip(b"\0").decode("ascii"))
+            data = self._mm[offset : offset + n * dtype.itemsize]
+            self.arrays[raw_name.rstrip(b"\0").decode("ascii")] = data.view(dtype)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def raw(self) -> memoryview:
+        """
+        The whole file as mapped: a consistent copy source even if the path was replaced since.
+        """
+        return memoryview(self._mm)
+
+
+def write_arrays(path: Path, arrays: dict[str, np.ndarray], *, generation: int = 0) -> None:
+    from app import rag_index  # rag_index imports this module
+
+    items = [(name, np.ascontiguousarray(a).reshape(-1)) for name, a in arrays.items()]
+    offset = _HEADER.size + _DESC.size * len(items)
+    layout = []
+    for name, a in items:
+        offset = -(-offset // _ALIGN) * _ALIGN
+        layout.append((name, a, offset))
+        offset += a.nbytes
+
+    tmp = rag_index.temp_path(path)
+    try:
+        with tmp.open("wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(items), int(generation)))
+            for name, a, off in layout:
+                f.write(_DESC.pack(name.encode("ascii"), a.dtype.str.encode("ascii"), a.size, off))
+            for _name, a, off in layout:
+                f.write(b"\0" * (off - f.tell()))
+                f.write(a.tobytes())
+        tmp.replace(path)
+    except Exception:
+        tmp.unlink(missing_ok=True)
+        raise
+    _forget(path)
+
+
+def set_generation(path: Path, generation: int) -> None:
+    """
+    Rewrites the header generation in place; only for files not yet renamed into place.
+    """
+    with path.open("r+b") as f:
+        magic, version, count, _generation = _HEADER.unpack(f.read(_HEADER.size))
+        f.seek(0)
+        f.write(_HEADER.pack(magic, version, count, int(generation)))
+
+
+# Open mappings, keyed by path and validated by (inode, mtime_ns, size).
+_OPEN_LOCK = threading.Lock()
+_OPEN: OrderedDict[str, tuple[tuple[int, int, int], ArrayFile]] = OrderedDict()
+
+
+def _forget(path: Path) -> None:
+    with _OPEN_LOCK:
+        _OPEN.pop(str(path), None)
+
+
+def open_arrays(path: Path, *, cache: bool = True) -> ArrayFile | None:
+    """
+    Returns a (cached) mapping of `path`, or None if it is missing or unreadable.
+    """
+    if not cache:
+        try:
+            return ArrayFile(path)
+        except (OSError, ValueError, struct.error):
+            return None
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    key = str(path)
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _OPEN_LOCK:
+        hit = _OPEN.get(key)
+        if hit is not None and hit[0] == stamp:
+            _OPEN.move_to_end(key)
+            return hit[1]
+    try:
+        f = ArrayFile(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    with _OPEN_LOCK:
+        _OPEN[key] = (stamp, f)
+        while len(_OPEN) > _MAX_OPEN:
+            _OPEN.popitem(last=False)
+    return f
+
+
+def pack_strings(values: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encodes strings as (offsets uint64[n + 1], utf-8 blob uint8[...]).
+    """
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    if encoded:
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def unpack_string(offsets: np.ndarray, blob: np.ndarray, i: int) -> str:
+    return blob[int(offsets[i]) : int(offsets[i + 1])].tobytes().decode("utf-8")
+
+
+def unpack_strings(offsets: np.ndarray, blob: np.ndarray) -> list[str]:
+    raw = blob.tobytes()
+    bounds = offsets.tolist()
+    return [raw[bounds[i] : bounds[i + 1]].decode("utf-8") for i in range(len(bounds) - 1)]
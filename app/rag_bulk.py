@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import IO, Any
+
+from fastapi import HTTPException
+
+from app import rag_analyzer, rag_index, rag_store
+
+# Bulk ingest of a zip / tar.gz archive of text files.
+#
+# Members are read one at a time from the (spooled) upload: tar archives in streaming mode,
+# zips through their central directory. Each member's bytes go to a process pool that decodes,
+# chunks and analyzes them (`rag_index.prepare_document`); a bounded number of members is in
+# flight, so memory stays proportional to the pool size. Results are consumed in archive order
+# and handed to `rag_store.add_documents`, which commits the whole archive in one write.
+#
+# Documents get `source = "archive:{archive name}/{member path}"`, so uploading a newer build of
+# the same archive re-ingests changed files in place.
+
+_DEFAULT_MAX_FILES = 500
+_DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+_SNIFF_BYTES = 8192
+
+_POOL_LOCK = threading.Lock()
+_POOL: ProcessPoolExecutor | None = None
+
+
+def _env_int(name: str, default: int) -> int:
+    raw = (os.environ.get(name) or "").strip()
+    try:
+        return max(0, int(raw)) if raw else default
+    except ValueError:
+        return default
+
+
+def max_files() -> int:
+    return _env_int("RAG_BULK_MAX_FILES", _DEFAULT_MAX_FILES)
+
+
+def max_bytes() -> int:
+    """
+    Limit on the archive upload and, separately, on the total size of its extracted files.
+    """
+    return _env_int("RAG_BULK_MAX_BYTES", _DEFAULT_MAX_BYTES)
+
+
+def _workers() -> int:
+    return _env_int("RAG_BULK_WORKERS", min(4, os.cpu_count() or 1))
+
+
+def _pool() -> ProcessPoolExecutor | None:
+    global _POOL
+    if _workers() <= 0:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: forking a server with live threads (RAG writers, executors) isn't safe.
+            ctx = multiprocessing.get_context("spawn")
+            _POOL = ProcessPoolExecutor(max_workers=_workers(), mp_context=ctx)
+        return _POOL
+
+
+def shutdown() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _invalid(message: str) -> HTTPException:
+    return HTTPException(status_code=400, detail={"code": "invalid_request", "message": message})
+
+
+def _skipped(path: str) -> bool:
+    parts = path.split("/")
+    return any(p.startswith(".") for p in parts) or parts[0] == "__MACOSX"
+
+
+def _members(fileobj: IO[bytes], file_limit: int) -> Iterator[tuple[str, bytes]]:
+    """
+    `(path, data)` for the regular files of a zip or (gzipped) tar archive, in archive order.
+    Files over `file_limit` bytes raise 413.
+    """
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+
+    def read(path: str, f: IO[bytes]) -> tuple[str, bytes]:
+        data = f.read(file_limit + 1)
+        if len(data) > file_limit:
+            raise HTTPException(
+                status_code=413,
+                detail={"code": "payload_too_large", "message": f"{path} exceeds {file_limit} bytes"},
+            )
+        return path, data
+
+    if magic.startswith(b"PK"):
+        try:
+            archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile as e:
+            raise _invalid("Invalid zip archive") from e
+        with archive:
+            for info in archive.infolist():
+                path = posixpath.normpath(info.filename)
+                if info.is_dir() or _skipped(path):
+                    continue
+                with archive.open(info) as f:
+                    yield read(path, f)
+        return
+    try:
+        archive = tarfile.open(fileobj=fileobj, mode="r|*")
+    except tarfile.TarError as e:
+        raise _invalid("Expected a .zip, .tar or .tar.gz archive") from e
+    with archive:
+        try:
+            for member in archive:
+                path = posixpath.normpath(member.name)
+                if not member.isfile() or _skipped(path):
+                    continue
+                f = archive.extractfile(member)
+                if f is not None:
+                    yield read(path, f)
+        except tarfile.TarError as e:
+            raise _invalid("Corrupt tar archive") from e
+
+
+def _prepare(name: str, source: str, data: bytes, analyze: bool, stemming: bool) -> rag_index.PreparedDocument | None:
+    """
+    Worker: decode (UTF-8, else latin-1), chunk and analyze one file; None for binary or blank.
+    """
+    if b"\0" in data[:_SNIFF_BYTES]:
+        return None
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = data.decode("latin-1")
+    doc = rag_index.prepare_document(name, text, source=source, analyze=analyze, stemming=stemming)
+    return doc if doc.chunks else None
+
+
+def ingest_archive(user_id: str, fileobj: IO[bytes], *, archive_name: str, file_limit: int) -> dict[str, Any]:
+    """
+    Indexes every text file of the archive as its own document. Returns the per-document
+    results plus the paths that were skipped (binary, blank or duplicate).
+    """
+    total_limit, count_limit = max_bytes(), max_files()
+    # Only the JSON backend stores postings computed outside the writer.
+    analyze = rag_store.rag_backend() == "json"
+    stemming = rag_analyzer.stemming_enabled()
+    pool = _pool()
+    window = 2 * max(1, _workers())
+    skipped: list[str] = []
+
+    def prepared() -> Iterator[rag_index.PreparedDocument]:
+        pending: deque[tuple[str, Future[Any] | rag_index.PreparedDocument | None]] = deque()
+        seen: set[str] = set()
+        total = 0
+
+        def drain(keep: int) -> Iterator[rag_index.PreparedDocument]:
+            while len(pending) > keep:
+                path, result = pending.popleft()
+                doc = result.result() if isinstance(result, Future) else result
+                if doc is None:
+                    skipped.append(path)
+                else:
+                    yield doc
+
+        for path, data in _members(fileobj, file_limit):
+            if path in seen:
+                skipped.append(path)
+                continue
+            seen.add(path)
+            if len(seen) > count_limit:
+                raise _invalid(f"Archive has more than {count_limit} files")
+            total += len(data)
+            if total > total_limit:
+                raise HTTPException(
+                    status_code=413,
+                    detail={"code": "payload_too_large", "message": f"Extracted files exceed {total_limit} bytes"},
+                )
+            args = (path[:200], f"archive:{archive_name}/{path}", data, analyze, stemming)
+            pending.append((path, pool.submit(_prepare, *args) if pool else _prepare(*args)))
+            yield from drain(window)
+        yield from drain(0)
+
+    documents = rag_store.add_documents(user_id, prepared())
+    return {"documents": documents, "skipped": skipped}
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from app import rag_analyzer, rag_index, rag_store
+
+# Near-duplicate page filter for crawl ingest.
+#
+# Each page gets a 64-bit SimHash (Charikar) over its word 3-gram shingles: pages that share most
+# of their text (pagination, print views, tag pages) land within a few bits of each other. With
+# a Hamming threshold d, signatures are split into d + 1 bands; by pigeonhole two signatures
+# within distance d agree exactly on at least one band, so a per-band hash table (LSH) finds every
+# candidate without scanning the whole index.
+#
+# The index is kept per user in `rag/near-dups.json` as (collection, url, signature) entries, so
+# a crawl is also checked against pages already stored by other crawls. Entries of a collection
+# being re-crawled are replaced, and entries whose collection no longer has stored documents are
+# dropped on load.
+
+_SHINGLE = 3
+# Pages with fewer shingles than this are too short for a meaningful signature; always kept.
+_MIN_SHINGLES = 8
+_DEFAULT_MAX_DISTANCE = 3
+_BITS = np.arange(64, dtype=np.uint64)
+
+
+def _max_distance() -> int:
+    raw = (os.environ.get("RAG_NEAR_DUP_DISTANCE") or "").strip()
+    try:
+        return min(16, int(raw)) if raw else _DEFAULT_MAX_DISTANCE
+    except ValueError:
+        return _DEFAULT_MAX_DISTANCE
+
+
+def _index_path(user_id: str) -> Path:
+    return rag_index.rag_dir(user_id) / "near-dups.json"
+
+
+def simhash(text: str) -> int | None:
+    """
+    64-bit SimHash of `text`'s word shingles, or None when the text is too short.
+    """
+    tokens = rag_analyzer.tokenize(text)
+    shingles = [" ".join(tokens[i : i + _SHINGLE]) for i in range(len(tokens) - _SHINGLE + 1)]
+    if len(shingles) < _MIN_SHINGLES:
+        return None
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles],
+        dtype=np.uint64,
+    )
+    ones = ((hashes[:, None] >> _BITS) & np.uint64(1)).sum(axis=0, dtype=np.int64)
+    bits = (2 * ones > len(hashes)).astype(np.uint64)
+    return int((bits << _BITS).sum(dtype=np.uint64))
+
+
+class NearDupIndex:
+    """
+    SimHash signatures with banded LSH lookup: `find` returns the key of a stored signature within
+    `max_distance` bits, if any.
+    """
+
+    def __init__(self, *, max_distance: int = _DEFAULT_MAX_DISTANCE) -> None:
+        self.max_distance = max_distance
+        edges = np.linspace(0, 64, max_distance + 2).astype(int).tolist()
+        self._bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges, edges[1:], strict=False)]
+        self._tables: list[dict[int, list[int]]] = [{} for _ in self._bands]
+        self.keys: list[Any] = []
+        self.signatures: list[int] = []
+
+    def _band_values(self, sig: int) -> list[int]:
+        return [(sig >> lo) & mask for lo, mask in self._bands]
+
+    def find(self, sig: int) -> Any | None:
+        seen: set[int] = set()
+        for table, value in zip(self._tables, self._band_values(sig), strict=True):
+            for i in table.get(value, ()):
+                if i not in seen:
+                    seen.add(i)
+                    if (self.signatures[i] ^ sig).bit_count() <= self.max_distance:
+                        return self.keys[i]
+        return None
+
+    def add(self, key: Any, sig: int) -> None:
+        i = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(sig)
+        for table, value in zip(self._tables, self._band_values(sig), strict=True):
+            table.setdefault(value, []).append(i)
+
+
+_LOCK = threading.Lock()
+
+
+def _read_entries(user_id: str) -> list[list[str]]:
+    try:
+        stored = rag_index.read_json(_index_path(user_id))
+    except (OSError, ValueError):
+        # Missing or unreadable: it only holds signatures, so start over.
+        stored = {}
+    entries = stored.get("entries") if isinstance(stored, dict) else None
+    return [e for e in entries or [] if isinstance(e, list) and len(e) == 3]
+
+
+class PageFilter:
+    """
+    Near-duplicate filter for one crawl whose pages are stored under `collection`, fed batches of
+    pages as they are crawled. Signatures the collection stored before are replaced, except those
+    of the URLs in `keep` (pages a recrawl may find unchanged). Kept pages are recorded in the
+    user's index after every batch, so an interrupted crawl still leaves its signatures behind.
+    """
+
+    def __init__(self, user_id: str, *, collection: str, keep: Iterable[str] = ()) -> None:
+        self.user_id = user_id
+        self.collection = collection
+        self.max_distance = _max_distance()
+        self._index = NearDupIndex(max_distance=max(self.max_distance, 0))
+        self._own: dict[str, str] = {}
+        if self.max_distance < 0:
+            return
+        keep = set(keep)
+        with _LOCK:
+            live = {str(d.get("collection") or d.get("source") or "") for d in rag_store.list_documents(user_id)}
+            live -= {collection, ""}
+            stored = _read_entries(user_id)
+            entries = [e for e in stored if e[0] in live]
+            self._own = {url: sig for source, url, sig in stored if source == collection and url in keep}
+            entries += [[collection, url, sig] for url, sig in self._own.items()]
+            rag_index.write_json(_index_path(user_id), {"version": 1, "entries": entries})
+        for _source, url, sig in entries:
+            self._index.add(url, int(sig, 16))
+
+    def filter(self, pages: list[tuple[str, str]]) -> tuple[list[tuple[str, str]], list[dict[str, str]]]:
+        """
+        Splits `(url, text)` pages into the ones to store and the near duplicates dropped
+        (`{"url", "duplicateOf"}`).
+        """
+        if self.max_distance < 0:
+            return pages, []
+        kept: list[tuple[str, str]] = []
+        dropped: list[dict[str, str]] = []
+        for url, text in pages:
+            sig = simhash(text)
+            if sig is not None:
+                original = self._index.find(sig)
+                # A page matching its own earlier version is not a duplicate.
+                if original is not None and original != url:
+                    dropped.append({"url": url, "duplicateOf": str(original)})
+                    continue
+                self._index.add(url, sig)
+                self._own[url] = f"{sig:016x}"
+            kept.append((url, text))
+        self._save()
+        return kept, dropped
+
+    def finish(self, urls: Iterable[str]) -> None:
+        """
+        Forgets the collection's signatures of pages not in `urls` (gone since the last crawl).
+        """
+        urls = set(urls)
+        self._own = {url: sig for url, sig in self._own.items() if url in urls}
+        self._save()
+
+    def _save(self) -> None:
+        if self.max_distance < 0:
+            return
+        with _LOCK:
+            # Re-read: other crawls of this user save their own collections in between.
+            entries = [e for e in _read_entries(self.user_id) if e[0] != self.collection]
+            entries += [[self.collection, url, sig] for url, sig in self._own.items()]
+            rag_index.write_json(_index_path(self.user_id), {"version": 1, "entries": entries})
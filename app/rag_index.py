@@ -0,0 +1,1982 @@
+from __future__ import annotations
+
+import copy
+import fcntl
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter, OrderedDict, deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NamedTuple, TextIO
+
+import numpy as np
+from fastapi import HTTPException
+
+from app import rag_analyzer, rag_binfile, rag_segments
+from app.storage import user_data_dir
+
+if TYPE_CHECKING:
+    from app.rag_vectors import PendingVectors
+
+# Okapi BM25 defaults.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_NON_SPACE_RE = re.compile(r"\S")
+
+_DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+_DEFAULT_COMPACT_DEAD_FRACTION = 0.25
+
+
+def _now_iso() -> str:
+    return datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def rag_dir(user_id: str) -> Path:
+    root = user_data_dir(user_id) / "rag"
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def manifest_path(user_id: str) -> Path:
+    return rag_dir(user_id) / "rag-manifest.json"
+
+
+def legacy_index_path(user_id: str) -> Path:
+    return rag_dir(user_id) / "rag-index.json"
+
+
+def shard_path(user_id: str, doc_id: str, name: str | None = None) -> Path:
+    root = rag_dir(user_id) / "chunks"
+    root.mkdir(parents=True, exist_ok=True)
+    return root / (name or f"{doc_id}.json")
+
+
+def postings_path(user_id: str) -> Path:
+    return rag_dir(user_id) / "rag-postings.bin"
+
+
+def tokenize(text: str) -> list[str]:
+    return rag_analyzer.tokenize(text)
+
+
+class StreamChunker:
+    """
+    Incremental version of `chunk_text`: feed text pieces, get chunk strings back as soon as
+    they are final. Produces exactly the chunks `chunk_text` would for the concatenated text
+    while only buffering about one window plus the current piece.
+    """
+
+    def __init__(self, *, max_chars: int = 1200, overlap: int = 120) -> None:
+        self.max_chars = max_chars
+        self.overlap = overlap
+        self._buf = ""
+        # Offset of `_buf` in everything fed so far.
+        self._base = 0
+        self.started = False
+
+    def feed(self, piece: str) -> Iterator[str]:
+        return (chunk for _start, chunk in self.feed_spans(piece))
+
+    def finish(self) -> Iterator[str]:
+        return (chunk for _start, chunk in self.finish_spans())
+
+    def feed_spans(self, piece: str) -> Iterator[tuple[int, str]]:
+        """
+        `feed`, with each chunk's character offset in the text fed so far (chunks are exact
+        substrings of it).
+        """
+        if not self.started:
+            stripped = piece.lstrip()
+            self._base += len(piece) - len(stripped)
+            piece = stripped
+            if not piece:
+                return
+            self.started = True
+        buf = self._buf + piece
+        i = 0
+        # A window is final once non-whitespace text exists past its end (the whole text is
+        # stripped first, so trailing whitespace never starts another window).
+        while len(buf) - i > self.max_chars and _NON_SPACE_RE.search(buf, i + self.max_chars):
+            window = buf[i : i + self.max_chars]
+            chunk = window.strip()
+            if chunk:
+                yield self._base + i + len(window) - len(window.lstrip()), chunk
+            i += self.max_chars - self.overlap
+        self._buf = buf[i:]
+        self._base += i
+
+    def finish_spans(self) -> Iterator[tuple[int, str]]:
+        t = self._buf.rstrip()
+        base = self._base
+        self._base += len(self._buf)
+        self._buf = ""
+        i = 0
+        n = len(t)
+        while i < n:
+            j = min(n, i + self.max_chars)
+            window = t[i:j]
+            chunk = window.strip()
+            if chunk:
+                yield base + i + len(window) - len(window.lstrip()), chunk
+            if j >= n:
+                break
+            i = max(0, j - self.overlap)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ChunkIds:
+    """
+    Deterministic chunk ids for one document: a hash of the document id, the chunk's content
+    hash and how many identical chunks precede it. Re-ingesting unchanged text under the same
+    document id reproduces the same ids, which is what incremental re-ingest diffs on.
+    """
+
+    def __init__(self, doc_id: str) -> None:
+        self.doc_id = doc_id
+        self._seen: Counter[str] = Counter()
+
+    def __call__(self, text: str) -> str:
+        digest = content_hash(text)
+        n = self._seen[digest]
+        self._seen[digest] += 1
+        return hashlib.blake2b(f"{self.doc_id}:{digest}:{n}".encode(), digest_size=16).hexdigest()
+
+
+def chunk_text(text: str, *, doc_id: str = "", max_chars: int = 1200, overlap: int = 120) -> list[dict[str, str]]:
+    chunker = StreamChunker(max_chars=max_chars, overlap=overlap)
+    pieces = [*chunker.feed(text or ""), *chunker.finish()]
+    ids = ChunkIds(doc_id)
+    return [{"id": ids(chunk), "text": chunk} for chunk in pieces]
+
+
+# Parsed-file cache
+#
+# Process-wide LRU of decoded files keyed by path. Entries are validated against the
+# file's (mtime_ns, size) on every read, and writes made through `write_json` replace the
+# entry in place, so repeated reads skip the JSON decode. The budget is approximated by the
+# on-disk size of the cached files, or by an estimate of the decoded size where that is far
+# larger (the writer's postings, which are charged via `_postings_footprint`).
+
+_CACHE_LOCK = threading.Lock()
+# path -> (mtime_ns, size, data, bytes charged against the budget)
+_CACHE: OrderedDict[str, tuple[int, int, Any, int]] = OrderedDict()
+_CACHE_BYTES = 0
+
+
+def _cache_budget() -> int:
+    raw = (os.environ.get("RAG_INDEX_CACHE_BYTES") or "").strip()
+    try:
+        return max(0, int(raw)) if raw else _DEFAULT_CACHE_BYTES
+    except ValueError:
+        return _DEFAULT_CACHE_BYTES
+
+
+def _cache_drop(path: Path) -> None:
+    global _CACHE_BYTES
+    with _CACHE_LOCK:
+        entry = _CACHE.pop(str(path), None)
+        if entry is not None:
+            _CACHE_BYTES -= entry[3]
+
+
+def _cache_put(path: Path, st: os.stat_result, data: Any, *, charge: int | None = None) -> None:
+    """
+    Caches `data` decoded from `path`, charging `charge` bytes (default: the file size).
+    """
+    global _CACHE_BYTES
+    key = str(path)
+    budget = _cache_budget()
+    charge = st.st_size if charge is None else charge
+    with _CACHE_LOCK:
+        old = _CACHE.pop(key, None)
+        if old is not None:
+            _CACHE_BYTES -= old[3]
+        if charge > budget:
+            return
+        _CACHE[key] = (st.st_mtime_ns, st.st_size, data, charge)
+        _CACHE_BYTES += charge
+        while _CACHE_BYTES > budget and _CACHE:
+            _key, evicted = _CACHE.popitem(last=False)
+            _CACHE_BYTES -= evicted[3]
+
+
+def clear_cache() -> None:
+    global _CACHE_BYTES
+    with _CACHE_LOCK:
+        _CACHE.clear()
+        _CACHE_BYTES = 0
+
+
+def _cache_get(path: Path, st: os.stat_result) -> Any | None:
+    key = str(path)
+    with _CACHE_LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+            _CACHE.move_to_end(key)
+            return hit[2]
+    return None
+
+
+def read_json(path: Path) -> Any:
+    st = path.stat()
+    hit = _cache_get(path, st)
+    if hit is not None:
+        return hit
+    data = json.loads(path.read_text(encoding="utf-8"))
+    _cache_put(path, st, data)
+    return data
+
+
+def temp_path(path: Path) -> Path:
+    """
+    A temp file next to `path` that no other writer uses.
+    """
+    return path.with_name(f"{path.name}.{uuid.uuid4().hex[:12]}.tmp")
+
+
+def write_json(path: Path, data: Any, *, indent: int | None = None) -> None:
+    tmp = temp_path(path)
+    if indent is None:
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    else:
+        payload = json.dumps(data, indent=indent, ensure_ascii=False)
+    try:
+        tmp.write_text(payload + "\n", encoding="utf-8")
+        tmp.replace(path)
+    except Exception:
+        # Callers mutate cached objects before saving; don't serve a version that never hit disk.
+        _cache_drop(path)
+        tmp.unlink(missing_ok=True)
+        raise
+    _cache_put(path, path.stat(), data)
+
+
+# Storage layout (under `user_data_dir(user_id)/rag`):
+# - `rag-manifest.json`: document metadata only; `chunks` is a count.
+# - `chunks/{doc_id}.json`: that document's chunks (`[{"id", "text"}, ...]`), loaded on demand.
+# - `{doc_id}.txt`: the raw document text.
+#
+# With `RAG_STORAGE_COMPRESSION` (zlib|lzma) new documents are written compressed instead: the
+# text goes to `{doc_id}-{nonce}.txtz` (see `app/rag_segments.py`) and the shard becomes
+# `{"text": file name, "chunks": [{"id", "start", "len"}, ...]}`, i.e. character ranges into it
+# rather than copies, so the (overlapping) chunk text is not stored a second time. Search results
+# decompress only the segments under their chunk (`load_chunk`). Both forms can coexist; a
+# document switches when it is next written.
+#
+# Older deployments kept everything in `rag-index.json` with chunk text inline; it is split
+# into the manifest + shards the first time the manifest is loaded.
+
+
+def _internal_error(e: Exception) -> HTTPException:
+    return HTTPException(status_code=500, detail={"code": "internal_error", "message": str(e)})
+
+
+def _migrate_legacy_index(user_id: str) -> dict[str, Any] | None:
+    """
+    Splits `rag-index.json` into the manifest + shards, under the store lock so concurrent
+    loads (and the writer) neither migrate twice nor read a half-written manifest.
+    """
+    legacy = legacy_index_path(user_id)
+    if not legacy.exists():
+        # No legacy index, or a concurrent migration removed it after our manifest read.
+        return _read_manifest_file(user_id)
+    with _store_lock(user_id):
+        # Another thread or process may have migrated while we waited.
+        manifest = _read_manifest_file(user_id)
+        if manifest is not None:
+            return manifest
+        try:
+            data = json.loads(legacy.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        return _split_legacy_index(user_id, data)
+
+
+def _read_manifest_file(user_id: str) -> Any | None:
+    try:
+        return read_json(manifest_path(user_id))
+    except FileNotFoundError:
+        return None
+
+
+def _split_legacy_index(user_id: str, data: Any) -> dict[str, Any]:
+    docs = data.get("documents") if isinstance(data, dict) else None
+    manifest: dict[str, Any] = {"version": 2, "documents": []}
+    for d in docs if isinstance(docs, list) else []:
+        if not isinstance(d, dict) or not d.get("id"):
+            continue
+        doc_id = str(d["id"])
+        chunks = [c for c in d.get("chunks") or [] if isinstance(c, dict)]
+        write_json(shard_path(user_id, doc_id), chunks)
+        entry = {k: v for k, v in d.items() if k != "chunks"}
+        entry["chunks"] = len(chunks)
+        manifest["documents"].append(entry)
+    write_json(manifest_path(user_id), manifest)
+    legacy_index_path(user_id).unlink(missing_ok=True)
+    return manifest
+
+
+def load_manifest(user_id: str) -> dict[str, Any]:
+    try:
+        data = read_json(manifest_path(user_id))
+    except FileNotFoundError:
+        try:
+            data = _migrate_legacy_index(user_id)
+        except Exception as e:
+            raise _internal_error(e) from e
+        if data is None:
+            return {"version": 2, "documents": []}
+    except Exception as e:
+        raise _internal_error(e) from e
+    if not isinstance(data, dict):
+        data = {"version": 2}
+    if not isinstance(data.get("documents"), list):
+        data["documents"] = []
+    if "generation" not in data and data["documents"]:
+        # Written before generations existed: make sure it can't match an empty derived file.
+        data["generation"] = 1
+    return data
+
+
+def save_manifest(user_id: str, data: dict[str, Any]) -> None:
+    try:
+        write_json(manifest_path(user_id), data)
+    except Exception as e:
+        raise _internal_error(e) from e
+
+
+def storage_compression() -> str | None:
+    """
+    `RAG_STORAGE_COMPRESSION`: the codec new documents' text is stored with (None: plain files).
+    """
+    name = (os.environ.get("RAG_STORAGE_COMPRESSION") or "").strip().lower()
+    return name if name in rag_segments.CODECS else None
+
+
+_SHARD_NAMES_LOCK = threading.Lock()
+_SHARD_NAMES: dict[str, tuple[int, int, dict[str, str]]] = {}
+
+
+def shard_name(entry: dict[str, Any]) -> str:
+    """
+    The shard file a manifest entry points at. Documents written by a `DocumentWriter` get a fresh
+    shard per write, so searches holding an older manifest keep reading the shard its postings
+    describe; imported and migrated documents use `{doc_id}.json`.
+    """
+    return str(entry.get("shard") or f"{entry.get('id')}.json")
+
+
+def _current_shard(user_id: str, doc_id: str) -> str:
+    manifest = load_manifest(user_id)
+    key = (id(manifest), manifest_generation(manifest))
+    with _SHARD_NAMES_LOCK:
+        hit = _SHARD_NAMES.get(user_id)
+        if hit is not None and hit[:2] == key:
+            return hit[2].get(doc_id) or f"{doc_id}.json"
+    names = {str(d.get("id") or ""): shard_name(d) for d in _documents(manifest)}
+    with _SHARD_NAMES_LOCK:
+        _SHARD_NAMES[user_id] = (*key, names)
+    return names.get(doc_id) or f"{doc_id}.json"
+
+
+def _read_shard(user_id: str, doc_id: str, shard: str | None = None) -> tuple[str | None, list[dict[str, Any]]]:
+    """
+    The shard's chunk entries, plus the name of the compressed text file they point into.
+    `shard` defaults to the one the current manifest points at.
+    """
+    try:
+        data = read_json(shard_path(user_id, doc_id, shard or _current_shard(user_id, doc_id)))
+    except FileNotFoundError:
+        return None, []
+    except ValueError:
+        # An unreadable shard costs its own document's chunks, not the user's whole index; the
+        # next re-ingest or delete of the document replaces it.
+        return None, []
+    except Exception as e:
+        raise _internal_error(e) from e
+    text = None
+    if isinstance(data, dict):
+        text = str(data.get("text") or "") or None
+        data = data.get("chunks")
+    if not isinstance(data, list):
+        return None, []
+    return text, [c if isinstance(c, dict) else {} for c in data]
+
+
+def _span(c: dict[str, Any]) -> tuple[int, int]:
+    start = int(c.get("start") or 0)
+    return start, start + int(c.get("len") or 0)
+
+
+def load_chunks(user_id: str, doc_id: str, *, shard: str | None = None) -> list[dict[str, Any]]:
+    """
+    All of a document's chunks as `{"id", "text"}` (compressed text is decompressed once).
+    """
+    name, chunks = _read_shard(user_id, doc_id, shard)
+    if name is None or all("text" in c for c in chunks):
+        return chunks
+    try:
+        with rag_segments.SegmentFile(rag_dir(user_id) / name) as f:
+            text = f.text()
+    except FileNotFoundError:
+        # Replaced by a re-ingest or deleted since the shard was read.
+        return []
+    except Exception as e:
+        raise _internal_error(e) from e
+    return [c if "text" in c else {"id": c.get("id"), "text": text[slice(*_span(c))]} for c in chunks]
+
+
+def load_chunk(user_id: str, doc_id: str, pos: int, *, shard: str | None = None) -> dict[str, Any] | None:
+    """
+    Chunk `pos` only: for compressed text just the segments under it are decompressed.
+    """
+    name, chunks = _read_shard(user_id, doc_id, shard)
+    if not 0 <= pos < len(chunks):
+        return None
+    c = chunks[pos]
+    if name is None or "text" in c:
+        return c
+    try:
+        with rag_segments.SegmentFile(rag_dir(user_id) / name) as f:
+            return {"id": c.get("id"), "text": f.text(*_span(c))}
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        raise _internal_error(e) from e
+
+
+def text_pieces(user_id: str, doc_id: str, *, piece_bytes: int = 1024 * 1024) -> Iterator[bytes]:
+    """
+    The document's raw text as UTF-8 pieces, however it is stored.
+    """
+    name, _chunks = _read_shard(user_id, doc_id)
+    try:
+        if name is not None:
+            with rag_segments.SegmentFile(rag_dir(user_id) / name) as f:
+                yield from f.segments()
+        else:
+            with (rag_dir(user_id) / f"{doc_id}.txt").open("rb") as fh:
+                while piece := fh.read(piece_bytes):
+                    yield piece
+    except FileNotFoundError:
+        return
+
+
+def _locate(text: str, chunks: list[str]) -> list[int]:
+    """
+    Offsets of chunker output in `text`, -1 where a chunk isn't part of it. Chunks start in
+    ascending order, so each search resumes at the previous hit.
+    """
+    starts = []
+    lo = 0
+    for chunk in chunks:
+        i = text.find(chunk, lo)
+        starts.append(i)
+        lo = max(lo, i)
+    return starts
+
+
+def _shard_entry(chunk_id: str, chunk: str, start: int, compressed: bool) -> dict[str, Any]:
+    if compressed and start >= 0:
+        return {"id": chunk_id, "start": start, "len": len(chunk)}
+    return {"id": chunk_id, "text": chunk}
+
+
+def _text_file_name(doc_id: str, compressed: bool) -> str:
+    # Compressed text gets a fresh name per write: readers holding the previous shard keep
+    # resolving its offsets against the previous file.
+    return f"{doc_id}-{uuid.uuid4().hex[:8]}.txtz" if compressed else f"{doc_id}.txt"
+
+
+def store_document_files(user_id: str, doc_id: str, text: str, chunks: list[tuple[str, str]]) -> tuple[str, int]:
+    """
+    Writes a document's text and shard with the given chunk ids (imports), in the configured
+    storage mode. Returns the text file name and the text's UTF-8 size.
+    """
+    codec = storage_compression()
+    name = _text_file_name(doc_id, codec is not None)
+    path = rag_dir(user_id) / name
+    texts = [t for _id, t in chunks]
+    starts = _locate(text, texts) if codec else [-1] * len(chunks)
+    entries = [_shard_entry(i, t, start, codec is not None) for (i, t), start in zip(chunks, starts, strict=True)]
+    if codec is None:
+        path.write_text(text, encoding="utf-8")
+        write_json(shard_path(user_id, doc_id), entries)
+        return name, path.stat().st_size
+    writer = rag_segments.SegmentWriter(path, codec)
+    try:
+        writer.write(text)
+    finally:
+        writer.close()
+    write_json(shard_path(user_id, doc_id), {"text": name, "chunks": entries})
+    return name, writer.bytes
+
+
+def _documents(manifest: dict[str, Any]) -> list[dict[str, Any]]:
+    return [d for d in manifest.get("documents") or [] if isinstance(d, dict)]
+
+
+# Inverted index
+#
+# Stored in `rag-postings.bin` (see `app/rag_binfile.py`) so searches read it through mmap
+# without decoding. Terms come from `rag_analyzer` and are identified by their 64-bit hash; arrays:
+#   term_hash u64[T] (sorted) | term_off u64[T + 1] -> range into post_slot/post_tf
+#   post_slot u32[P] (ascending per term) | post_tf u32[P] | post_pos_off u64[P + 1]
+#   post_pos u32[3 * N]: per occurrence (token ordinal, char start, char end) in the chunk
+#   slot_doc i32[S] (-1 = deleted) | slot_pos u32[S] | slot_len u32[S]   (chunk-offset table)
+#   doc_off u64[D + 1] | doc_blob u8[...]                                (document ids)
+#   stats u64[2] = (total token length, live chunks) | analyzer u8[...] (analyzer signature)
+#   term_ub f64[T]: each term's largest BM25 contribution under these stats (for MaxScore)
+# The header generation matches the manifest's `postingsGeneration`; on mismatch, an analyzer
+# change (or for older `rag-postings.json` deployments) the file is rebuilt from the chunk shards.
+#
+# Deletes don't touch this file: the document id goes on the manifest's `tombstones` list and
+# searches skip its slots. Once dead slots (tombstoned or unindexed by a re-ingest) exceed
+# `RAG_COMPACT_DEAD_FRACTION` of the table, the writer compacts the file in the background.
+# Until then corpus statistics still count the dead chunks, as in any tombstoning index.
+#
+# Writes go through a mutable dict form:
+#   {"chunks": [[doc_id, chunk_pos, length] | None, ...], "docs": {doc_id: [slot, ...]},
+#    "terms": {term_hash: [[slot, tf, positions], ...]}, "totalLength": int, "liveChunks": int,
+#    "generation": int, "analyzer": str}
+# where `positions` is the posting's packed uint32 (ordinal, start, end) triples.
+
+_Positions = dict[int, bytes]
+
+
+def manifest_generation(manifest: dict[str, Any]) -> int:
+    return int(manifest.get("generation") or 0)
+
+
+def postings_generation(manifest: dict[str, Any]) -> int:
+    # Manifests from before tombstones kept the postings in step with every store generation.
+    return int(manifest.get("postingsGeneration", manifest_generation(manifest)) or 0)
+
+
+def generation(user_id: str) -> int:
+    return manifest_generation(load_manifest(user_id))
+
+
+def _empty_postings(gen: int = 0, analyzer: str = "") -> dict[str, Any]:
+    return {
+        "chunks": [],
+        "docs": {},
+        "terms": {},
+        "totalLength": 0,
+        "liveChunks": 0,
+        "generation": gen,
+        "analyzer": analyzer or rag_analyzer.get_analyzer().signature,
+    }
+
+
+def _chunk_stats(text: str, analyzer: rag_analyzer.Analyzer | None = None) -> tuple[int, _Positions]:
+    a = (analyzer or rag_analyzer.get_analyzer()).analyze(text)
+    if not len(a.ids):
+        return 0, {}
+    order = np.argsort(a.ids, kind="stable")
+    triples = np.stack([a.pos, a.start, a.end], axis=1)[order]
+    hashes, first = np.unique(a.ids[order], return_index=True)
+    bounds = [*first.tolist(), len(order)]
+    return len(a.ids), {h: triples[bounds[i] : bounds[i + 1]].tobytes() for i, h in enumerate(hashes.tolist())}
+
+
+def _add_postings(postings: dict[str, Any], doc_id: str, stats: list[tuple[int, int, _Positions]]) -> None:
+    """
+    Appends chunks `(chunk_pos, length, term positions)` of `doc_id` to the index.
+    """
+    table: list[Any] = postings["chunks"]
+    terms: dict[int, list[list[Any]]] = postings["terms"]
+    slots: list[int] = postings["docs"].setdefault(doc_id, [])
+    for pos, length, positions in stats:
+        slot = len(table)
+        table.append([doc_id, pos, length])
+        slots.append(slot)
+        for h, blob in positions.items():
+            terms.setdefault(h, []).append([slot, len(blob) // 12, blob])
+        postings["totalLength"] += length
+        postings["liveChunks"] += 1
+
+
+def _index_document(postings: dict[str, Any], doc_id: str, chunks: list[dict[str, Any]]) -> None:
+    stats = [(pos, *_chunk_stats(str(ch.get("text") or ""))) for pos, ch in enumerate(chunks)]
+    _add_postings(postings, doc_id, stats)
+
+
+def _unindex_document(postings: dict[str, Any], doc_id: str, chunks: list[dict[str, Any]]) -> None:
+    slots = postings["docs"].pop(doc_id, None)
+    if slots:
+        _unindex_slots(postings, slots, [str(ch.get("text") or "") for ch in chunks])
+
+
+def _reindex_document(
+    postings: dict[str, Any],
+    doc_id: str,
+    old_chunks: list[dict[str, Any]],
+    kept: dict[int, int],
+    added: list[tuple[int, int, _Positions]],
+) -> None:
+    """
+    Applies a chunk-level diff: slots of kept chunks are renumbered in place (`kept` maps old
+    to new chunk position), dropped chunks are unindexed and `added` ones appended.
+    """
+    table: list[Any] = postings["chunks"]
+    live: list[int] = []
+    dead: list[int] = []
+    dead_texts: list[str] = []
+    for slot in postings["docs"].get(doc_id) or []:
+        entry = table[slot]
+        if entry is None:
+            continue
+        new_pos = kept.get(int(entry[1]))
+        if new_pos is None:
+            dead.append(slot)
+            if int(entry[1]) < len(old_chunks):
+                dead_texts.append(str(old_chunks[int(entry[1])].get("text") or ""))
+        else:
+            entry[1] = new_pos
+            live.append(slot)
+    _unindex_slots(postings, dead, dead_texts)
+    postings["docs"][doc_id] = live
+    _add_postings(postings, doc_id, added)
+
+
+def _unindex_slots(postings: dict[str, Any], slots: list[int], texts: list[str]) -> None:
+    if not slots:
+        return
+    dead = set(slots)
+    touched: set[int] = set()
+    for text in texts:
+        touched.update(rag_analyzer.get_analyzer().term_ids(text).tolist())
+    terms: dict[int, list[list[Any]]] = postings["terms"]
+    for h in touched:
+        plist = terms.get(h)
+        if not plist:
+            continue
+        kept = [p for p in plist if p[0] not in dead]
+        if kept:
+            terms[h] = kept
+        else:
+            del terms[h]
+    table: list[Any] = postings["chunks"]
+    for slot in slots:
+        entry = table[slot]
+        if entry is not None:
+            postings["totalLength"] -= int(entry[2])
+            postings["liveChunks"] -= 1
+            table[slot] = None
+
+
+def build_postings(user_id: str, manifest: dict[str, Any]) -> dict[str, Any]:
+    postings = _empty_postings(postings_generation(manifest))
+    for doc in _documents(manifest):
+        doc_id = str(doc.get("id") or "")
+        _index_document(postings, doc_id, load_chunks(user_id, doc_id, shard=shard_name(doc)))
+    return postings
+
+
+def _postings_arrays(postings: dict[str, Any]) -> dict[str, np.ndarray]:
+    doc_ids = list(postings["docs"])
+    ordinal = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+    table: list[Any] = postings["chunks"]
+    slot_doc = np.array([ordinal[e[0]] if e is not None else -1 for e in table], dtype=np.int32)
+    slot_pos = np.array([e[1] if e is not None else 0 for e in table], dtype=np.uint32)
+    slot_len = np.array([e[2] if e is not None else 0 for e in table], dtype=np.uint32)
+
+    hashes = sorted(postings["terms"])
+    plists = [postings["terms"][h] for h in hashes]
+    term_off = np.zeros(len(hashes) + 1, dtype=np.uint64)
+    if plists:
+        np.cumsum([len(pl) for pl in plists], out=term_off[1:])
+    flat = [p for pl in plists for p in pl]
+    post_tf = np.array([p[1] for p in flat], dtype=np.uint32)
+    post_pos_off = np.zeros(len(flat) + 1, dtype=np.uint64)
+    np.cumsum(post_tf, out=post_pos_off[1:])
+    doc_off, doc_blob = rag_binfile.pack_strings(doc_ids)
+    arrays = {
+        "term_hash": np.array(hashes, dtype=np.uint64),
+        "term_off": term_off,
+        "post_slot": np.array([p[0] for p in flat], dtype=np.uint32),
+        "post_tf": post_tf,
+        "post_pos_off": post_pos_off,
+        "post_pos": np.frombuffer(b"".join(p[2] for p in flat), dtype=np.uint32),
+        "slot_doc": slot_doc,
+        "slot_pos": slot_pos,
+        "slot_len": slot_len,
+        "doc_off": doc_off,
+        "doc_blob": doc_blob,
+        "stats": np.array([postings["totalLength"], postings["liveChunks"]], dtype=np.uint64),
+        "analyzer": np.frombuffer(postings["analyzer"].encode("utf-8"), dtype=np.uint8),
+    }
+    arrays["term_ub"] = _term_upper_bounds(arrays, postings["totalLength"], postings["liveChunks"])
+    return arrays
+
+
+def _postings_from_file(f: rag_binfile.ArrayFile) -> dict[str, Any]:
+    doc_ids = rag_binfile.unpack_strings(f["doc_off"], f["doc_blob"])
+    postings = _empty_postings(f.generation, _file_analyzer(f))
+    postings["docs"] = {doc_id: [] for doc_id in doc_ids}
+    table: list[Any] = postings["chunks"]
+    slot_rows = zip(f["slot_doc"].tolist(), f["slot_pos"].tolist(), f["slot_len"].tolist(), strict=True)
+    for slot, (d, pos, length) in enumerate(slot_rows):
+        if d < 0:
+            table.append(None)
+            continue
+        table.append([doc_ids[d], pos, length])
+        postings["docs"][doc_ids[d]].append(slot)
+    offs = f["term_off"].tolist()
+    slots = f["post_slot"].tolist()
+    tfs = f["post_tf"].tolist()
+    pos_off = [12 * o for o in f["post_pos_off"].tolist()]
+    raw = f["post_pos"].tobytes()
+    terms: dict[int, list[list[Any]]] = postings["terms"]
+    for i, h in enumerate(f["term_hash"].tolist()):
+        terms[h] = [[slots[p], tfs[p], raw[pos_off[p] : pos_off[p + 1]]] for p in range(offs[i], offs[i + 1])]
+    total_length, live = f["stats"].tolist()
+    postings["totalLength"] = total_length
+    postings["liveChunks"] = live
+    return postings
+
+
+# Rough CPython sizes of the decoded postings: a `[slot, tf, positions]` list with its ints and
+# bytes header, a chunk table row plus its `docs` entry, and a term's dict entry and list.
+_POSTING_BYTES = 150
+_SLOT_BYTES = 180
+_TERM_BYTES = 200
+
+
+def _postings_footprint(arrays: dict[str, np.ndarray] | rag_binfile.ArrayFile) -> int:
+    """
+    Estimated memory of the postings dict decoded from `arrays`, several times the file size.
+    """
+    return (
+        len(arrays["post_slot"]) * _POSTING_BYTES
+        + arrays["post_pos"].nbytes
+        + len(arrays["slot_doc"]) * _SLOT_BYTES
+        + len(arrays["term_hash"]) * _TERM_BYTES
+    )
+
+
+def _save_postings(user_id: str, postings: dict[str, Any]) -> None:
+    path = postings_path(user_id)
+    arrays = _postings_arrays(postings)
+    try:
+        rag_binfile.write_arrays(path, arrays, generation=postings["generation"])
+    except Exception as e:
+        _cache_drop(path)
+        raise _internal_error(e) from e
+    _cache_put(path, path.stat(), postings, charge=_postings_footprint(arrays))
+    (rag_dir(user_id) / "rag-postings.json").unlink(missing_ok=True)
+
+
+def _file_analyzer(f: rag_binfile.ArrayFile) -> str:
+    return f["analyzer"].tobytes().decode("utf-8") if "analyzer" in f.arrays else ""
+
+
+def _current_analyzer(signature: str) -> bool:
+    return signature == rag_analyzer.get_analyzer().signature
+
+
+def _usable(f: rag_binfile.ArrayFile, manifest: dict[str, Any]) -> bool:
+    # Files from older layouts lack `post_pos`/`term_ub` and are rebuilt like stale ones.
+    return (
+        f.generation == postings_generation(manifest)
+        and "post_pos" in f.arrays
+        and "term_ub" in f.arrays
+        and _current_analyzer(_file_analyzer(f))
+    )
+
+
+def _open_postings(user_id: str, manifest: dict[str, Any]) -> rag_binfile.ArrayFile:
+    """
+    The mmap'd postings file for `manifest`, rebuilt first if stale. Only the writer (or a
+    caller that owns the store, like tests and scripts) may call this; searches use `snapshot`.
+    """
+    path = postings_path(user_id)
+    f = rag_binfile.open_arrays(path)
+    if f is None or not _usable(f, manifest):
+        _save_postings(user_id, build_postings(user_id, manifest))
+        f = rag_binfile.open_arrays(path)
+        if f is None:
+            raise _internal_error(RuntimeError("Failed to open postings"))
+    return f
+
+
+def _load_postings(user_id: str, manifest: dict[str, Any]) -> dict[str, Any]:
+    """
+    Write path: the mutable postings for `manifest`.
+    """
+    path = postings_path(user_id)
+    try:
+        cached = _cache_get(path, path.stat())
+    except FileNotFoundError:
+        cached = None
+    if (
+        cached is not None
+        and cached["generation"] == postings_generation(manifest)
+        and _current_analyzer(cached["analyzer"])
+    ):
+        return cached
+    f = _open_postings(user_id, manifest)
+    postings = _postings_from_file(f)
+    _cache_put(path, path.stat(), postings, charge=_postings_footprint(f))
+    return postings
+
+
+def _dead_slots(f: rag_binfile.ArrayFile, manifest: dict[str, Any]) -> np.ndarray:
+    """
+    Mask of slots searches must skip: unindexed chunks and chunks of tombstoned documents.
+    """
+    tombstones = tuple(manifest.get("tombstones") or ())
+    key = ("dead", tombstones)
+    dead = f.memo.get(key)
+    if dead is None:
+        slot_doc = f["slot_doc"]
+        dead = slot_doc < 0
+        if tombstones:
+            gone = set(tombstones)
+            doc_ids = rag_binfile.unpack_strings(f["doc_off"], f["doc_blob"])
+            dead |= np.isin(slot_doc, [i for i, doc_id in enumerate(doc_ids) if doc_id in gone])
+        dead.flags.writeable = False
+        f.memo = {key: dead}
+    return dead
+
+
+def _dead_fraction(f: rag_binfile.ArrayFile, manifest: dict[str, Any]) -> float:
+    dead = _dead_slots(f, manifest)
+    return float(dead.mean()) if len(dead) else 0.0
+
+
+def _compact_dead_fraction() -> float:
+    raw = (os.environ.get("RAG_COMPACT_DEAD_FRACTION") or "").strip()
+    try:
+        return min(1.0, max(0.0, float(raw))) if raw else _DEFAULT_COMPACT_DEAD_FRACTION
+    except ValueError:
+        return _DEFAULT_COMPACT_DEAD_FRACTION
+
+
+def _compacted_arrays(f: rag_binfile.ArrayFile, dead: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    The postings arrays without the `dead` slots: surviving slots are renumbered in order, so
+    posting lists stay ascending and nothing is re-tokenized.
+    """
+    live = ~dead
+    renumber = np.cumsum(live, dtype=np.int64) - 1
+    post_slot = f["post_slot"]
+    post_live = live[post_slot]
+    post_tf = f["post_tf"][post_live]
+    post_pos = f["post_pos"].reshape(-1, 3)[np.repeat(post_live, f["post_tf"])]
+
+    seen = np.concatenate([[0], np.cumsum(post_live, dtype=np.int64)])
+    term_off = f["term_off"].astype(np.int64)
+    counts = seen[term_off[1:]] - seen[term_off[:-1]]
+    kept_terms = counts > 0
+    new_term_off = np.zeros(int(kept_terms.sum()) + 1, dtype=np.uint64)
+    np.cumsum(counts[kept_terms], out=new_term_off[1:])
+    post_pos_off = np.zeros(len(post_tf) + 1, dtype=np.uint64)
+    np.cumsum(post_tf, out=post_pos_off[1:])
+
+    used, slot_doc = np.unique(f["slot_doc"][live], return_inverse=True)
+    doc_ids = rag_binfile.unpack_strings(f["doc_off"], f["doc_blob"])
+    doc_off, doc_blob = rag_binfile.pack_strings([doc_ids[i] for i in used.tolist()])
+    slot_len = f["slot_len"][live]
+    total_length, n = int(slot_len.sum(dtype=np.uint64)), int(live.sum())
+    arrays = {
+        "term_hash": f["term_hash"][kept_terms],
+        "term_off": new_term_off,
+        "post_slot": renumber[post_slot[post_live]].astype(np.uint32),
+        "post_tf": post_tf,
+        "post_pos_off": post_pos_off,
+        "post_pos": post_pos.reshape(-1),
+        "slot_doc": slot_doc.astype(np.int32),
+        "slot_pos": f["slot_pos"][live],
+        "slot_len": slot_len,
+        "doc_off": doc_off,
+        "doc_blob": doc_blob,
+        "stats": np.array([total_length, n], dtype=np.uint64),
+        "analyzer": f["analyzer"],
+    }
+    arrays["term_ub"] = _term_upper_bounds(arrays, total_length, n)
+    return arrays
+
+
+def _term_index(f: rag_binfile.ArrayFile, h: int) -> int | None:
+    hashes = f["term_hash"]
+    i = int(np.searchsorted(hashes, np.uint64(h)))
+    if i >= len(hashes) or hashes[i] != h:
+        return None
+    return i
+
+
+def _slot_positions(f: rag_binfile.ArrayFile, term: int, slot: int) -> np.ndarray:
+    """
+    `(ordinal, start, end)` rows for term index `term` in chunk `slot` (empty if absent).
+    """
+    lo, hi = int(f["term_off"][term]), int(f["term_off"][term + 1])
+    slots = f["post_slot"][lo:hi]
+    p = int(np.searchsorted(slots, slot))
+    if p >= len(slots) or slots[p] != slot:
+        return np.zeros((0, 3), dtype=np.uint32)
+    a, b = int(f["post_pos_off"][lo + p]), int(f["post_pos_off"][lo + p + 1])
+    return f["post_pos"][3 * a : 3 * b].reshape(-1, 3)
+
+
+def _idf(n: int, df: int) -> float:
+    return math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+
+
+def _bm25(tf: np.ndarray, dl: np.ndarray, idf: Any, avgdl: float) -> np.ndarray:
+    # Shared by query-time scoring and the per-term upper bounds, so both round identically.
+    tf = tf.astype(np.float64)
+    return idf * tf * (BM25_K1 + 1.0) / (tf + BM25_K1 * (1.0 - BM25_B + BM25_B * dl / avgdl))
+
+
+def _corpus_stats(total_length: int, n: int) -> tuple[int, float]:
+    """
+    `(live chunks, average chunk length)`.
+    """
+    if n <= 0:
+        return n, 1.0
+    return n, (total_length / n) or 1.0
+
+
+def _term_upper_bounds(arrays: dict[str, np.ndarray], total_length: int, n: int) -> np.ndarray:
+    """
+    Per term, the largest score contribution any of its postings makes (for MaxScore).
+    """
+    term_off = arrays["term_off"]
+    if not len(arrays["post_slot"]):
+        return np.zeros(len(term_off) - 1, dtype=np.float64)
+    n, avgdl = _corpus_stats(total_length, n)
+    dfs = np.diff(term_off).astype(np.int64)
+    idf = np.repeat(np.array([_idf(n, int(df)) for df in dfs.tolist()]), dfs)
+    dl = arrays["slot_len"][arrays["post_slot"]]
+    scores = _bm25(arrays["post_tf"], dl, idf, avgdl)
+    return np.maximum.reduceat(scores, term_off[:-1].astype(np.int64))
+
+
+def _query_terms(f: rag_binfile.ArrayFile, terms: list[str]) -> list[int]:
+    """
+    Term indexes of the query terms present in the index, highest upper bound first. Every
+    scoring path adds contributions in this order, so their float sums agree bit for bit.
+    """
+    found = {i for i in (_term_index(f, rag_analyzer.term_hash(t)) for t in terms) if i is not None}
+    ub = f["term_ub"]
+    return sorted(found, key=lambda i: (-float(ub[i]), i))
+
+
+def _term_scores(f: rag_binfile.ArrayFile, term: int) -> tuple[np.ndarray, np.ndarray]:
+    n, avgdl = _corpus_stats(*(int(x) for x in f["stats"]))
+    lo, hi = int(f["term_off"][term]), int(f["term_off"][term + 1])
+    slots = f["post_slot"][lo:hi]
+    return slots, _bm25(f["post_tf"][lo:hi], f["slot_len"][slots], _idf(n, hi - lo), avgdl)
+
+
+def _memo_scores(
+    f: rag_binfile.ArrayFile, term: int, memo: dict[int, tuple[np.ndarray, np.ndarray]] | None
+) -> tuple[np.ndarray, np.ndarray]:
+    if memo is None:
+        return _term_scores(f, term)
+    if term not in memo:
+        memo[term] = _term_scores(f, term)
+    return memo[term]
+
+
+def bm25_scores(
+    f: rag_binfile.ArrayFile,
+    terms: list[str],
+    *,
+    memo: dict[int, tuple[np.ndarray, np.ndarray]] | None = None,
+    dead: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Scores every chunk that contains at least one query term; returns (slots, scores) with
+    slots ascending. Slots set in the `dead` mask are left out.
+
+    Work is proportional to the number of postings for the query terms, not the corpus size.
+    Pass the same `memo` for a batch of queries to score each distinct term only once.
+    """
+    parts = [_memo_scores(f, t, memo) for t in _query_terms(f, terms)]
+    if not parts or int(f["stats"][1]) <= 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float64)
+    if len(parts) == 1:
+        slots, scores = parts[0]
+    else:
+        slots, inverse = np.unique(np.concatenate([p[0] for p in parts]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([p[1] for p in parts]))
+    if dead is not None:
+        alive = ~dead[slots]
+        slots, scores = slots[alive], scores[alive]
+    return slots, scores
+
+
+# Relative slack on upper-bound comparisons so float rounding can never prune a true hit.
+_PRUNE_SLACK = 1.0 + 1e-9
+
+
+def _kth_largest(scores: np.ndarray, k: int) -> float:
+    return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+
+def bm25_top_k(
+    f: rag_binfile.ArrayFile,
+    terms: list[str],
+    k: int,
+    *,
+    memo: dict[int, tuple[np.ndarray, np.ndarray]] | None = None,
+    dead: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The `k` best (slots, scores) of `bm25_scores`, ordered by score then slot, with MaxScore
+    pruning.
+
+    Terms are taken highest upper bound first and their posting lists merged in full until the
+    bounds of the remaining terms add up to less than the current k-th best partial score. From
+    then on no unseen chunk can reach the top k, so the remaining (typically long, low-idf) lists
+    are only probed for surviving candidates, and candidates that can no longer catch up are
+    dropped before each probe. Scores are exactly those of `bm25_scores`. `dead` slots are
+    dropped as they are merged, so they never hold a place in the top k.
+    """
+    ordered = _query_terms(f, terms)
+    n, avgdl = _corpus_stats(*(int(x) for x in f["stats"]))
+    if not ordered or n <= 0 or k <= 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float64)
+    ub = f["term_ub"][ordered]
+    rest = np.cumsum(ub[::-1])[::-1] * _PRUNE_SLACK  # rest[j]: bound on terms j.. combined
+
+    cand = np.zeros(0, dtype=np.uint32)
+    scores = np.zeros(0, dtype=np.float64)
+    j = 0
+    while j < len(ordered):
+        if len(cand) >= k and rest[j] < _kth_largest(scores, k):
+            break
+        slots, s = _memo_scores(f, ordered[j], memo)
+        cand, inverse = np.unique(np.concatenate([cand, slots]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([scores, s]))
+        if dead is not None:
+            alive = ~dead[cand]
+            cand, scores = cand[alive], scores[alive]
+        j += 1
+
+    slot_len = f["slot_len"]
+    for jj in range(j, len(ordered)):
+        keep = scores + rest[jj] >= _kth_largest(scores, k)
+        cand, scores = cand[keep], scores[keep]
+        lo, hi = int(f["term_off"][ordered[jj]]), int(f["term_off"][ordered[jj] + 1])
+        plist = f["post_slot"][lo:hi]
+        p = np.searchsorted(plist, cand)
+        hit = p < len(plist)
+        hit[hit] = plist[p[hit]] == cand[hit]
+        tf = f["post_tf"][lo:hi][p[hit]]
+        scores[hit] += _bm25(tf, slot_len[cand[hit]], _idf(n, hi - lo), avgdl)
+
+    top = np.lexsort((cand, -scores))[:k]
+    return cand[top], scores[top]
+
+
+_EXCERPT_CHARS = 360
+
+
+def snippet(text: str, spans: list[tuple[int, int]]) -> tuple[str, list[list[int]]]:
+    """
+    Cuts an excerpt around the densest cluster of matched-term `spans` (sorted character
+    offsets into `text`). Returns it with the spans that fall inside, relative to the excerpt.
+    """
+    width = _EXCERPT_CHARS
+    if not spans:
+        return text[:width].strip(), []
+    best_i, best_n, j = 0, 1, 0
+    for i in range(len(spans)):
+        j = max(j, i)
+        while j < len(spans) and spans[j][1] - spans[i][0] <= width:
+            j += 1
+        if j - i > best_n:
+            best_i, best_n = i, j - i
+    lo, hi = spans[best_i][0], spans[best_i + best_n - 1][1]
+    start = max(0, min(lo - max(0, width - (hi - lo)) // 2, len(text) - width))
+    raw = text[start : start + width]
+    lead = len(raw) - len(raw.lstrip())
+    out = raw.strip()
+    base = start + lead
+    highlights = [[a - base, b - base] for a, b in spans if a >= base and b <= base + len(out)]
+    return out, highlights
+
+
+def excerpt(text: str, query: str, *, analyzer: rag_analyzer.Analyzer | None = None) -> tuple[str, list[list[int]]]:
+    """
+    `snippet` for backends without stored positions: finds the query terms in `text` with the
+    (per-chunk cached) analyzer output.
+    """
+    analyzer = analyzer or rag_analyzer.get_analyzer()
+    wanted = np.array([rag_analyzer.term_hash(t) for t in analyzer.terms(query)], dtype=np.uint64)
+    a = analyzer.analyze(text)
+    mask = np.isin(a.ids, wanted)
+    return snippet(text, list(zip(a.start[mask].tolist(), a.end[mask].tolist(), strict=True)))
+
+
+def _phrase(analyzer: rag_analyzer.Analyzer, text: str) -> list[tuple[int, int]]:
+    """
+    A quoted phrase as `(term hash, token offset from its first term)` pairs.
+    """
+    a = analyzer.analyze(text)
+    if not len(a.ids):
+        return []
+    return list(zip(a.ids.tolist(), (a.pos - a.pos[0]).tolist(), strict=True))
+
+
+def _has_phrase(f: rag_binfile.ArrayFile, slot: int, phrase: list[tuple[int, int]]) -> bool:
+    anchors: np.ndarray | None = None
+    for h, offset in phrase:
+        term = _term_index(f, h)
+        if term is None:
+            return False
+        ordinals = _slot_positions(f, term, slot)[:, 0].astype(np.int64) - offset
+        anchors = ordinals if anchors is None else anchors[np.isin(anchors, ordinals)]
+        if not len(anchors):
+            return False
+    return True
+
+
+# Single writer
+#
+# Every change to a user's JSON store runs on that user's writer thread: callers enqueue an op
+# and wait for its result. The thread takes everything queued so far, applies the ops in order
+# to one copy of the manifest and postings, and saves each file once for the whole batch (group
+# commit). Exclusive ops (compaction, rebuilds) run in a batch of their own. An advisory lock
+# file serializes writers of different processes; each batch starts from what is on disk.
+
+
+class _WriteState:
+    """
+    What the ops of one batch mutate. Postings are loaded on first use; `after` callbacks run
+    once the batch is saved (vector rows, removing files of deleted documents).
+    """
+
+    def __init__(self, user_id: str) -> None:
+        self.user_id = user_id
+        # `load_manifest` hands out the cached object that readers share.
+        self.manifest = copy.deepcopy(load_manifest(user_id))
+        self.after: list[Callable[[], None]] = []
+        self.dirty = False
+        self._postings: dict[str, Any] | None = None
+        self._base_generation = manifest_generation(self.manifest)
+        self._vectors: list[tuple[PendingVectors, str, list[int], dict[int, int] | None]] = []
+        self._vectors_exact = True
+
+    @property
+    def postings(self) -> dict[str, Any]:
+        if self._postings is None:
+            self._postings = _load_postings(self.user_id, self.manifest)
+        return self._postings
+
+    def bump(self) -> int:
+        gen = manifest_generation(self.manifest) + 1
+        self.manifest["generation"] = gen
+        self.dirty = True
+        return gen
+
+    def save(self) -> None:
+        if self._postings is not None:
+            gen = postings_generation(self.manifest) + 1
+            self._postings["generation"] = gen
+            self.manifest["postingsGeneration"] = gen
+            _save_postings(self.user_id, self._postings)
+        if self.dirty or self._postings is not None:
+            save_manifest(self.user_id, self.manifest)
+
+    def discard(self) -> None:
+        if self._postings is not None:
+            # Partially applied ops mutated the cached dict in place.
+            _cache_drop(postings_path(self.user_id))
+
+    def add_vectors(
+        self,
+        pending: PendingVectors,
+        doc_id: str,
+        *,
+        positions: list[int],
+        keep: dict[int, int] | None,
+        exact: bool = True,
+    ) -> None:
+        """
+        Queues a document's embedded chunks; all of a batch's rows are saved in one rewrite.
+        `exact=False` marks rows that may not match the chunks (forces a later re-sync).
+        """
+        if not self._vectors:
+            self.after.append(self._save_vectors)
+        self._vectors.append((pending, doc_id, positions, keep))
+        self._vectors_exact = self._vectors_exact and exact
+
+    def _save_vectors(self) -> None:
+        from app import rag_vectors  # rag_vectors imports this module
+
+        gen = manifest_generation(self.manifest) if self._vectors_exact else 0
+        rag_vectors.commit_many(self.user_id, self._vectors, generation=gen, previous=self._base_generation)
+
+
+_STORE_LOCK_HELD = threading.local()
+
+
+@contextmanager
+def _store_lock(user_id: str) -> Iterator[None]:
+    """
+    Cross-process lock on one user's store. Re-entrant within a thread: the writer loads the
+    manifest while holding it, and that load may have to migrate a legacy index.
+    """
+    held: set[str] = _STORE_LOCK_HELD.__dict__.setdefault("users", set())
+    if user_id in held:
+        yield
+        return
+    with (rag_dir(user_id) / ".writer.lock").open("a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        held.add(user_id)
+        try:
+            yield
+        finally:
+            held.discard(user_id)
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class _Op:
+    __slots__ = ("fn", "exclusive", "future")
+
+    def __init__(self, fn: Callable[[_WriteState], Any], exclusive: bool) -> None:
+        self.fn = fn
+        self.exclusive = exclusive
+        self.future: Future[Any] = Future()
+
+
+class _UserWriter:
+    def __init__(self, user_id: str) -> None:
+        self.user_id = user_id
+        self._lock = threading.Lock()
+        self._queue: deque[_Op] = deque()
+        self._thread: threading.Thread | None = None
+        self._compacting = False
+
+    def submit(self, fn: Callable[[_WriteState], Any], *, exclusive: bool = False) -> Future[Any]:
+        return self.submit_many([fn], exclusive=exclusive)[0]
+
+    def submit_many(self, fns: list[Callable[[_WriteState], Any]], *, exclusive: bool = False) -> list[Future[Any]]:
+        """
+        Queues `fns` back to back, so non-exclusive ones are applied in the same batch.
+        """
+        ops = [_Op(fn, exclusive) for fn in fns]
+        with self._lock:
+            self._queue.extend(ops)
+            if self._thread is None:
+                # Started on demand; exits once the queue is drained.
+                self._thread = threading.Thread(target=self._run, name=f"rag-writer-{self.user_id}", daemon=True)
+                self._thread.start()
+        return [op.future for op in ops]
+
+    def _next_batch(self) -> list[_Op]:
+        with self._lock:
+            batch: list[_Op] = []
+            while self._queue:
+                if batch and (batch[0].exclusive or self._queue[0].exclusive):
+                    break
+                batch.append(self._queue.popleft())
+            if not batch:
+                self._thread = None
+            return batch
+
+    def _run(self) -> None:
+        while batch := self._next_batch():
+            outcomes = _apply_batch(self.user_id, batch)
+            # Queued before anyone is released, so `flush()` also waits for the compaction.
+            self._maybe_compact()
+            _resolve(batch, outcomes)
+
+    def _maybe_compact(self) -> None:
+        if self._compacting:
+            return
+        try:
+            manifest = load_manifest(self.user_id)
+        except HTTPException:
+            return
+        f = rag_binfile.open_arrays(postings_path(self.user_id))
+        if f is None or not _usable(f, manifest) or _dead_fraction(f, manifest) <= _compact_dead_fraction():
+            return
+        self._compacting = True
+        self.submit(_compact, exclusive=True).add_done_callback(self._compacted)
+
+    def _compacted(self, _future: Future[Any]) -> None:
+        self._compacting = False
+
+
+_Outcome = tuple[Any, BaseException | None]
+
+
+def _apply_batch(user_id: str, batch: list[_Op]) -> list[_Outcome]:
+    outcomes: list[_Outcome] = []
+    try:
+        with _store_lock(user_id):
+            state = _WriteState(user_id)
+            _IN_WRITER.state = state
+            try:
+                for op in batch:
+                    try:
+                        outcomes.append((op.fn(state), None))
+                    except Exception as e:
+                        outcomes.append((None, e))
+                state.save()
+            except BaseException:
+                state.discard()
+                raise
+            finally:
+                _IN_WRITER.state = None
+            for fn in state.after:
+                try:
+                    fn()
+                except Exception:
+                    # Derived data (vector rows) is re-synced by the next read that notices.
+                    pass
+    except Exception as e:
+        return [(None, e)] * len(batch)
+    return outcomes
+
+
+def _resolve(batch: list[_Op], outcomes: list[_Outcome]) -> None:
+    for op, (value, error) in zip(batch, outcomes, strict=True):
+        if error is not None:
+            op.future.set_exception(error)
+        else:
+            op.future.set_result(value)
+
+
+_IN_WRITER = threading.local()
+_WRITERS_LOCK = threading.Lock()
+_WRITERS: dict[str, _UserWriter] = {}
+
+
+def _writer(user_id: str) -> _UserWriter:
+    with _WRITERS_LOCK:
+        writer = _WRITERS.get(user_id)
+        if writer is None:
+            writer = _WRITERS[user_id] = _UserWriter(user_id)
+        return writer
+
+
+def _write(user_id: str, fn: Callable[[_WriteState], Any], *, exclusive: bool = False) -> Any:
+    """
+    Runs `fn` on the user's writer and returns its result (or raises its exception).
+    """
+    return _write_many(user_id, [fn], exclusive=exclusive)[0]
+
+
+def _write_many(user_id: str, fns: list[Callable[[_WriteState], Any]], *, exclusive: bool = False) -> list[Any]:
+    """
+    Like `_write` for several ops applied in one batch; raises the first failure after all ran.
+    """
+    state = getattr(_IN_WRITER, "state", None)
+    if state is not None and state.user_id == user_id:
+        # Called from inside an op: queueing behind ourselves would deadlock, so join the batch.
+        return [fn(state) for fn in fns]
+    futures = _writer(user_id).submit_many(fns, exclusive=exclusive)
+    errors = [e for e in (f.exception() for f in futures) if e is not None]
+    if errors:
+        raise errors[0]
+    return [f.result() for f in futures]
+
+
+def flush(user_id: str) -> None:
+    """
+    Waits until every write queued for `user_id` so far, including a compaction it triggered,
+    has finished.
+    """
+    _write(user_id, lambda _state: None, exclusive=True)
+
+
+def _ensure_postings(state: _WriteState) -> None:
+    _open_postings(state.user_id, state.manifest)
+
+
+def _compact(state: _WriteState) -> None:
+    manifest = state.manifest
+    f = _open_postings(state.user_id, manifest)
+    gen = postings_generation(manifest) + 1
+    path = postings_path(state.user_id)
+    try:
+        rag_binfile.write_arrays(path, _compacted_arrays(f, _dead_slots(f, manifest)), generation=gen)
+    except Exception as e:
+        raise _internal_error(e) from e
+    finally:
+        _cache_drop(path)
+    manifest["postingsGeneration"] = gen
+    manifest["tombstones"] = []
+    state.dirty = True
+
+
+def snapshot(user_id: str) -> tuple[dict[str, Any], rag_binfile.ArrayFile]:
+    """
+    Read path: a manifest and the postings file that matches it. A stale file is rebuilt by the
+    writer rather than by the reader.
+    """
+    for _attempt in range(3):
+        manifest = load_manifest(user_id)
+        f = rag_binfile.open_arrays(postings_path(user_id))
+        if f is not None and _usable(f, manifest):
+            return manifest, f
+        _write(user_id, _ensure_postings, exclusive=True)
+    raise _internal_error(RuntimeError("Failed to open postings"))
+
+
+# Public API used by `/api/rag/*` and indexing jobs.
+
+
+def list_documents(user_id: str) -> list[dict[str, Any]]:
+    out = []
+    for d in _documents(load_manifest(user_id)):
+        out.append(
+            {
+                "id": d.get("id"),
+                "name": d.get("name"),
+                "createdAt": d.get("createdAt"),
+                "bytes": d.get("bytes"),
+                "chunks": int(d.get("chunks") or 0),
+                "source": d.get("source"),
+                "collection": d.get("collection"),
+            }
+        )
+    return out
+
+
+_CLAIMS_LOCK = threading.Lock()
+_CLAIMS: set[tuple[str, str, str | None]] = set()
+
+
+def claim_writer(user_id: str, source: str, collection: str | None = None) -> None:
+    """
+    Reserves the document `(source, collection)` identifies for one open writer until it commits
+    or aborts; a second writer for the same document gets a 409 instead of racing the first
+    one's files.
+    """
+    with _CLAIMS_LOCK:
+        if (user_id, source, collection) in _CLAIMS:
+            raise HTTPException(
+                status_code=409, detail={"code": "conflict", "message": "Document is already being written"}
+            )
+        _CLAIMS.add((user_id, source, collection))
+
+
+def release_writer(user_id: str, source: str, collection: str | None = None) -> None:
+    with _CLAIMS_LOCK:
+        _CLAIMS.discard((user_id, source, collection))
+
+
+def find_by_source(manifest: dict[str, Any], source: str, collection: str | None = None) -> dict[str, Any] | None:
+    """
+    The document a write of `source` into `collection` re-ingests. Both must match: the same URL
+    can be a crawled page in one collection and a standalone document (e.g. a GitHub repo).
+    """
+    for d in reversed(_documents(manifest)):
+        if d.get("source") == source and (d.get("collection") or None) == collection:
+            return d
+    return None
+
+
+class PreparedDocument(NamedTuple):
+    """
+    A document chunked (and optionally analyzed) ahead of the write, e.g. in a worker process.
+    `stats` holds `_chunk_stats` per chunk, computed with the analyzer `analyzer` names.
+    """
+
+    name: str
+    text: str
+    chunks: list[str]
+    source: str | None = None
+    stats: list[tuple[int, _Positions]] | None = None
+    analyzer: str = ""
+    collection: str | None = None
+
+
+def prepare_document(
+    name: str,
+    text: str,
+    *,
+    source: str | None = None,
+    collection: str | None = None,
+    analyze: bool = True,
+    stemming: bool | None = None,
+) -> PreparedDocument:
+    """
+    Chunks `text` exactly like a streamed write would and, with `analyze`, precomputes each
+    chunk's postings. Pure CPU work with picklable results, so it can run in another process.
+    """
+    chunker = StreamChunker()
+    chunks = [*chunker.feed(text), *chunker.finish()]
+    if not analyze:
+        return PreparedDocument(name, text, chunks, source, collection=collection)
+    analyzer = rag_analyzer.get_analyzer(stemming=stemming)
+    stats = [_chunk_stats(chunk, analyzer) for chunk in chunks]
+    return PreparedDocument(name, text, chunks, source, stats, analyzer.signature, collection)
+
+
+class DocumentWriter:
+    """
+    Streams one document into the store.
+
+    Text pieces go to a temp copy of the document's text file (segment-compressed with
+    `RAG_STORAGE_COMPRESSION`) and are chunked incrementally; chunks go straight into a temp
+    shard, keeping only per-chunk term counts in memory. The manifest and postings are updated
+    once, on `commit()` (or together with other documents through `commit_documents`);
+    `abort()` discards everything written so far.
+
+    When `source` and `collection` match an existing document, it is re-ingested in place: chunk
+    ids are content hashes, so only chunks whose id is new are tokenized/embedded and only the
+    dropped ones are unindexed. `collection` groups documents that belong together (the pages of
+    one web crawl).
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        *,
+        name: str,
+        source: str | None = None,
+        collection: str | None = None,
+        vectors: PendingVectors | None = None,
+    ) -> None:
+        self.user_id = user_id
+        self.name = name
+        self.source = source
+        self.collection = collection
+        self._claim = (source, collection) if source else None
+        if source:
+            claim_writer(user_id, source, collection)
+        try:
+            existing = find_by_source(load_manifest(user_id), source, collection) if source else None
+            self.doc_id = str(existing["id"]) if existing else str(uuid.uuid4())
+            self.replaces = existing is not None
+            self.chunks = 0
+            self._vectors = vectors
+            self._ids = ChunkIds(self.doc_id)
+            self._old_pos: dict[str, int] = {}
+            if existing:
+                self._old_pos = {str(c.get("id") or ""): pos for pos, c in enumerate(load_chunks(user_id, self.doc_id))}
+            self._kept: dict[int, int] = {}
+            self._added: list[tuple[int, int, _Positions]] = []
+            self._chunker = StreamChunker()
+            self._had_text = False
+            self._codec = storage_compression()
+            # Characters written so far, and where the current chunker's input starts.
+            self._chars = 0
+            self._section = 0
+            self._doc_path = rag_dir(user_id) / _text_file_name(self.doc_id, self._codec is not None)
+            self._text_tmp = temp_path(self._doc_path)
+            self._shard_path = shard_path(user_id, self.doc_id, f"{self.doc_id}-{uuid.uuid4().hex[:8]}.json")
+            self._shard_tmp = temp_path(self._shard_path)
+            self._text: TextIO | rag_segments.SegmentWriter
+            if self._codec:
+                self._text = rag_segments.SegmentWriter(self._text_tmp, self._codec)
+            else:
+                self._text = self._text_tmp.open("w", encoding="utf-8")
+            self._shard = self._shard_tmp.open("w", encoding="utf-8")
+            self._shard.write(f'{{"text":{json.dumps(self._doc_path.name)},"chunks":[' if self._codec else "[")
+        except BaseException:
+            self._release()
+            raise
+
+    @property
+    def has_text(self) -> bool:
+        return self._had_text or self._chunker.started
+
+    def write(self, piece: str) -> None:
+        if not piece:
+            return
+        self._text.write(piece)
+        self._chars += len(piece)
+        self._emit(self._chunker.feed_spans(piece))
+
+    def end_section(self) -> None:
+        """
+        Closes the current chunk window so the next piece starts a fresh one. Writing each
+        page/file as its own section keeps its chunks (and ids) stable when neighbours change.
+        """
+        self._emit(self._chunker.finish_spans())
+        self._had_text = self.has_text
+        self._chunker = StreamChunker()
+        self._section = self._chars
+
+    def write_prepared(self, doc: PreparedDocument) -> None:
+        """
+        Writes a whole `prepare_document` result into a fresh writer. Precomputed postings are
+        used when they come from the current analyzer.
+        """
+        self._text.write(doc.text)
+        stats = doc.stats if doc.analyzer == rag_analyzer.get_analyzer().signature else None
+        starts = _locate(doc.text, doc.chunks) if self._codec else [-1] * len(doc.chunks)
+        # Offsets are relative to the current section, which begins where this text does.
+        self._section = self._chars
+        self._chars += len(doc.text)
+        self._emit(zip(starts, doc.chunks, strict=True), stats)
+        self._section = self._chars
+        self._had_text = self._had_text or bool(doc.chunks)
+
+    def _emit(self, spans: Iterable[tuple[int, str]], stats: list[tuple[int, _Positions]] | None = None) -> None:
+        """
+        Stores chunks given as (offset in the current section or -1, text).
+        """
+        for i, (start, chunk) in enumerate(spans):
+            chunk_id = self._ids(chunk)
+            if self.chunks:
+                self._shard.write(",")
+            entry = _shard_entry(chunk_id, chunk, self._section + start if start >= 0 else -1, bool(self._codec))
+            self._shard.write(json.dumps(entry, ensure_ascii=False))
+            old = self._old_pos.get(chunk_id)
+            if old is not None:
+                self._kept[old] = self.chunks
+            else:
+                self._added.append((self.chunks, *(stats[i] if stats is not None else _chunk_stats(chunk))))
+                if self._vectors is not None:
+                    self._vectors.add(chunk)
+            self.chunks += 1
+
+    def close(self) -> None:
+        """
+        Finishes the temp files and releases their handles; the document stays invisible until
+        committed. Lets a caller stage many documents without holding two files open for each.
+        """
+        if self._shard.closed:
+            return
+        try:
+            self._emit(self._chunker.finish_spans())
+            self._shard.write("]}\n" if self._codec else "]\n")
+            self._text.close()
+            self._shard.close()
+        except Exception as e:
+            self.abort()
+            raise _internal_error(e) from e
+
+    def _publish(self) -> list[dict[str, Any]]:
+        """
+        Moves the finished files into place; returns the chunks they replace.
+        """
+        old_chunks = load_chunks(self.user_id, self.doc_id) if self.replaces else []
+        self.close()
+        try:
+            # Text first: a published shard may point into it. The shard has a name of its own and
+            # stays invisible until `_apply` points the manifest at it.
+            self._text_tmp.replace(self._doc_path)
+            self._shard_tmp.replace(self._shard_path)
+        except Exception as e:
+            self.abort()
+            raise _internal_error(e) from e
+        return old_chunks
+
+    def commit(self) -> dict[str, Any]:
+        return commit_documents([self])[0]
+
+    def _apply(self, old_chunks: list[dict[str, Any]], state: _WriteState) -> dict[str, Any]:
+        manifest = state.manifest
+        postings = state.postings
+        state.bump()
+        vanished = False
+        entry = next((d for d in _documents(manifest) if str(d.get("id") or "") == self.doc_id), None)
+        if entry is None:
+            entry = {"id": self.doc_id, "createdAt": _now_iso(), "path": self._doc_path.name}
+            manifest["documents"].append(entry)
+            if self.replaces:
+                # Deleted while we were writing: index the new shard from scratch.
+                _unindex_document(postings, self.doc_id, old_chunks)
+                _index_document(
+                    postings, self.doc_id, load_chunks(self.user_id, self.doc_id, shard=self._shard_path.name)
+                )
+                tombstones = manifest.get("tombstones") or []
+                manifest["tombstones"] = [t for t in tombstones if t != self.doc_id]
+                self._kept = {}
+                vanished = True
+            else:
+                _add_postings(postings, self.doc_id, self._added)
+        else:
+            entry["updatedAt"] = _now_iso()
+            _reindex_document(postings, self.doc_id, old_chunks, self._kept, self._added)
+            if entry.get("path") != self._doc_path.name:
+                # Compressed text has a new name per write, or the storage mode changed.
+                state.after.append(functools.partial(_remove_text_file, self.user_id, entry.get("path")))
+                entry["path"] = self._doc_path.name
+            state.after.append(functools.partial(_remove_shard, self.user_id, self.doc_id, shard_name(entry)))
+        entry["shard"] = self._shard_path.name
+        entry["name"] = self.name
+        entry["bytes"] = (
+            self._text.bytes if isinstance(self._text, rag_segments.SegmentWriter) else self._doc_path.stat().st_size
+        )
+        entry["chunks"] = self.chunks
+        if self.source:
+            entry["source"] = self.source
+        if self.collection:
+            entry["collection"] = self.collection
+
+        if self._vectors is not None:
+            state.add_vectors(
+                self._vectors,
+                self.doc_id,
+                positions=[pos for pos, _length, _tfs in self._added],
+                keep=self._kept if self.replaces else None,
+                exact=not vanished,
+            )
+        removed = len(old_chunks) - len(self._kept)
+        return {"id": self.doc_id, "chunks": self.chunks, "added": len(self._added), "removed": removed}
+
+    def _release(self) -> None:
+        if self._claim:
+            release_writer(self.user_id, *self._claim)
+            self._claim = None
+
+    def abort(self) -> None:
+        self._release()
+        for f in (self._text, self._shard):
+            try:
+                f.close()
+            except Exception:
+                pass
+        paths = [self._text_tmp, self._shard_tmp, self._shard_path]
+        if not self.replaces:
+            paths.append(self._doc_path)
+        elif self._codec:
+            # Never referenced unless the shard was published too.
+            paths.append(self._doc_path)
+        for path in paths:
+            try:
+                path.unlink(missing_ok=True)
+            except Exception:
+                pass
+
+
+def commit_documents(writers: list[DocumentWriter]) -> list[dict[str, Any]]:
+    """
+    Commits one user's documents as a single writer batch: the manifest and postings are saved
+    once for all of them. Returns each writer's `commit()` result, in order.
+    """
+    if not writers:
+        return []
+    ops = []
+    try:
+        try:
+            for writer in writers:
+                ops.append(functools.partial(writer._apply, writer._publish()))
+        except BaseException:
+            # The failing writer aborted itself; the ones after it never published.
+            for writer in writers[len(ops) + 1 :]:
+                writer.abort()
+            # Files already moved into place must still be indexed.
+            if ops:
+                _write_many(writers[0].user_id, ops)
+            raise
+        return _write_many(writers[0].user_id, ops)
+    finally:
+        # Only once the manifest lists the documents may another writer look them up by source.
+        for writer in writers:
+            writer._release()
+
+
+def add_document(
+    user_id: str, *, name: str, text: str, source: str | None = None, collection: str | None = None
+) -> dict[str, Any]:
+    writer = DocumentWriter(user_id, name=name, source=source, collection=collection)
+    try:
+        writer.write(text)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def add_documents(
+    user_id: str,
+    docs: Iterable[PreparedDocument],
+    *,
+    vectors: Callable[[], PendingVectors] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Stages every document in `docs` (temp files only), then commits them in one batch.
+    """
+    writers: list[DocumentWriter] = []
+    try:
+        for doc in docs:
+            writer = DocumentWriter(
+                user_id,
+                name=doc.name,
+                source=doc.source,
+                collection=doc.collection,
+                vectors=vectors() if vectors else None,
+            )
+            writers.append(writer)
+            writer.write_prepared(doc)
+            writer.close()
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    return commit_documents(writers)
+
+
+def delete_document(user_id: str, doc_id: str) -> dict[str, Any]:
+    """
+    Removes `doc_id` from the manifest and tombstones its postings; the postings file is not
+    rewritten (see "Inverted index" above).
+    """
+    return _write(user_id, functools.partial(_delete, doc_id))
+
+
+def _delete(doc_id: str, state: _WriteState) -> dict[str, Any]:
+    manifest = state.manifest
+    docs = manifest["documents"]
+    before = len(docs)
+    removed = next((d for d in docs if isinstance(d, dict) and str(d.get("id") or "") == doc_id), None)
+    if removed is None:
+        return {"deleted": 0, "before": before, "after": before, "generation": manifest_generation(manifest)}
+
+    gen = state.bump()
+    manifest["documents"] = [d for d in docs if d is not removed]
+    manifest.setdefault("tombstones", []).append(doc_id)
+    state.after.append(
+        functools.partial(_remove_document_files, state.user_id, doc_id, removed.get("path"), shard_name(removed))
+    )
+    return {"deleted": 1, "before": before, "after": before - 1, "generation": gen}
+
+
+def _remove_document_files(user_id: str, doc_id: str, path: Any, shard: str) -> None:
+    _remove_shard(user_id, doc_id, shard)
+    _remove_text_file(user_id, path)
+
+
+def _remove_shard(user_id: str, doc_id: str, name: str) -> None:
+    path = shard_path(user_id, doc_id, name)
+    _cache_drop(path)
+    try:
+        path.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def _remove_text_file(user_id: str, path: Any) -> None:
+    try:
+        if isinstance(path, str) and path:
+            (rag_dir(user_id) / path).unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def restore(
+    user_id: str,
+    documents: list[dict[str, Any]],
+    *,
+    tombstones: list[str],
+    postings: Path | None = None,
+    after: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Publishes an exported corpus into an empty store (409 otherwise). The documents' shards and
+    text files must already be in place. `postings` is an unpublished postings file that matches
+    them; it is used if the current analyzer built it, else the postings are rebuilt on first
+    search. `after` gets the new store generation once the manifest is saved.
+    """
+
+    def _restore(state: _WriteState) -> int:
+        if _documents(state.manifest):
+            raise HTTPException(status_code=409, detail={"code": "conflict", "message": "RAG store is not empty"})
+        gen = state.bump()
+        state.manifest["documents"] = documents
+        state.manifest["tombstones"] = tombstones
+        # A generation no existing postings file has, so anything but the import counts as stale.
+        postings_gen = postings_generation(state.manifest) + 1
+        state.manifest["postingsGeneration"] = postings_gen
+        f = rag_binfile.open_arrays(postings, cache=False) if postings is not None else None
+        if f is not None and "post_pos" in f.arrays and "term_ub" in f.arrays and _current_analyzer(_file_analyzer(f)):
+            try:
+                rag_binfile.set_generation(postings, postings_gen)
+                postings.replace(postings_path(state.user_id))
+            except Exception as e:
+                raise _internal_error(e) from e
+            finally:
+                _cache_drop(postings_path(state.user_id))
+        if after is not None:
+            state.after.append(functools.partial(after, gen))
+        return gen
+
+    return _write(user_id, _restore, exclusive=True)
+
+
+def search(user_id: str, query: str, *, limit: int = 8) -> list[dict[str, Any]]:
+    return search_many(user_id, [(query, limit)])[0]
+
+
+def search_many(user_id: str, queries: list[tuple[str, int]]) -> list[list[dict[str, Any]]]:
+    """
+    Answers `(query, limit)` pairs against one manifest/postings snapshot; posting lists shared
+    by several queries are scored once.
+    """
+    manifest, f = snapshot(user_id)
+    dead = _dead_slots(f, manifest)
+    by_id = {str(d.get("id") or ""): d for d in _documents(manifest)}
+    analyzer = rag_analyzer.get_analyzer()
+    memo: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+    out: list[list[dict[str, Any]]] = []
+    for query, limit in queries:
+        terms = analyzer.terms(query)
+        if not terms or limit <= 0:
+            out.append([])
+            continue
+        phrases = [ph for ph in (_phrase(analyzer, p) for p in rag_analyzer.phrases(query)) if ph]
+        if phrases:
+            # Phrases filter the BM25 ranking: walk it best-first until `limit` chunks match.
+            slots, scores = bm25_scores(f, terms, memo=memo, dead=dead)
+            picked: list[int] = []
+            for i in np.argsort(-scores, kind="stable").tolist():
+                if all(_has_phrase(f, int(slots[i]), ph) for ph in phrases):
+                    picked.append(i)
+                    if len(picked) >= limit:
+                        break
+            top = np.array(picked, dtype=np.int64)
+            slots, scores = slots[top], scores[top]
+        else:
+            slots, scores = bm25_top_k(f, terms, int(limit), memo=memo, dead=dead)
+        out.append(_results(user_id, f, by_id, terms, slots, scores))
+    return out
+
+
+def _results(
+    user_id: str,
+    f: rag_binfile.ArrayFile,
+    by_id: dict[str, dict[str, Any]],
+    terms: list[str],
+    slots: np.ndarray,
+    scores: np.ndarray,
+) -> list[dict[str, Any]]:
+    term_ids = [i for i in (_term_index(f, rag_analyzer.term_hash(t)) for t in dict.fromkeys(terms)) if i is not None]
+    results = []
+    for slot, score in zip(slots.tolist(), scores.tolist(), strict=True):
+        if f["slot_doc"][slot] < 0:
+            continue
+        doc_id = rag_binfile.unpack_string(f["doc_off"], f["doc_blob"], int(f["slot_doc"][slot]))
+        pos = int(f["slot_pos"][slot])
+        doc = by_id.get(doc_id)
+        ch = load_chunk(user_id, doc_id, pos, shard=shard_name(doc)) if doc else None
+        if ch is None:
+            continue
+        spans = sorted((int(a), int(b)) for t in term_ids for _o, a, b in _slot_positions(f, t, slot).tolist())
+        text, highlights = snippet(str(ch.get("text") or ""), spans)
+        results.append(
+            {
+                "score": round(float(score), 4),
+                "document": {"id": doc_id, "name": str(doc.get("name") or "")},
+                "chunkId": ch.get("id"),
+                "excerpt": text,
+                "highlights": highlights,
+            }
+        )
+    return results
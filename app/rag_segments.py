@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import lzma
+import struct
+import zlib
+from collections.abc import Iterator
+from pathlib import Path
+
+# Compressed document text (`RAG_STORAGE_COMPRESSION=zlib|lzma`).
+#
+# The text is cut into segments of `SEGMENT_CHARS` characters, each compressed on its own, so a
+# chunk's text (stored as a character range) is read by decompressing only the one or two
+# segments under it. Written front to back while a document streams in:
+#   header:   4s magic "RAGZ" | u8 codec | 3x pad | u32 segment chars
+#   data:     each segment's compressed UTF-8
+#   index:    u64[count + 1] file offsets of the segments (and the end of the last one)
+#   footer:   u64 chars | u64 utf-8 bytes | u32 count | 4s magic "RAGZ"
+
+SEGMENT_CHARS = 32 * 1024
+CODECS = {"zlib": 1, "lzma": 2}
+
+_MAGIC = b"RAGZ"
+_HEADER = struct.Struct("<4sB3xI")
+_FOOTER = struct.Struct("<QQI4s")
+
+
+def _compress(codec: int, data: bytes) -> bytes:
+    return lzma.compress(data) if codec == CODECS["lzma"] else zlib.compress(data, 6)
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    return lzma.decompress(data) if codec == CODECS["lzma"] else zlib.decompress(data)
+
+
+class SegmentWriter:
+    """
+    File-like sink for `DocumentWriter`: `write(str)` pieces, then `close()`.
+    """
+
+    def __init__(self, path: Path, codec: str) -> None:
+        self.codec = CODECS[codec]
+        self.chars = 0
+        self.bytes = 0
+        self.closed = False
+        self._buf = ""
+        self._offsets = [_HEADER.size]
+        self._f = path.open("wb")
+        self._f.write(_HEADER.pack(_MAGIC, self.codec, SEGMENT_CHARS))
+
+    def _segment(self, text: str) -> None:
+        raw = text.encode("utf-8")
+        self.bytes += len(raw)
+        data = _compress(self.codec, raw)
+        self._f.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def write(self, piece: str) -> None:
+        self.chars += len(piece)
+        buf = self._buf + piece
+        i = 0
+        while len(buf) - i >= SEGMENT_CHARS:
+            self._segment(buf[i : i + SEGMENT_CHARS])
+            i += SEGMENT_CHARS
+        self._buf = buf[i:]
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buf:
+                self._segment(self._buf)
+                self._buf = ""
+            count = len(self._offsets) - 1
+            self._f.write(struct.pack(f"<{count + 1}Q", *self._offsets))
+            self._f.write(_FOOTER.pack(self.chars, self.bytes, count, _MAGIC))
+        finally:
+            self._f.close()
+
+
+class SegmentFile:
+    """
+    Read access to a segment file; open per use (`with SegmentFile(path) as f`).
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._f = path.open("rb")
+        try:
+            magic, self.codec, self.segment_chars = _HEADER.unpack(self._f.read(_HEADER.size))
+            self._f.seek(-_FOOTER.size, 2)
+            self.chars, self.bytes, count, end_magic = _FOOTER.unpack(self._f.read(_FOOTER.size))
+            if magic != _MAGIC or end_magic != _MAGIC or self.codec not in CODECS.values():
+                raise ValueError(f"Not a segment file: {path.name}")
+            self._f.seek(-_FOOTER.size - 8 * (count + 1), 2)
+            self._offsets = struct.unpack(f"<{count + 1}Q", self._f.read(8 * (count + 1)))
+        except BaseException:
+            self._f.close()
+            raise
+
+    def __enter__(self) -> SegmentFile:
+        return self
+
+    def __exit__(self, *_exc: object) -> None:
+        self._f.close()
+
+    def segment(self, k: int) -> bytes:
+        """
+        Segment `k`'s text as UTF-8.
+        """
+        self._f.seek(self._offsets[k])
+        return _decompress(self.codec, self._f.read(self._offsets[k + 1] - self._offsets[k]))
+
+    def segments(self) -> Iterator[bytes]:
+        for k in range(len(self._offsets) - 1):
+            yield self.segment(k)
+
+    def text(self, start: int = 0, end: int | None = None) -> str:
+        """
+        Characters `[start, end)` of the text, decompressing only the segments they fall in.
+        """
+        end = self.chars if end is None else min(end, self.chars)
+        if start >= end:
+            return ""
+        first, last = start // self.segment_chars, (end - 1) // self.segment_chars
+        text = "".join(self.segment(k).decode("utf-8") for k in range(first, last + 1))
+        base = first * self.segment_chars
+        return text[start - base : end - base]
@@ -0,0 +1,473 @@
+from __future__ import annotations
+
+import itertools
+import json
+import sqlite3
+import threading
+import uuid
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import closing
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from fastapi import HTTPException
+
+from app import rag_analyzer, rag_index
+
+if TYPE_CHECKING:
+    from app.rag_vectors import PendingVectors
+
+# Optional RAG backend (`RAG_BACKEND=sqlite`): one SQLite database per user in WAL mode.
+# Chunks are mirrored into an external-content FTS5 table by triggers, so appends/deletes are
+# transactional and ranking (FTS5 `bm25()`) happens inside the engine. The schema is created once
+# per database and process, so read paths never take the write lock.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    path TEXT,
+    source TEXT,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    collection TEXT
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    doc_id TEXT NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    pos INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks(doc_id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+    text, content='chunks', content_rowid='rowid', tokenize='unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+"""
+
+
+def _now_iso() -> str:
+    return datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def db_path(user_id: str) -> Path:
+    return rag_index.rag_dir(user_id) / "rag.sqlite3"
+
+
+_READY_LOCK = threading.Lock()
+_READY: set[Path] = set()
+
+
+def _internal_error(e: Exception) -> HTTPException:
+    return HTTPException(status_code=500, detail={"code": "internal_error", "message": str(e)})
+
+
+def _init_db(user_id: str, path: Path) -> None:
+    fresh = not path.exists()
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        # Databases created before documents had a collection.
+        if "collection" not in {r[1] for r in conn.execute("PRAGMA table_info(documents)")}:
+            conn.execute("ALTER TABLE documents ADD COLUMN collection TEXT")
+        if fresh:
+            _import_json_corpus(user_id, conn)
+
+
+def _connect(user_id: str) -> sqlite3.Connection:
+    path = db_path(user_id)
+    try:
+        if path not in _READY or not path.exists():
+            with _READY_LOCK:
+                if path not in _READY or not path.exists():
+                    _init_db(user_id, path)
+                    _READY.add(path)
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+    except sqlite3.Error as e:
+        raise _internal_error(e) from e
+    return conn
+
+
+def _import_json_corpus(user_id: str, conn: sqlite3.Connection) -> None:
+    """
+    Seeds a new database from the JSON store so switching backends keeps existing documents.
+    """
+    manifest = rag_index.load_manifest(user_id)
+    with conn:
+        for d in manifest["documents"]:
+            if not isinstance(d, dict) or not d.get("id"):
+                continue
+            doc_id = str(d["id"])
+            chunks = rag_index.load_chunks(user_id, doc_id)
+            _insert_document(conn, d, chunks)
+        if manifest["documents"]:
+            _bump_generation(conn)
+
+
+def _insert_document(conn: sqlite3.Connection, entry: dict[str, Any], chunks: list[dict[str, Any]]) -> None:
+    doc_id = str(entry["id"])
+    conn.execute(
+        "INSERT INTO documents (id, name, created_at, bytes, path, source, chunks, collection) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            doc_id,
+            str(entry.get("name") or ""),
+            str(entry.get("createdAt") or _now_iso()),
+            int(entry.get("bytes") or 0),
+            entry.get("path"),
+            entry.get("source"),
+            len(chunks),
+            entry.get("collection"),
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO chunks (id, doc_id, pos, text) VALUES (?, ?, ?, ?)",
+        [(str(c.get("id") or uuid.uuid4()), doc_id, pos, str(c.get("text") or "")) for pos, c in enumerate(chunks)],
+    )
+
+
+def _bump_generation(conn: sqlite3.Connection) -> int:
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+    return int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+
+
+def generation(user_id: str) -> int:
+    with closing(_connect(user_id)) as conn:
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+
+
+def list_documents(user_id: str) -> list[dict[str, Any]]:
+    with closing(_connect(user_id)) as conn:
+        rows = conn.execute(
+            "SELECT id, name, created_at, bytes, chunks, source, collection FROM documents ORDER BY rowid"
+        ).fetchall()
+    return [
+        {"id": r[0], "name": r[1], "createdAt": r[2], "bytes": r[3], "chunks": r[4], "source": r[5], "collection": r[6]}
+        for r in rows
+    ]
+
+
+class DocumentWriter:
+    """
+    Streams one document into the database. Chunks are staged in a temp file as the chunker
+    emits them and written in one short transaction on `commit()`, so an upload in progress
+    never holds the write lock; nothing is visible until then.
+
+    A document whose `source` and `collection` match an existing one is re-ingested in place: chunks whose
+    content-hash id already exists only get their position updated, new ones are inserted and
+    the rest deleted on commit.
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        *,
+        name: str,
+        source: str | None = None,
+        collection: str | None = None,
+        vectors: PendingVectors | None = None,
+    ) -> None:
+        self.user_id = user_id
+        self.name = name
+        self.source = source
+        self.collection = collection
+        self.chunks = 0
+        self._vectors = vectors
+        self._claim = (source, collection) if source else None
+        if source:
+            rag_index.claim_writer(user_id, source, collection)
+        try:
+            existing = None
+            self._old_pos: dict[str, int] = {}
+            with closing(_connect(user_id)) as conn:
+                if source:
+                    existing = conn.execute(
+                        "SELECT id FROM documents WHERE source = ? AND collection IS ? ORDER BY rowid DESC LIMIT 1",
+                        (source, collection),
+                    ).fetchone()
+                if existing:
+                    rows = conn.execute("SELECT id, pos FROM chunks WHERE doc_id = ?", (existing[0],)).fetchall()
+                    self._old_pos = {r[0]: r[1] for r in rows}
+            self.doc_id = str(existing[0]) if existing else str(uuid.uuid4())
+            self.replaces = existing is not None
+            self._kept: dict[int, int] = {}
+            self._added: list[int] = []
+            self._ids = rag_index.ChunkIds(self.doc_id)
+            self._chunker = rag_index.StreamChunker()
+            self._had_text = False
+            self._doc_path = rag_index.rag_dir(user_id) / f"{self.doc_id}.txt"
+            self._text_tmp = rag_index.temp_path(self._doc_path)
+            self._staged_path = rag_index.temp_path(rag_index.rag_dir(user_id) / f"{self.doc_id}.chunks")
+            self._text = self._text_tmp.open("w", encoding="utf-8")
+            # One JSON line per chunk: [id, pos, text], text null for chunks kept from before.
+            self._staged = self._staged_path.open("w", encoding="utf-8")
+        except sqlite3.Error as e:
+            self.abort()
+            raise _internal_error(e) from e
+        except BaseException:
+            self.abort()
+            raise
+
+    @property
+    def has_text(self) -> bool:
+        return self._had_text or self._chunker.started
+
+    def write(self, piece: str) -> None:
+        if not piece:
+            return
+        self._text.write(piece)
+        self._emit(self._chunker.feed(piece))
+
+    def end_section(self) -> None:
+        """
+        Closes the current chunk window so the next piece starts a fresh one (see
+        `rag_index.DocumentWriter.end_section`).
+        """
+        self._emit(self._chunker.finish())
+        self._had_text = self.has_text
+        self._chunker = rag_index.StreamChunker()
+
+    def write_prepared(self, doc: rag_index.PreparedDocument) -> None:
+        """
+        Writes a whole `rag_index.prepare_document` result into a fresh writer (FTS5 does its
+        own tokenizing, so precomputed postings are ignored).
+        """
+        self._text.write(doc.text)
+        self._emit(doc.chunks)
+        self._had_text = self._had_text or bool(doc.chunks)
+
+    def _emit(self, chunks: Iterable[str]) -> None:
+        for chunk in chunks:
+            chunk_id = self._ids(chunk)
+            old = self._old_pos.pop(chunk_id, None)
+            if old is not None:
+                self._kept[old] = self.chunks
+                self._staged.write(json.dumps([chunk_id, self.chunks, None]) + "\n")
+            else:
+                self._staged.write(json.dumps([chunk_id, self.chunks, chunk], ensure_ascii=False) + "\n")
+                self._added.append(self.chunks)
+                if self._vectors is not None:
+                    self._vectors.add(chunk)
+            self.chunks += 1
+
+    def _staged_rows(self) -> Iterator[list[Any]]:
+        with self._staged_path.open(encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _store(self, conn: sqlite3.Connection) -> int:
+        if self.replaces:
+            cur = conn.execute(
+                "UPDATE documents SET name = ? WHERE id = ?",
+                (self.name, self.doc_id),
+            )
+            if cur.rowcount == 0:
+                raise HTTPException(
+                    status_code=409,
+                    detail={"code": "conflict", "message": "Document was deleted while it was being written"},
+                )
+        else:
+            conn.execute(
+                "INSERT INTO documents (id, name, created_at, bytes, path, source, chunks, collection) "
+                "VALUES (?, ?, ?, 0, ?, ?, 0, ?)",
+                (self.doc_id, self.name, _now_iso(), self._doc_path.name, self.source or None, self.collection),
+            )
+        rows = self._staged_rows()
+        while batch := list(itertools.islice(rows, 512)):
+            conn.executemany(
+                "UPDATE chunks SET pos = ? WHERE id = ?", [(pos, cid) for cid, pos, text in batch if text is None]
+            )
+            conn.executemany(
+                "INSERT INTO chunks (id, doc_id, pos, text) VALUES (?, ?, ?, ?)",
+                [(cid, self.doc_id, pos, text) for cid, pos, text in batch if text is not None],
+            )
+        conn.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in self._old_pos])
+        conn.execute(
+            "UPDATE documents SET bytes = ?, chunks = ? WHERE id = ?",
+            (self._doc_path.stat().st_size, self.chunks, self.doc_id),
+        )
+        return _bump_generation(conn)
+
+    def commit(self) -> dict[str, Any]:
+        try:
+            self._emit(self._chunker.finish())
+            self._text.close()
+            self._staged.close()
+            with closing(_connect(self.user_id)) as conn:
+                with conn:
+                    # Text first: the committed row points at it.
+                    self._text_tmp.replace(self._doc_path)
+                    gen = self._store(conn)
+        except HTTPException:
+            self.abort()
+            raise
+        except Exception as e:
+            self.abort()
+            raise _internal_error(e) from e
+        self._staged_path.unlink(missing_ok=True)
+        self._release()
+        removed = len(self._old_pos)
+        if self._vectors is not None:
+            self._vectors.commit(
+                self.user_id,
+                self.doc_id,
+                generation=gen,
+                positions=self._added,
+                keep=self._kept if self.replaces else None,
+            )
+        return {"id": self.doc_id, "chunks": self.chunks, "added": len(self._added), "removed": removed}
+
+    def _release(self) -> None:
+        if self._claim:
+            rag_index.release_writer(self.user_id, *self._claim)
+            self._claim = None
+
+    def abort(self) -> None:
+        self._release()
+        for name in ("_text", "_staged"):
+            try:
+                getattr(self, name).close()
+            except Exception:
+                pass
+        paths = ["_text_tmp", "_staged_path"]
+        if not getattr(self, "replaces", True):
+            paths.append("_doc_path")
+        for name in paths:
+            try:
+                getattr(self, name).unlink(missing_ok=True)
+            except Exception:
+                pass
+
+
+def add_document(
+    user_id: str, *, name: str, text: str, source: str | None = None, collection: str | None = None
+) -> dict[str, Any]:
+    writer = DocumentWriter(user_id, name=name, source=source, collection=collection)
+    try:
+        writer.write(text)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def add_documents(
+    user_id: str,
+    docs: Iterable[rag_index.PreparedDocument],
+    *,
+    vectors: Callable[[], PendingVectors] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Stores prepared documents one short transaction each; SQLite updates are incremental anyway.
+    """
+    results = []
+    for doc in docs:
+        writer = DocumentWriter(
+            user_id,
+            name=doc.name,
+            source=doc.source,
+            collection=doc.collection,
+            vectors=vectors() if vectors else None,
+        )
+        try:
+            writer.write_prepared(doc)
+        except BaseException:
+            writer.abort()
+            raise
+        results.append(writer.commit())
+    return results
+
+
+def load_chunks(user_id: str, doc_id: str) -> list[dict[str, Any]]:
+    with closing(_connect(user_id)) as conn:
+        rows = conn.execute("SELECT id, text FROM chunks WHERE doc_id = ? ORDER BY pos", (doc_id,)).fetchall()
+    return [{"id": r[0], "text": r[1]} for r in rows]
+
+
+def load_chunk(user_id: str, doc_id: str, pos: int) -> dict[str, Any] | None:
+    with closing(_connect(user_id)) as conn:
+        row = conn.execute("SELECT id, text FROM chunks WHERE doc_id = ? AND pos = ?", (doc_id, pos)).fetchone()
+    return {"id": row[0], "text": row[1]} if row else None
+
+
+def delete_document(user_id: str, doc_id: str) -> dict[str, Any]:
+    with closing(_connect(user_id)) as conn, conn:
+        before = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        row = conn.execute("SELECT path FROM documents WHERE id = ?", (doc_id,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+            gen = _bump_generation(conn)
+        else:
+            gen = int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+        after = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    if row is not None and isinstance(row[0], str) and row[0]:
+        try:
+            (rag_index.rag_dir(user_id) / row[0]).unlink(missing_ok=True)
+        except Exception:
+            pass
+    return {"deleted": 1 if row is not None else 0, "before": before, "after": after, "generation": gen}
+
+
+_SEARCH_SQL = """
+SELECT c.id, c.doc_id, d.name, c.text, bm25(chunks_fts) AS rank
+FROM chunks_fts
+JOIN chunks c ON c.rowid = chunks_fts.rowid
+JOIN documents d ON d.id = c.doc_id
+WHERE chunks_fts MATCH ?
+ORDER BY rank
+LIMIT ?
+"""
+
+
+def search(user_id: str, query: str, *, limit: int = 8) -> list[dict[str, Any]]:
+    return search_many(user_id, [(query, limit)])[0]
+
+
+def search_many(user_id: str, queries: list[tuple[str, int]]) -> list[list[dict[str, Any]]]:
+    """
+    Answers `(query, limit)` pairs over one connection and one read snapshot.
+    """
+    # FTS5 indexes unstemmed unicode61 tokens, so only drop stopwords here.
+    analyzer = rag_analyzer.get_analyzer(stemming=False)
+    out: list[list[dict[str, Any]]] = []
+    with closing(_connect(user_id)) as conn, conn:
+        conn.execute("BEGIN")
+        for query, limit in queries:
+            terms = analyzer.terms(query)
+            if not terms:
+                out.append([])
+                continue
+            # Quote every term so user input can't inject FTS5 query syntax; OR matches the JSON
+            # backend and quoted phrases must all match.
+            match = " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+            phrases = [" ".join(rag_analyzer.tokenize(p)) for p in rag_analyzer.phrases(query)]
+            if phrases:
+                match = " AND ".join([*(f'"{p}"' for p in phrases), f"({match})"])
+            rows = conn.execute(_SEARCH_SQL, (match, int(limit))).fetchall()
+            results = []
+            for chunk_id, doc_id, doc_name, text, rank in rows:
+                excerpt, highlights = rag_index.excerpt(str(text or ""), query, analyzer=analyzer)
+                results.append(
+                    {
+                        "score": round(-float(rank), 4),
+                        "document": {"id": doc_id, "name": str(doc_name or "")},
+                        "chunkId": chunk_id,
+                        "excerpt": excerpt,
+                        "highlights": highlights,
+                    }
+                )
+            out.append(results)
+    return out
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Any, Protocol
+
+from app import rag_analyzer, rag_index, rag_sqlite, rag_vectors
+
+# Entry point for RAG storage. `RAG_BACKEND` selects the implementation:
+# - `json` (default): manifest + chunk shards + inverted index files (`app/rag_index.py`)
+# - `sqlite`: per-user SQLite database with FTS5 (`app/rag_sqlite.py`)
+#
+# Embeddings for vector search (`app/rag_vectors.py`) are kept alongside either backend.
+
+SEARCH_MODES = ("keyword", "vector", "hybrid")
+
+_DEFAULT_SEARCH_CACHE_SIZE = 512
+_DEFAULT_SEARCH_CACHE_TTL_SEC = 300.0
+_DEFAULT_HYBRID_CANDIDATES = 50
+# Reciprocal rank fusion constant (Cormack et al.): damps the weight of the very first ranks.
+_RRF_K = 60
+
+
+class DocumentWriter(Protocol):
+    doc_id: str
+    chunks: int
+
+    @property
+    def has_text(self) -> bool: ...
+
+    def write(self, piece: str) -> None: ...
+
+    def end_section(self) -> None: ...
+
+    def write_prepared(self, doc: rag_index.PreparedDocument) -> None: ...
+
+    def commit(self) -> dict[str, Any]: ...
+
+    def abort(self) -> None: ...
+
+
+_BACKENDS: dict[str, ModuleType] = {"json": rag_index, "sqlite": rag_sqlite}
+
+
+def rag_backend() -> str:
+    name = (os.environ.get("RAG_BACKEND") or "").strip().lower()
+    return name if name in _BACKENDS else "json"
+
+
+def _backend() -> ModuleType:
+    return _BACKENDS[rag_backend()]
+
+
+def tokenize(text: str) -> list[str]:
+    return rag_index.tokenize(text)
+
+
+def list_documents(user_id: str) -> list[dict[str, Any]]:
+    return _backend().list_documents(user_id)
+
+
+def begin_document(
+    user_id: str, *, name: str, source: str | None = None, collection: str | None = None
+) -> DocumentWriter:
+    """
+    Starts a streamed document write; call `write()` per text piece, then `commit()` or `abort()`.
+    """
+    return _backend().DocumentWriter(
+        user_id, name=name, source=source, collection=collection, vectors=rag_vectors.PendingVectors()
+    )
+
+
+def add_document(
+    user_id: str, *, name: str, text: str, source: str | None = None, collection: str | None = None
+) -> dict[str, Any]:
+    writer = begin_document(user_id, name=name, source=source, collection=collection)
+    try:
+        writer.write(text)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def add_documents(user_id: str, docs: Iterable[rag_index.PreparedDocument]) -> list[dict[str, Any]]:
+    """
+    Stores many prepared documents (see `rag_index.prepare_document`); the JSON backend commits
+    them in a single write.
+    """
+    return _backend().add_documents(user_id, docs, vectors=rag_vectors.PendingVectors)
+
+
+def load_chunks(user_id: str, doc_id: str) -> list[dict[str, Any]]:
+    return _backend().load_chunks(user_id, doc_id)
+
+
+def delete_document(user_id: str, doc_id: str) -> dict[str, Any]:
+    result = _backend().delete_document(user_id, doc_id)
+    if result.get("deleted"):
+        rag_vectors.delete_document(user_id, doc_id, generation=result["generation"])
+    return result
+
+
+def generation(user_id: str) -> int:
+    return _backend().generation(user_id)
+
+
+def _vector_search_many(user_id: str, queries: list[tuple[str, int]]) -> list[list[dict[str, Any]]]:
+    backend = _backend()
+    docs = backend.list_documents(user_id)
+    names = {str(d.get("id") or ""): str(d.get("name") or "") for d in docs}
+
+    def load_texts(doc_id: str) -> list[str]:
+        return [str(c.get("text") or "") for c in backend.load_chunks(user_id, doc_id)]
+
+    gen = backend.generation(user_id)
+    if rag_vectors.generation(user_id) != gen:
+        counts = {str(d.get("id") or ""): int(d.get("chunks") or 0) for d in docs}
+        rag_vectors.sync(user_id, counts, load_texts, generation=gen)
+    out = []
+    for (query, _limit), hits in zip(queries, rag_vectors.search_many(user_id, queries), strict=True):
+        results = []
+        for doc_id, pos, score in hits:
+            ch = backend.load_chunk(user_id, doc_id, pos) if doc_id in names else None
+            if ch is None:
+                continue
+            excerpt, highlights = rag_index.excerpt(str(ch.get("text") or ""), query)
+            results.append(
+                {
+                    "score": round(score, 4),
+                    "document": {"id": doc_id, "name": names[doc_id]},
+                    "chunkId": ch.get("id"),
+                    "excerpt": excerpt,
+                    "highlights": highlights,
+                }
+            )
+        out.append(results)
+    return out
+
+
+# Hybrid search
+#
+# Keyword and vector retrieval run concurrently, each returning a bounded candidate list
+# (`RAG_HYBRID_CANDIDATES` per query, at least the requested limit), and are fused with
+# reciprocal rank fusion: score = sum over retrievers of 1 / (_RRF_K + rank). Rank-based fusion
+# needs no calibration between BM25 and cosine scores.
+
+_HYBRID_POOL_LOCK = threading.Lock()
+_HYBRID_POOL: ThreadPoolExecutor | None = None
+
+
+def _hybrid_pool() -> ThreadPoolExecutor:
+    global _HYBRID_POOL
+    with _HYBRID_POOL_LOCK:
+        if _HYBRID_POOL is None:
+            _HYBRID_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-hybrid")
+        return _HYBRID_POOL
+
+
+def _hybrid_candidates(limit: int) -> int:
+    return max(int(limit), int(_env_number("RAG_HYBRID_CANDIDATES", _DEFAULT_HYBRID_CANDIDATES)))
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000.0, 2)
+
+
+def _timed(fn: Callable[..., Any], *args: Any) -> tuple[Any, float]:
+    start = time.perf_counter()
+    return fn(*args), _elapsed_ms(start)
+
+
+def _rrf(limit: int, ranked: dict[str, list[dict[str, Any]]]) -> list[dict[str, Any]]:
+    fused: dict[Any, dict[str, Any]] = {}
+    for retriever, results in ranked.items():
+        for rank, r in enumerate(results, start=1):
+            key = (r["document"]["id"], r["chunkId"])
+            hit = fused.get(key)
+            if hit is None:
+                # Keyword results come first, so their term highlights win over vector ones.
+                hit = fused[key] = {**r, "score": 0.0, "ranks": {}}
+            hit["score"] += 1.0 / (_RRF_K + rank)
+            hit["ranks"][retriever] = rank
+    out = sorted(fused.values(), key=lambda h: -h["score"])[:limit]
+    for hit in out:
+        hit["score"] = round(hit["score"], 6)
+    return out
+
+
+def _hybrid_search_many(
+    user_id: str, queries: list[tuple[str, int]], timings: dict[str, float] | None
+) -> list[list[dict[str, Any]]]:
+    # Keyword search runs on the pool while the vector half runs on the calling thread, which then
+    # waits for both: never call this (or `search`) from the event loop, use `asyncio.to_thread`.
+    pending = [(query, _hybrid_candidates(limit)) for query, limit in queries]
+    keyword = _hybrid_pool().submit(_timed, _backend().search_many, user_id, pending)
+    vector, vector_ms = _timed(_vector_search_many, user_id, pending)
+    lexical, keyword_ms = keyword.result()
+    start = time.perf_counter()
+    out = [
+        _rrf(int(limit), {"keyword": k, "vector": v})
+        for (_query, limit), k, v in zip(queries, lexical, vector, strict=True)
+    ]
+    if timings is not None:
+        timings.update({"keywordMs": keyword_ms, "vectorMs": vector_ms, "fusionMs": _elapsed_ms(start)})
+    return out
+
+
+# Search result cache
+#
+# Process-wide LRU with a TTL, keyed by (user, backend, mode, store generation, analyzer
+# signature, embedder, normalized query terms, limit): changing `RAG_STEMMING`, the stopwords
+# or `RAG_EMBEDDER` misses the cache right away. Every write path (uploads, deletes, indexing
+# jobs) bumps the generation, so entries for an older corpus are simply never hit again and age
+# out. Cached result lists are shared between callers and must not be mutated.
+
+_SEARCH_CACHE_LOCK = threading.Lock()
+_SEARCH_CACHE: OrderedDict[tuple[Any, ...], tuple[float, list[dict[str, Any]]]] = OrderedDict()
+
+
+def _env_number(name: str, default: float) -> float:
+    raw = (os.environ.get(name) or "").strip()
+    try:
+        return max(0.0, float(raw)) if raw else default
+    except ValueError:
+        return default
+
+
+def _search_cache_size() -> int:
+    return int(_env_number("RAG_SEARCH_CACHE_SIZE", _DEFAULT_SEARCH_CACHE_SIZE))
+
+
+def _search_cache_ttl() -> float:
+    return _env_number("RAG_SEARCH_CACHE_TTL_SEC", _DEFAULT_SEARCH_CACHE_TTL_SEC)
+
+
+def clear_search_cache() -> None:
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE.clear()
+
+
+def _search_cache_get(key: tuple[Any, ...]) -> list[dict[str, Any]] | None:
+    now = time.monotonic()
+    with _SEARCH_CACHE_LOCK:
+        hit = _SEARCH_CACHE.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= now:
+            del _SEARCH_CACHE[key]
+            return None
+        _SEARCH_CACHE.move_to_end(key)
+        return hit[1]
+
+
+def _search_cache_put(key: tuple[Any, ...], results: list[dict[str, Any]]) -> None:
+    size, ttl = _search_cache_size(), _search_cache_ttl()
+    if size <= 0 or ttl <= 0:
+        return
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE[key] = (time.monotonic() + ttl, results)
+        _SEARCH_CACHE.move_to_end(key)
+        while len(_SEARCH_CACHE) > size:
+            _SEARCH_CACHE.popitem(last=False)
+
+
+def _phrase_key(query: str) -> tuple[tuple[str, ...], ...]:
+    return tuple(tuple(tokenize(p)) for p in rag_analyzer.phrases(query))
+
+
+def search(
+    user_id: str,
+    query: str,
+    *,
+    limit: int = 8,
+    mode: str = "keyword",
+    timings: dict[str, float] | None = None,
+) -> list[dict[str, Any]]:
+    return search_many(user_id, [(query, limit)], mode=mode, timings=timings)[0]
+
+
+def search_many(
+    user_id: str,
+    queries: list[tuple[str, int]],
+    *,
+    mode: str = "keyword",
+    timings: dict[str, float] | None = None,
+) -> list[list[dict[str, Any]]]:
+    """
+    Runs several `(query, limit)` searches against one snapshot of the index; results are
+    returned in the same order as `queries`. Repeated searches are served from the cache.
+
+    For `mode="hybrid"`, per-stage durations of the retrievers that actually ran (nothing on a
+    full cache hit) are added to `timings`.
+    """
+    prefix = (
+        user_id,
+        rag_backend(),
+        mode,
+        generation(user_id),
+        rag_analyzer.get_analyzer().signature,
+        rag_vectors.embedder_key() if mode != "keyword" else None,
+    )
+    keys = [(*prefix, tuple(tokenize(query)), _phrase_key(query), int(limit)) for query, limit in queries]
+    out = [_search_cache_get(key) for key in keys]
+    misses = [i for i, hit in enumerate(out) if hit is None]
+    if misses:
+        pending = [queries[i] for i in misses]
+        if mode == "vector":
+            found = _vector_search_many(user_id, pending)
+        elif mode == "hybrid":
+            found = _hybrid_search_many(user_id, pending, timings)
+        else:
+            found = _backend().search_many(user_id, pending)
+        for i, results in zip(misses, found, strict=True):
+            _search_cache_put(keys[i], results)
+            out[i] = results
+    return [results or [] for results in out]
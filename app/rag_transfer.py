@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import itertools
+import json
+import os
+import re
+import struct
+import uuid
+import zlib
+from collections.abc import Iterable, Iterator
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from fastapi import HTTPException
+
+from app import rag_analyzer, rag_binfile, rag_index, rag_store, rag_vectors
+
+# Portable export of one user's RAG corpus (`GET /api/rag/export`, `POST /api/rag/import`).
+#
+# Layout: 4s magic "RAGX" | u16 format version | u16 codec (1 = zlib), followed by a single
+# compressed stream of records, each u8 kind | u32 payload length | payload:
+#   H  JSON header: backend, analyzer signature, store generation, tombstones, document count
+#   P  piece of the prebuilt postings file (JSON backend, `rag_binfile` layout)
+#   V  piece of the embeddings file
+#   D  JSON document entry (id, name, createdAt, source, collection); its T and C records follow
+#   T  piece of the document's text (UTF-8)
+#   C  chunk: u16 id length | id | text
+#   E  JSON trailer: counts, and whether the store changed while it was being read
+# Payloads are split into pieces of at most 1 MiB, so neither side holds more than one document
+# plus a piece in memory.
+#
+# Importing into an empty JSON store restores the corpus as exported: document ids are kept and
+# the prebuilt postings/embeddings are installed when the analyzer/embedder still match (else
+# they are rebuilt on first search). Any other import adds the documents like a bulk upload.
+
+_MAGIC = b"RAGX"
+_FORMAT = 1
+_CODEC_ZLIB = 1
+_PREAMBLE = struct.Struct("<4sHH")
+_RECORD = struct.Struct("<cI")
+_CHUNK_ID = struct.Struct("<H")
+_PIECE = 1024 * 1024
+_MAX_RECORD = 16 * 1024 * 1024
+_DEFAULT_MAX_IMPORT_BYTES = 1024 * 1024 * 1024
+_DOC_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# (entry, text, [(chunk id, chunk text), ...]) of one imported document.
+_Document = tuple[dict[str, Any], bytes, list[tuple[str, str]]]
+
+
+def _now_iso() -> str:
+    return datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _max_import_bytes() -> int:
+    raw = (os.environ.get("RAG_IMPORT_MAX_BYTES") or "").strip()
+    try:
+        return max(1, int(raw)) if raw else _DEFAULT_MAX_IMPORT_BYTES
+    except ValueError:
+        return _DEFAULT_MAX_IMPORT_BYTES
+
+
+def _invalid(message: str) -> HTTPException:
+    return HTTPException(status_code=400, detail={"code": "invalid_request", "message": message})
+
+
+def _json_bytes(data: dict[str, Any]) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# Export
+
+
+def export_stream(user_id: str) -> Iterator[bytes]:
+    """
+    Takes the snapshot to export (errors surface here, before any byte is sent) and returns an
+    iterator over the compressed container.
+    """
+    postings: rag_binfile.ArrayFile | None = None
+    tombstones: list[str] = []
+    analyzer = ""
+    if rag_store.rag_backend() == "json":
+        manifest, postings = rag_index.snapshot(user_id)
+        gen = rag_index.manifest_generation(manifest)
+        tombstones = [str(t) for t in manifest.get("tombstones") or []]
+        analyzer = rag_analyzer.get_analyzer().signature
+    else:
+        gen = rag_store.generation(user_id)
+    vectors = rag_vectors.snapshot(user_id)
+    if vectors is not None and vectors.generation != gen:
+        # Rows that lag the store would be wrong after a restore; let the importer re-embed.
+        vectors = None
+    docs = rag_store.list_documents(user_id)
+    header = {
+        "format": _FORMAT,
+        "backend": rag_store.rag_backend(),
+        "analyzer": analyzer,
+        "generation": gen,
+        "tombstones": tombstones,
+        "documents": len(docs),
+        "exportedAt": _now_iso(),
+    }
+    return _export(user_id, header, docs, postings, vectors)
+
+
+def _export(
+    user_id: str,
+    header: dict[str, Any],
+    docs: list[dict[str, Any]],
+    postings: rag_binfile.ArrayFile | None,
+    vectors: rag_binfile.ArrayFile | None,
+) -> Iterator[bytes]:
+    z = zlib.compressobj(6)
+
+    def record(kind: bytes, payload: bytes | memoryview) -> bytes:
+        return z.compress(_RECORD.pack(kind, len(payload))) + z.compress(payload)
+
+    yield _PREAMBLE.pack(_MAGIC, _FORMAT, _CODEC_ZLIB)
+    yield record(b"H", _json_bytes(header))
+    for kind, f in ((b"P", postings), (b"V", vectors)):
+        if f is None:
+            continue
+        raw = f.raw()
+        for i in range(0, len(raw), _PIECE):
+            out = record(kind, raw[i : i + _PIECE])
+            if out:
+                yield out
+
+    chunks = 0
+    for d in docs:
+        doc_id = str(d.get("id") or "")
+        entry = {
+            "id": doc_id,
+            "name": d.get("name"),
+            "createdAt": d.get("createdAt"),
+            "source": d.get("source"),
+            "collection": d.get("collection"),
+        }
+        out = record(b"D", _json_bytes(entry))
+        for piece in rag_index.text_pieces(user_id, doc_id, piece_bytes=_PIECE):
+            out += record(b"T", piece)
+            yield out
+            out = b""
+        for c in rag_store.load_chunks(user_id, doc_id):
+            chunk_id = str(c.get("id") or "").encode("utf-8")
+            text = str(c.get("text") or "").encode("utf-8")
+            out += record(b"C", _CHUNK_ID.pack(len(chunk_id)) + chunk_id + text)
+            chunks += 1
+        if out:
+            yield out
+
+    # Postings and rows describe the snapshot; only trust them if no write landed meanwhile.
+    consistent = rag_store.generation(user_id) == header["generation"]
+    yield record(b"E", _json_bytes({"documents": len(docs), "chunks": chunks, "consistent": consistent}))
+    yield z.flush()
+
+
+# Import
+
+
+def _records(blocks: Iterable[bytes], max_bytes: int) -> Iterator[tuple[bytes, bytes]]:
+    it = iter(blocks)
+    head = b""
+    for block in it:
+        head += block
+        if len(head) >= _PREAMBLE.size:
+            break
+    if len(head) < _PREAMBLE.size or head[:4] != _MAGIC:
+        raise _invalid("Not a RAG export")
+    _magic, version, codec = _PREAMBLE.unpack_from(head)
+    if version != _FORMAT or codec != _CODEC_ZLIB:
+        raise _invalid(f"Unsupported export format {version} (codec {codec})")
+
+    z = zlib.decompressobj()
+    buf = bytearray()
+    total = 0
+
+    def complete() -> Iterator[tuple[bytes, bytes]]:
+        pos = 0
+        while len(buf) - pos >= _RECORD.size:
+            kind, n = _RECORD.unpack_from(buf, pos)
+            if n > _MAX_RECORD:
+                raise _invalid("Corrupt export: oversized record")
+            start = pos + _RECORD.size
+            if len(buf) - start < n:
+                break
+            yield kind, bytes(buf[start : start + n])
+            pos = start + n
+        del buf[:pos]
+
+    for block in itertools.chain([head[_PREAMBLE.size :]], it):
+        data = block
+        while True:
+            if z.eof:
+                if data:
+                    raise _invalid("Trailing data after export")
+                break
+            try:
+                out = z.decompress(data, _PIECE)
+            except zlib.error as e:
+                raise _invalid("Corrupt export") from e
+            data = z.unconsumed_tail or z.unused_data
+            total += len(out)
+            if total > max_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail={"code": "payload_too_large", "message": f"Export exceeds {max_bytes} bytes"},
+                )
+            buf += out
+            yield from complete()
+            # Output capped at `_PIECE` may leave more pending inside the decompressor.
+            if not data and len(out) < _PIECE:
+                break
+    if not z.eof or buf:
+        raise _invalid("Truncated export")
+
+
+def _json_record(payload: bytes) -> dict[str, Any]:
+    try:
+        data = json.loads(payload)
+    except ValueError as e:
+        raise _invalid("Corrupt export: bad JSON record") from e
+    if not isinstance(data, dict):
+        raise _invalid("Corrupt export: bad JSON record")
+    return data
+
+
+class _Reader:
+    """
+    Groups records into documents; with `root`, postings/embedding pieces are spooled to temp
+    files there (`postings`, `vectors`).
+    """
+
+    def __init__(self, root: Path | None) -> None:
+        self.root = root
+        self.trailer: dict[str, Any] | None = None
+        self.postings: Path | None = None
+        self.vectors: Path | None = None
+        self._files: dict[bytes, BinaryIO] = {}
+
+    def _spool(self, kind: bytes, payload: bytes) -> None:
+        if self.root is None:
+            return
+        f = self._files.get(kind)
+        if f is None:
+            path = self.root / f".import-{uuid.uuid4().hex}.{'postings' if kind == b'P' else 'vectors'}"
+            if kind == b"P":
+                self.postings = path
+            else:
+                self.vectors = path
+            f = self._files[kind] = path.open("wb")
+        f.write(payload)
+
+    def documents(self, records: Iterator[tuple[bytes, bytes]]) -> Iterator[_Document]:
+        doc: tuple[dict[str, Any], bytearray, list[tuple[str, str]]] | None = None
+        for kind, payload in records:
+            if self.trailer is not None:
+                raise _invalid("Corrupt export: records after the trailer")
+            if kind in (b"P", b"V"):
+                if doc is not None:
+                    raise _invalid("Corrupt export: index data after documents")
+                self._spool(kind, payload)
+            elif kind in (b"D", b"E"):
+                if doc is not None:
+                    yield doc[0], bytes(doc[1]), doc[2]
+                    doc = None
+                if kind == b"D":
+                    self._close_files()
+                    doc = (_json_record(payload), bytearray(), [])
+                else:
+                    self.trailer = _json_record(payload)
+            elif kind == b"T" and doc is not None:
+                doc[1].extend(payload)
+            elif kind == b"C" and doc is not None and len(payload) >= _CHUNK_ID.size:
+                (n,) = _CHUNK_ID.unpack_from(payload)
+                body = payload[_CHUNK_ID.size :]
+                try:
+                    doc[2].append((body[:n].decode("utf-8"), body[n:].decode("utf-8")))
+                except UnicodeDecodeError as e:
+                    raise _invalid("Corrupt export: bad chunk") from e
+            else:
+                raise _invalid(f"Corrupt export: unexpected {kind.decode('latin-1')!r} record")
+        if self.trailer is None:
+            raise _invalid("Truncated export")
+        self._close_files()
+
+    def _close_files(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def cleanup(self) -> None:
+        self._close_files()
+        for path in (self.postings, self.vectors):
+            if path is not None:
+                path.unlink(missing_ok=True)
+
+
+def import_stream(user_id: str, blocks: Iterable[bytes]) -> dict[str, Any]:
+    """
+    Imports an `export_stream` container read from `blocks`. Into an empty JSON store the corpus
+    is restored as exported (`mode: "restore"`); otherwise its documents are added to the store
+    (`mode: "merge"`, new ids, documents with a known source re-ingested in place).
+    """
+    records = _records(blocks, _max_import_bytes())
+    kind, payload = next(records, (b"", b""))
+    if kind != b"H":
+        raise _invalid("Corrupt export: missing header")
+    header = _json_record(payload)
+    if rag_store.rag_backend() == "json" and not rag_store.list_documents(user_id):
+        return _restore(user_id, header, records)
+
+    reader = _Reader(None)
+    try:
+        docs = (
+            rag_index.PreparedDocument(
+                name=str(entry.get("name") or "document")[:200],
+                text=text.decode("utf-8", errors="replace"),
+                chunks=[t for _id, t in chunks],
+                source=str(entry["source"]) if entry.get("source") else None,
+                collection=str(entry["collection"]) if entry.get("collection") else None,
+            )
+            for entry, text, chunks in reader.documents(records)
+        )
+        results = rag_store.add_documents(user_id, docs)
+    finally:
+        reader.cleanup()
+    return {"mode": "merge", "documents": len(results), "chunks": sum(int(r["chunks"]) for r in results)}
+
+
+def _restore(user_id: str, header: dict[str, Any], records: Iterator[tuple[bytes, bytes]]) -> dict[str, Any]:
+    root = rag_index.rag_dir(user_id)
+    reader = _Reader(root)
+    written: list[Path] = []
+    entries: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    try:
+        for entry, text, chunks in reader.documents(records):
+            doc_id = str(entry.get("id") or "")
+            # Ids become file names.
+            if not _DOC_ID_RE.fullmatch(doc_id) or doc_id in seen:
+                raise _invalid("Corrupt export: bad document id")
+            seen.add(doc_id)
+            written.append(rag_index.shard_path(user_id, doc_id))
+            name, size = rag_index.store_document_files(user_id, doc_id, text.decode("utf-8", errors="replace"), chunks)
+            written.append(root / name)
+            restored = {
+                "id": doc_id,
+                "name": str(entry.get("name") or "document")[:200],
+                "createdAt": str(entry.get("createdAt") or _now_iso()),
+                "path": name,
+                "bytes": size,
+                "chunks": len(chunks),
+            }
+            for key in ("source", "collection"):
+                if entry.get(key):
+                    restored[key] = str(entry[key])
+            entries.append(restored)
+
+        trailer = reader.trailer or {}
+        # Prebuilt structures match the exported shards only if nothing changed mid-export.
+        prebuilt = bool(trailer.get("consistent"))
+        postings = reader.postings if prebuilt else None
+        vectors = reader.vectors if prebuilt else None
+        tombstones = [str(t) for t in header.get("tombstones") or []] if postings else []
+
+        def install_vectors(gen: int) -> None:
+            if vectors is not None:
+                rag_vectors.install(user_id, vectors, generation=gen)
+
+        gen = rag_index.restore(user_id, entries, tombstones=tombstones, postings=postings, after=install_vectors)
+    except BaseException:
+        for path in written:
+            path.unlink(missing_ok=True)
+        raise
+    finally:
+        reader.cleanup()
+    return {
+        "mode": "restore",
+        "documents": len(entries),
+        "chunks": sum(e["chunks"] for e in entries),
+        "generation": gen,
+    }
@@ -0,0 +1,381 @@
+from __future__ import annotations
+
+import fcntl
+import math
+import os
+import threading
+import zlib
+from collections import Counter
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Protocol
+
+import numpy as np
+
+from app import rag_analyzer, rag_binfile, rag_index
+
+# Local semantic retrieval: one float32 embedding matrix per user, computed at ingest time.
+#
+# Stored in `vectors.bin` (see `app/rag_binfile.py`) and searched through mmap:
+#   matrix f32[N * dim] (L2-normalized rows) | row_doc u32[N] | row_pos u32[N]
+#   doc_off u64[D + 1] | doc_blob u8[...] (document ids) | embedder u8[...] ("name:dim")
+# The header generation records the store generation the rows match; 0 means "unknown".
+# When it differs from the store, or the configured embedder changed, the next vector search
+# re-syncs the rows from the chunks.
+
+_BATCH = 64
+
+
+class Embedder(Protocol):
+    name: str
+    dim: int
+
+    def embed(self, texts: list[str]) -> np.ndarray: ...
+
+
+class HashingEmbedder:
+    """
+    Deterministic feature-hashing embedder (unigrams + bigrams, signed buckets, sublinear tf).
+
+    No model download and stable across processes, so it works as the built-in default.
+    """
+
+    name = "hashing"
+    # Bumped when feature extraction changes so stored rows are re-embedded.
+    revision = 2
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = dim
+
+    def _features(self, text: str) -> Counter[str]:
+        tokens = rag_analyzer.tokenize(text)
+        feats = Counter(tokens)
+        feats.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:], strict=False))
+        return feats
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            row = out[i]
+            for feat, n in self._features(text).items():
+                h = zlib.crc32(feat.encode("utf-8"))
+                weight = 1.0 + math.log(n)
+                row[h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+_EMBEDDERS: dict[str, Callable[[], Embedder]] = {"hashing": HashingEmbedder}
+_EMBEDDER_LOCK = threading.Lock()
+_EMBEDDER: Embedder | None = None
+
+
+def register_embedder(name: str, factory: Callable[[], Embedder]) -> None:
+    """
+    Registers a local embedder; select it with `RAG_EMBEDDER=<name>`.
+    """
+    global _EMBEDDER
+    with _EMBEDDER_LOCK:
+        _EMBEDDERS[name] = factory
+        _EMBEDDER = None
+
+
+def get_embedder() -> Embedder:
+    global _EMBEDDER
+    name = (os.environ.get("RAG_EMBEDDER") or "").strip() or "hashing"
+    if name not in _EMBEDDERS:
+        name = "hashing"
+    with _EMBEDDER_LOCK:
+        if _EMBEDDER is None or _EMBEDDER.name != name:
+            _EMBEDDER = _EMBEDDERS[name]()
+        return _EMBEDDER
+
+
+def _embedder_key(embedder: Embedder) -> str:
+    return f"{embedder.name}:{embedder.dim}:{getattr(embedder, 'revision', 0)}"
+
+
+def embedder_key() -> str:
+    """
+    Identifies the configured embedder; vectors (and results) from another key don't apply.
+    """
+    return _embedder_key(get_embedder())
+
+
+def _vectors_path(user_id: str) -> Path:
+    return rag_index.rag_dir(user_id) / "vectors.bin"
+
+
+def _open(user_id: str, embedder: Embedder) -> rag_binfile.ArrayFile | None:
+    f = rag_binfile.open_arrays(_vectors_path(user_id))
+    if f is None or f["embedder"].tobytes().decode("utf-8") != _embedder_key(embedder):
+        return None
+    if f["matrix"].size != len(f["row_doc"]) * embedder.dim:
+        return None
+    return f
+
+
+_ROWS_LOCK = threading.Lock()
+_ROWS_LOCKS: dict[str, threading.Lock] = {}
+
+
+@contextmanager
+def _rows_lock(user_id: str) -> Iterator[None]:
+    """
+    Serializes read-modify-write cycles on one user's `vectors.bin`, across threads and worker
+    processes. A lock file of its own: the JSON writer commits vectors while holding `.writer.lock`.
+    """
+    with _ROWS_LOCK:
+        lock = _ROWS_LOCKS.get(user_id)
+        if lock is None:
+            lock = _ROWS_LOCKS[user_id] = threading.Lock()
+    with lock, (rag_index.rag_dir(user_id) / ".vectors.lock").open("a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def generation(user_id: str) -> int | None:
+    f = _open(user_id, get_embedder())
+    return f.generation if f is not None else None
+
+
+def snapshot(user_id: str) -> rag_binfile.ArrayFile | None:
+    """
+    The current rows file (for exports), or None if there is none for the configured embedder.
+    """
+    return _open(user_id, get_embedder())
+
+
+def install(user_id: str, path: Path, *, generation: int) -> bool:
+    """
+    Publishes an unpublished rows file (e.g. from an import) as the rows of store `generation`.
+    Returns False, leaving the rows to the next re-sync, if another embedder produced it.
+    """
+    embedder = get_embedder()
+    f = rag_binfile.open_arrays(path, cache=False)
+    if f is None or f["embedder"].tobytes().decode("utf-8") != _embedder_key(embedder):
+        return False
+    if f["matrix"].size != len(f["row_doc"]) * embedder.dim:
+        return False
+    with _rows_lock(user_id):
+        rag_binfile.set_generation(path, generation)
+        path.replace(_vectors_path(user_id))
+    return True
+
+
+class _Rows:
+    """
+    Mutable copy of the stored rows, used by writers.
+    """
+
+    def __init__(self, embedder: Embedder, f: rag_binfile.ArrayFile | None) -> None:
+        self.embedder = embedder
+        # No file yet covers an empty store, i.e. generation 0.
+        self.generation = f.generation if f is not None else 0
+        if f is None:
+            self.doc_ids: list[str] = []
+            self.row_doc = np.zeros(0, dtype=np.uint32)
+            self.row_pos = np.zeros(0, dtype=np.uint32)
+            self.matrix = np.zeros((0, embedder.dim), dtype=np.float32)
+            return
+        self.doc_ids = rag_binfile.unpack_strings(f["doc_off"], f["doc_blob"])
+        self.row_doc = np.asarray(f["row_doc"])
+        self.row_pos = np.asarray(f["row_pos"])
+        self.matrix = np.asarray(f["matrix"]).reshape(-1, embedder.dim)
+
+    def row_counts(self) -> dict[str, int]:
+        counts = np.bincount(self.row_doc, minlength=len(self.doc_ids)).tolist()
+        return {doc_id: n for doc_id, n in zip(self.doc_ids, counts, strict=True) if n}
+
+    def keep(self, mask: np.ndarray) -> None:
+        self.row_doc = self.row_doc[mask]
+        self.row_pos = self.row_pos[mask]
+        self.matrix = self.matrix[mask]
+
+    def drop(self, doc_ids: set[str]) -> None:
+        dropped = np.array([d in doc_ids for d in self.doc_ids] or [False], dtype=bool)
+        self.keep(~dropped[self.row_doc])
+
+    def remap(self, doc_id: str, keep: dict[int, int]) -> None:
+        """
+        Renumbers `doc_id`'s rows after a re-ingest (`keep` maps old to new chunk position)
+        and drops rows of chunks that are gone.
+        """
+        if doc_id not in self.doc_ids:
+            return
+        mine = self.row_doc == self.doc_ids.index(doc_id)
+        pos = self.row_pos.astype(np.int64)
+        pos[mine] = [keep.get(p, -1) for p in pos[mine].tolist()]
+        self.row_pos = pos.astype(np.uint32)
+        self.keep(pos >= 0)
+
+    def append(self, doc_id: str, vectors: np.ndarray, positions: list[int] | None = None) -> None:
+        if doc_id not in self.doc_ids:
+            self.doc_ids.append(doc_id)
+        n = len(vectors)
+        pos = np.arange(n, dtype=np.uint32) if positions is None else np.array(positions, dtype=np.uint32)
+        self.row_doc = np.concatenate([self.row_doc, np.full(n, self.doc_ids.index(doc_id), dtype=np.uint32)])
+        self.row_pos = np.concatenate([self.row_pos, pos])
+        self.matrix = np.concatenate([self.matrix, vectors.astype(np.float32, copy=False)])
+
+    def save(self, user_id: str, generation: int) -> None:
+        # Drop ids no row refers to any more and renumber.
+        used, row_doc = np.unique(self.row_doc, return_inverse=True)
+        doc_off, doc_blob = rag_binfile.pack_strings([self.doc_ids[i] for i in used.tolist()])
+        rag_binfile.write_arrays(
+            _vectors_path(user_id),
+            {
+                "matrix": self.matrix,
+                "row_doc": row_doc.astype(np.uint32),
+                "row_pos": self.row_pos,
+                "doc_off": doc_off,
+                "doc_blob": doc_blob,
+                "embedder": np.frombuffer(_embedder_key(self.embedder).encode("utf-8"), dtype=np.uint8),
+            },
+            generation=generation,
+        )
+
+    def next_generation(self, generation: int, previous: int | None = None) -> int:
+        # Only claim the new store generation if these rows matched the one before the write.
+        return generation if self.generation == (generation - 1 if previous is None else previous) else 0
+
+
+class PendingVectors:
+    """
+    Embeds chunks in batches while a document streams in; rows are appended on `commit()`.
+    """
+
+    def __init__(self, embedder: Embedder | None = None) -> None:
+        self.embedder = embedder or get_embedder()
+        self._texts: list[str] = []
+        self._blocks: list[np.ndarray] = []
+
+    def add(self, text: str) -> None:
+        self._texts.append(text)
+        if len(self._texts) >= _BATCH:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._texts:
+            self._blocks.append(self.embedder.embed(self._texts))
+            self._texts = []
+
+    def take(self) -> np.ndarray | None:
+        self._flush()
+        blocks, self._blocks = self._blocks, []
+        return np.vstack(blocks) if blocks else None
+
+    def commit(
+        self,
+        user_id: str,
+        doc_id: str,
+        *,
+        generation: int,
+        positions: list[int] | None = None,
+        keep: dict[int, int] | None = None,
+    ) -> None:
+        """
+        Stores the embedded chunks at `positions` (default: 0..n-1). For a re-ingested document
+        `keep` maps the surviving chunks' old positions to new ones; other old rows are dropped.
+        """
+        commit_many(user_id, [(self, doc_id, positions, keep)], generation=generation)
+
+
+def commit_many(
+    user_id: str,
+    items: list[tuple[PendingVectors, str, list[int] | None, dict[int, int] | None]],
+    *,
+    generation: int,
+    previous: int | None = None,
+) -> None:
+    """
+    `PendingVectors.commit` for several documents `(pending, doc_id, positions, keep)` with one
+    rewrite of the file. The rows claim `generation` only if they matched `previous` (default:
+    `generation - 1`) before.
+    """
+    if not items:
+        return
+    embedder = items[0][0].embedder
+    with _rows_lock(user_id):
+        rows = _Rows(embedder, _open(user_id, embedder))
+        for pending, doc_id, positions, keep in items:
+            vectors = pending.take()
+            if keep is not None:
+                rows.remap(doc_id, keep)
+            if vectors is not None:
+                rows.append(doc_id, vectors, positions)
+        rows.save(user_id, rows.next_generation(generation, previous))
+
+
+def delete_document(user_id: str, doc_id: str, *, generation: int) -> None:
+    embedder = get_embedder()
+    with _rows_lock(user_id):
+        rows = _Rows(embedder, _open(user_id, embedder))
+        rows.drop({doc_id})
+        rows.save(user_id, rows.next_generation(generation))
+
+
+def sync(
+    user_id: str, chunk_counts: dict[str, int], load_texts: Callable[[str], list[str]], *, generation: int
+) -> None:
+    """
+    Makes the rows cover exactly the documents in `chunk_counts` (doc id -> chunk count): drops
+    rows of unknown documents and re-embeds documents whose row count is off (corpora indexed
+    before vectors existed, embedder changes, interrupted writes).
+    """
+    embedder = get_embedder()
+    with _rows_lock(user_id):
+        rows = _Rows(embedder, _open(user_id, embedder))
+        have = rows.row_counts()
+        stale = {d for d, n in have.items() if chunk_counts.get(d) != n}
+        missing = [d for d, n in chunk_counts.items() if n and have.get(d) != n]
+        rows.drop(stale)
+        for doc_id in missing:
+            pending = PendingVectors(embedder)
+            for text in load_texts(doc_id):
+                pending.add(text)
+            vectors = pending.take()
+            if vectors is not None:
+                rows.append(doc_id, vectors)
+        rows.save(user_id, generation)
+
+
+def search(user_id: str, query: str, *, limit: int = 8) -> list[tuple[str, int, float]]:
+    """
+    Returns up to `limit` (doc_id, chunk_pos, cosine) rows with positive similarity.
+    """
+    return search_many(user_id, [(query, limit)])[0]
+
+
+def search_many(user_id: str, queries: list[tuple[str, int]]) -> list[list[tuple[str, int, float]]]:
+    """
+    Batched `search`: all queries are embedded together and scored with one matrix product.
+    """
+    embedder = get_embedder()
+    f = _open(user_id, embedder)
+    if f is None or not len(f["row_doc"]) or not queries:
+        return [[] for _ in queries]
+    q = embedder.embed([query for query, _limit in queries])
+    scores = f["matrix"].reshape(-1, embedder.dim) @ q.T
+    out: list[list[tuple[str, int, float]]] = []
+    for j, (_query, limit) in enumerate(queries):
+        col = scores[:, j]
+        if limit <= 0 or not q[j].any():
+            out.append([])
+            continue
+        k = min(int(limit), len(col))
+        top = np.argpartition(-col, k - 1)[:k]
+        top = top[np.argsort(-col[top], kind="stable")]
+        hits = []
+        for i in top.tolist():
+            if col[i] <= 0:
+                continue
+            doc_id = rag_binfile.unpack_string(f["doc_off"], f["doc_blob"], int(f["row_doc"][i]))
+            hits.append((doc_id, int(f["row_pos"][i]), float(col[i])))
+        out.append(hits)
+    return out
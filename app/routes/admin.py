@@ -10,6 +10,7 @@ from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 
 from app.auth import require_user_from_request
+from app.crawl_settings import load_crawl_throttle, save_crawl_throttle
 from app.feature_overrides import load_feature_overrides, save_feature_overrides
 from app.routes.user import _is_admin
 from app.settings import feature_enabled
@@ -136,6 +137,31 @@ async def put_feature_overrides(body: FeatureOverridesBody, http_request: Reques
     return {"ok": True, "overrides": saved}
 
 
+class CrawlThrottleBody(BaseModel):
+    minDelaySec: float = 0.05
+    maxDelaySec: float = 30.0
+    maxConcurrency: int = 4
+
+
+@router.get("/api/admin/crawl-throttle")
+async def get_crawl_throttle(http_request: Request):
+    user = await require_user_from_request(http_request)
+    _require_admin(user)
+    return {"ok": True, "limits": load_crawl_throttle()}
+
+
+@router.put("/api/admin/crawl-throttle")
+async def put_crawl_throttle(body: CrawlThrottleBody, http_request: Request):
+    user = await require_user_from_request(http_request)
+    _require_admin(user)
+    if body.minDelaySec > body.maxDelaySec:
+        raise HTTPException(
+            status_code=400,
+            detail={"code": "invalid_request", "message": "minDelaySec must not exceed maxDelaySec"},
+        )
+    return {"ok": True, "limits": save_crawl_throttle(body.model_dump())}
+
+
 class UsersPruneBody(BaseModel):
     olderThanDays: int = 90
     inactiveOnly: bool = True
@@ -1,15 +1,24 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import time
+from collections.abc import Iterator
 from typing import Any
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from openai import OpenAI
 from pydantic import BaseModel
 
+from app import rag_store
+from app.auth import require_user_from_request
+from app.settings import feature_enabled
+
 router = APIRouter()
 
+_DEFAULT_RAG_BUDGET_MS = 300.0
+
 
 class ChatMessage(BaseModel):
     role: str
@@ -33,21 +42,118 @@ async def chat_endpoint(request: ChatRequest):
         raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "API Key is required"})
 
     client = OpenAI(api_key=api_key, base_url=base_url)
+    messages = [{"role": m.role, "content": m.content} for m in request.messages]
+    return StreamingResponse(_generate(client, request.model, messages), media_type="text/plain")
+
+
+def _generate(client: OpenAI, model: str | None, messages: list[dict[str, Any]]) -> Iterator[str]:
+    try:
+        stream = client.chat.completions.create(model=model, messages=messages, stream=True)
+        for chunk in stream:
+            if chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        yield f"Error: {str(e)}"
+
+
+# Retrieval-augmented chat
+#
+# `/api/chat/rag` searches the user's RAG index for the last user message and hands the hits to
+# the model as a system message, saving the client its own search round trip. Retrieval gets
+# `RAG_CHAT_BUDGET_MS`; past that, or when the index fails, the chat goes ahead without context
+# (a slow search keeps running in its thread and lands in the search cache for the next turn).
+# Meanwhile the provider client is built; no provider request is sent before the completion.
+
 
-    def generate():
-        try:
-            stream = client.chat.completions.create(
-                model=request.model,
-                messages=[{"role": m.role, "content": m.content} for m in request.messages],
-                stream=True,
-            )
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
-        except Exception as e:
-            yield f"Error: {str(e)}"
-
-    return StreamingResponse(generate(), media_type="text/plain")
+class ChatRagRequest(ChatRequest):
+    limit: int = 5
+    mode: str = "keyword"  # keyword|vector|hybrid
+
+
+def _rag_budget_sec() -> float:
+    raw = (os.environ.get("RAG_CHAT_BUDGET_MS") or "").strip()
+    try:
+        ms = max(0.0, float(raw)) if raw else _DEFAULT_RAG_BUDGET_MS
+    except ValueError:
+        ms = _DEFAULT_RAG_BUDGET_MS
+    return ms / 1000.0
+
+
+def _last_user_text(messages: list[ChatMessage]) -> str:
+    for m in reversed(messages):
+        if m.role != "user":
+            continue
+        if isinstance(m.content, str):
+            return m.content.strip()
+        parts = [p.get("text") for p in m.content if isinstance(p, dict) and p.get("type") == "text"]
+        return " ".join(p for p in parts if isinstance(p, str)).strip()
+    return ""
+
+
+async def _retrieve(
+    user_id: str, query: str, *, limit: int, mode: str, budget: float
+) -> tuple[list[dict[str, Any]], str]:
+    """
+    Search results and how retrieval went: ok, timeout or error.
+    """
+    if not query or not rag_store.tokenize(query):
+        return [], "ok"
+    try:
+        results = await asyncio.wait_for(
+            asyncio.to_thread(rag_store.search, user_id, query, limit=limit, mode=mode), timeout=budget
+        )
+    except TimeoutError:
+        return [], "timeout"
+    except (HTTPException, OSError):
+        return [], "error"
+    return results, "ok"
+
+
+def _context_message(results: list[dict[str, Any]]) -> dict[str, Any]:
+    lines = [
+        "Answer using the following excerpts from the user's documents when they are relevant. "
+        "Cite them by their [number]."
+    ]
+    for i, r in enumerate(results, start=1):
+        lines.append(f"[{i}] {r['document']['name']}: {r['excerpt']}")
+    return {"role": "system", "content": "\n\n".join(lines)}
+
+
+@router.post("/api/chat/rag")
+async def chat_rag_endpoint(request: ChatRagRequest, http_request: Request):
+    if not feature_enabled("indexing"):
+        raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
+    user = await require_user_from_request(http_request)
+    user_id = str(user.get("id") or "")
+
+    api_key = request.apiKey or os.environ.get("OPENAI_API_KEY")
+    base_url = request.baseUrl or os.environ.get("OPENAI_BASE_URL")
+    if not api_key:
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "API Key is required"})
+    mode = (request.mode or "keyword").strip().lower()
+    if mode not in rag_store.SEARCH_MODES:
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Invalid search mode"})
+    limit = max(1, min(int(request.limit or 5), 25))
+
+    budget = _rag_budget_sec()
+    start = time.perf_counter()
+    client, (results, retrieval) = await asyncio.gather(
+        asyncio.to_thread(OpenAI, api_key=api_key, base_url=base_url),
+        _retrieve(user_id, _last_user_text(request.messages), limit=limit, mode=mode, budget=budget),
+    )
+    setup_ms = round((time.perf_counter() - start) * 1000.0, 2)
+
+    messages = [{"role": m.role, "content": m.content} for m in request.messages]
+    if results:
+        # After any leading system prompt, so the client's own instructions keep priority.
+        at = next((i for i, m in enumerate(messages) if m["role"] != "system"), len(messages))
+        messages.insert(at, _context_message(results))
+    headers = {
+        "X-RAG-Chunks": str(len(results)),
+        "X-RAG-Retrieval": retrieval,
+        "X-RAG-Setup-Ms": str(setup_ms),
+    }
+    return StreamingResponse(_generate(client, request.model, messages), media_type="text/plain", headers=headers)
 
 
 class ModelsRequest(BaseModel):
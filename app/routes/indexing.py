@@ -15,6 +15,14 @@ class WebCrawlRequest(BaseModel):
     maxDepth: int = 2
     rateLimitSec: float = 0.25
     respectRobots: bool = True
+    autoThrottle: bool = False  # adapt pace to the site's latency and 429/503s (admin bounds)
+
+
+class RecrawlRequest(BaseModel):
+    url: str  # start URL of an earlier web crawl
+    rateLimitSec: float = 0.25
+    respectRobots: bool = True
+    autoThrottle: bool = False
 
 
 class GitHubRepoRequest(BaseModel):
@@ -53,6 +61,24 @@ async def start_web_crawl(body: WebCrawlRequest, http_request: Request):
         max_depth=body.maxDepth,
         rate_limit_sec=body.rateLimitSec,
         respect_robots=body.respectRobots,
+        auto_throttle=body.autoThrottle,
+    )
+    return {"ok": True, "job": job.__dict__}
+
+
+@router.post("/api/indexing/jobs/recrawl")
+async def start_recrawl(body: RecrawlRequest, http_request: Request):
+    if not feature_enabled("indexing"):
+        raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
+    user = await require_user_from_request(http_request)
+    user_id = str(user.get("id") or "")
+    store = http_request.app.state.index_job_store
+    job = await store.create_recrawl_job(
+        user_id,
+        start_url=body.url,
+        rate_limit_sec=body.rateLimitSec,
+        respect_robots=body.respectRobots,
+        auto_throttle=body.autoThrottle,
     )
     return {"ok": True, "job": job.__dict__}
 
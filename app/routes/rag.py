@@ -1,152 +1,213 @@
 from __future__ import annotations
 
-import json
-import re
-import uuid
-from dataclasses import dataclass
-from datetime import UTC, datetime
-from pathlib import Path
-
-from fastapi import APIRouter, HTTPException, Request, UploadFile
+import asyncio
+import codecs
+import os
+import time
+from collections.abc import AsyncIterator, Iterator
+from typing import Any, BinaryIO
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.datastructures import FormData, UploadFile
+from starlette.types import Message
 
+from app import rag_bulk, rag_store, rag_transfer
 from app.auth import require_user_from_request
 from app.settings import feature_enabled
-from app.storage import user_data_dir
 
 router = APIRouter()
 
 
-def _rag_dir(user_id: str) -> Path:
-    root = user_data_dir(user_id) / "rag"
-    root.mkdir(parents=True, exist_ok=True)
-    return root
+@router.get("/api/rag/documents")
+async def list_documents(http_request: Request):
+    if not feature_enabled("indexing"):
+        raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
+    user = await require_user_from_request(http_request)
+    user_id = str(user.get("id") or "")
+    return {"documents": await asyncio.to_thread(rag_store.list_documents, user_id)}
+
 
+_UPLOAD_BLOCK_BYTES = 64 * 1024
+_DEFAULT_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+# Room for multipart boundaries and part headers on top of the file itself.
+_FORM_OVERHEAD_BYTES = 64 * 1024
 
-def _index_path(user_id: str) -> Path:
-    return _rag_dir(user_id) / "rag-index.json"
+
+def _max_upload_bytes() -> int:
+    raw = (os.environ.get("RAG_MAX_UPLOAD_BYTES") or "").strip()
+    try:
+        return max(1, int(raw)) if raw else _DEFAULT_MAX_UPLOAD_BYTES
+    except ValueError:
+        return _DEFAULT_MAX_UPLOAD_BYTES
 
 
-@dataclass(frozen=True)
-class _Chunk:
-    id: str
-    text: str
+def _too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail={"code": "payload_too_large", "message": f"File exceeds {max_bytes} bytes"},
+    )
 
 
-def _chunk_text(text: str, *, max_chars: int = 1200, overlap: int = 120) -> list[_Chunk]:
-    t = (text or "").strip()
-    if not t:
-        return []
-    chunks: list[_Chunk] = []
-    i = 0
-    n = len(t)
-    while i < n:
-        j = min(n, i + max_chars)
-        chunk = t[i:j].strip()
-        if chunk:
-            chunks.append(_Chunk(id=str(uuid.uuid4()), text=chunk))
-        if j >= n:
+async def _form_file(http_request: Request, max_bytes: int) -> tuple[FormData, UploadFile]:
+    """
+    Parses the multipart body and returns it with its `file` part. The body is capped before
+    anything is spooled: a larger `Content-Length` is rejected up front, and a body without one
+    is cut off as soon as it crosses the cap. Close the form once done with the file.
+    """
+    limit = max_bytes + _FORM_OVERHEAD_BYTES
+    declared = http_request.headers.get("content-length") or ""
+    if declared.isdigit() and int(declared) > limit:
+        raise _too_large(max_bytes)
+    receive = http_request.receive
+    received = 0
+
+    async def limited_receive() -> Message:
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise _too_large(max_bytes)
+        return message
+
+    form = await Request(http_request.scope, limited_receive).form()
+    file = form.get("file")
+    if not isinstance(file, UploadFile):
+        await form.close()
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Missing file"})
+    return form, file
+
+
+def _stream_upload(fh: BinaryIO, writer: rag_store.DocumentWriter, encoding: str, max_bytes: int) -> int:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    total = 0
+    while True:
+        block = fh.read(_UPLOAD_BLOCK_BYTES)
+        if not block:
             break
-        i = max(0, j - overlap)
-    return chunks
+        total += len(block)
+        if total > max_bytes:
+            raise _too_large(max_bytes)
+        writer.write(decoder.decode(block))
+    writer.write(decoder.decode(b"", final=True))
+    return total
+
+
+def _ingest_upload(user_id: str, name: str, fh: BinaryIO, max_bytes: int) -> dict[str, Any]:
+    # Decode as UTF-8 while streaming; if that fails partway, start over as latin-1.
+    for encoding in ("utf-8", "latin-1"):
+        writer = rag_store.begin_document(user_id, name=name)
+        try:
+            total = _stream_upload(fh, writer, encoding, max_bytes)
+        except UnicodeDecodeError:
+            writer.abort()
+            fh.seek(0)
+            continue
+        except BaseException:
+            writer.abort()
+            raise
+        break
 
+    if total == 0:
+        writer.abort()
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Empty file"})
+    if not writer.has_text:
+        writer.abort()
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "No indexable text found"})
+    return writer.commit()
 
-def _load_index(path: Path) -> dict:
-    try:
-        return json.loads(path.read_text(encoding="utf-8"))
-    except FileNotFoundError:
-        return {"version": 1, "documents": []}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail={"code": "internal_error", "message": str(e)}) from e
 
+@router.post("/api/rag/documents/upload")
+async def upload_document(http_request: Request):
+    if not feature_enabled("indexing"):
+        raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
+    user = await require_user_from_request(http_request)
+    user_id = str(user.get("id") or "")
 
-def _save_index(path: Path, data: dict) -> None:
+    max_bytes = _max_upload_bytes()
+    form, file = await _form_file(http_request, max_bytes)
     try:
-        path.write_text(json.dumps(data, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail={"code": "internal_error", "message": str(e)}) from e
+        if file.size is not None and file.size > max_bytes:
+            raise _too_large(max_bytes)
 
+        name = (file.filename or "document").strip()
+        if len(name) > 200:
+            name = name[:200]
 
-def _now_iso() -> str:
-    return datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+        # Chunking, embedding and the commit (which waits on the user's writer) all block.
+        result = await asyncio.to_thread(_ingest_upload, user_id, name, file.file, max_bytes)
+    finally:
+        await form.close()
+    return {"ok": True, "id": result["id"], "chunks": result["chunks"]}
 
 
-@router.get("/api/rag/documents")
-async def list_documents(http_request: Request):
+@router.post("/api/rag/documents/bulk")
+async def bulk_upload(http_request: Request):
     if not feature_enabled("indexing"):
         raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
     user = await require_user_from_request(http_request)
     user_id = str(user.get("id") or "")
-    idx_path = _index_path(user_id)
-    idx = _load_index(idx_path)
-    docs = idx.get("documents") if isinstance(idx.get("documents"), list) else []
-    out = []
-    for d in docs:
-        if not isinstance(d, dict):
-            continue
-        out.append(
-            {
-                "id": d.get("id"),
-                "name": d.get("name"),
-                "createdAt": d.get("createdAt"),
-                "bytes": d.get("bytes"),
-                "chunks": len(d.get("chunks") or []),
-            }
+
+    max_bytes = rag_bulk.max_bytes()
+    form, file = await _form_file(http_request, max_bytes)
+    try:
+        if file.size is not None and file.size > max_bytes:
+            raise _too_large(max_bytes)
+        name = (file.filename or "archive").strip()[:200]
+
+        # Extraction, the worker pool and the commit all block; keep them off the event loop.
+        result = await asyncio.to_thread(
+            rag_bulk.ingest_archive, user_id, file.file, archive_name=name, file_limit=_max_upload_bytes()
         )
-    return {"documents": out}
+    finally:
+        await form.close()
+    documents = result["documents"]
+    if not documents:
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "No indexable text found"})
+    return {
+        "ok": True,
+        "documents": [{"id": d["id"], "chunks": d["chunks"]} for d in documents],
+        "skipped": result["skipped"],
+    }
 
 
-@router.post("/api/rag/documents/upload")
-async def upload_document(file: UploadFile, http_request: Request):
+@router.get("/api/rag/export")
+async def export_index(http_request: Request):
     if not feature_enabled("indexing"):
         raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
     user = await require_user_from_request(http_request)
     user_id = str(user.get("id") or "")
+    # The snapshot is taken up front; the (sync) body iterator runs in Starlette's threadpool.
+    body = await asyncio.to_thread(rag_transfer.export_stream, user_id)
+    return StreamingResponse(
+        body,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="rag-export.ragx"'},
+    )
 
-    data = await file.read()
-    if not data:
-        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Empty file"})
-
-    name = (file.filename or "document").strip()
-    if len(name) > 200:
-        name = name[:200]
 
-    try:
-        text = data.decode("utf-8")
-    except Exception:
+def _blocking_blocks(stream: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop) -> Iterator[bytes]:
+    # Lets a worker thread pull the request body from the event loop, one block at a time.
+    while True:
         try:
-            text = data.decode("latin-1")
-        except Exception as e:
-            raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Unsupported encoding"}) from e
+            block = asyncio.run_coroutine_threadsafe(anext(stream), loop).result()
+        except StopAsyncIteration:
+            return
+        if block:
+            yield block
 
-    doc_id = str(uuid.uuid4())
-    chunks = _chunk_text(text)
-    if not chunks:
-        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "No indexable text found"})
 
-    rag_root = _rag_dir(user_id)
-    doc_path = rag_root / f"{doc_id}.txt"
-    doc_path.write_text(text, encoding="utf-8")
-
-    idx_path = _index_path(user_id)
-    idx = _load_index(idx_path)
-    docs = idx.get("documents")
-    if not isinstance(docs, list):
-        docs = []
-        idx["documents"] = docs
-
-    docs.append(
-        {
-            "id": doc_id,
-            "name": name,
-            "createdAt": _now_iso(),
-            "bytes": len(data),
-            "path": doc_path.name,
-            "chunks": [{"id": c.id, "text": c.text} for c in chunks],
-        }
-    )
-    _save_index(idx_path, idx)
-    return {"ok": True, "id": doc_id, "chunks": len(chunks)}
+@router.post("/api/rag/import")
+async def import_index(http_request: Request):
+    if not feature_enabled("indexing"):
+        raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
+    user = await require_user_from_request(http_request)
+    user_id = str(user.get("id") or "")
+    blocks = _blocking_blocks(http_request.stream(), asyncio.get_running_loop())
+    result = await asyncio.to_thread(rag_transfer.import_stream, user_id, blocks)
+    return {"ok": True, **result}
 
 
 @router.delete("/api/rag/documents/{doc_id}")
@@ -155,39 +216,44 @@ async def delete_document(doc_id: str, http_request: Request):
         raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
     user = await require_user_from_request(http_request)
     user_id = str(user.get("id") or "")
-
-    idx_path = _index_path(user_id)
-    idx = _load_index(idx_path)
-    docs = idx.get("documents")
-    if not isinstance(docs, list):
-        docs = []
-        idx["documents"] = docs
-
-    before = len(docs)
-    kept = []
-    removed = None
-    for d in docs:
-        if isinstance(d, dict) and str(d.get("id") or "") == doc_id:
-            removed = d
-        else:
-            kept.append(d)
-    idx["documents"] = kept
-    _save_index(idx_path, idx)
-
-    if removed is not None:
-        try:
-            path = removed.get("path")
-            if isinstance(path, str) and path:
-                (_rag_dir(user_id) / path).unlink(missing_ok=True)
-        except Exception:
-            pass
-
-    return {"ok": True, "deleted": 1 if removed is not None else 0, "before": before, "after": len(kept)}
+    result = await asyncio.to_thread(rag_store.delete_document, user_id, doc_id)
+    return {"ok": True, **result}
 
 
 class SearchRequest(BaseModel):
     query: str
     limit: int = 8
+    mode: str = "keyword"  # keyword|vector|hybrid
+
+
+_MAX_BATCH_QUERIES = 32
+
+
+def _search_query(query: str) -> str:
+    q = (query or "").strip()
+    if not q:
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Missing query"})
+    if not rag_store.tokenize(q):
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Invalid query"})
+    return q
+
+
+def _search_mode(mode: str) -> str:
+    m = (mode or "keyword").strip().lower()
+    if m not in rag_store.SEARCH_MODES:
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Invalid search mode"})
+    return m
+
+
+def _search_limit(limit: int) -> int:
+    return max(1, min(int(limit or 8), 25))
+
+
+def _with_timings(body: dict, mode: str, timings: dict[str, float], start: float) -> dict:
+    # Hybrid responses report where the time went: retriever stages plus the whole search.
+    if mode == "hybrid":
+        body["timings"] = {**timings, "totalMs": round((time.perf_counter() - start) * 1000.0, 2)}
+    return body
 
 
 @router.post("/api/rag/search")
@@ -197,53 +263,49 @@ async def search(request: SearchRequest, http_request: Request):
     user = await require_user_from_request(http_request)
     user_id = str(user.get("id") or "")
 
-    q = (request.query or "").strip()
-    if not q:
-        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Missing query"})
+    q = _search_query(request.query)
+    mode = _search_mode(request.mode)
+    start = time.perf_counter()
+    timings: dict[str, float] = {}
+    results = await asyncio.to_thread(
+        rag_store.search, user_id, q, limit=_search_limit(request.limit), mode=mode, timings=timings
+    )
+    return _with_timings({"results": results}, mode, timings, start)
 
-    idx_path = _index_path(user_id)
-    idx = _load_index(idx_path)
-    docs = idx.get("documents") if isinstance(idx.get("documents"), list) else []
 
-    terms = [t for t in re.split(r"\\W+", q.lower()) if t]
-    if not terms:
-        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Invalid query"})
+class BatchSearchQuery(BaseModel):
+    query: str
+    limit: int = 8
 
-    results = []
-    for d in docs:
-        if not isinstance(d, dict):
-            continue
-        doc_name = str(d.get("name") or "")
-        doc_id = str(d.get("id") or "")
-        chunks = d.get("chunks") if isinstance(d.get("chunks"), list) else []
-        for ch in chunks:
-            if not isinstance(ch, dict):
-                continue
-            text = str(ch.get("text") or "")
-            hay = text.lower()
-            score = sum(hay.count(t) for t in terms)
-            if score <= 0:
-                continue
-            first = None
-            for t in terms:
-                pos = hay.find(t)
-                if pos != -1:
-                    first = pos
-                    break
-            if first is None:
-                first = 0
-            start = max(0, first - 120)
-            end = min(len(text), first + 240)
-            excerpt = text[start:end].strip()
-            results.append(
-                {
-                    "score": score,
-                    "document": {"id": doc_id, "name": doc_name},
-                    "chunkId": ch.get("id"),
-                    "excerpt": excerpt,
-                }
-            )
-
-    results.sort(key=lambda r: int(r.get("score") or 0), reverse=True)
-    limit = max(1, min(int(request.limit or 8), 25))
-    return {"results": results[:limit]}
+
+class BatchSearchRequest(BaseModel):
+    queries: list[BatchSearchQuery]
+    mode: str = "keyword"  # keyword|vector|hybrid
+
+
+@router.post("/api/rag/search/batch")
+async def search_batch(request: BatchSearchRequest, http_request: Request):
+    if not feature_enabled("indexing"):
+        raise HTTPException(status_code=403, detail={"code": "feature_disabled", "message": "Indexing is disabled"})
+    user = await require_user_from_request(http_request)
+    user_id = str(user.get("id") or "")
+
+    if not request.queries:
+        raise HTTPException(status_code=400, detail={"code": "invalid_request", "message": "Missing queries"})
+    if len(request.queries) > _MAX_BATCH_QUERIES:
+        raise HTTPException(
+            status_code=400,
+            detail={"code": "invalid_request", "message": f"At most {_MAX_BATCH_QUERIES} queries per batch"},
+        )
+    mode = _search_mode(request.mode)
+    # Results are keyed by query text; a repeated query is answered once with its largest limit.
+    limits: dict[str, int] = {}
+    for item in request.queries:
+        q = _search_query(item.query)
+        limits[q] = max(limits.get(q, 0), _search_limit(item.limit))
+    queries = list(limits.items())
+    start = time.perf_counter()
+    timings: dict[str, float] = {}
+    results = await asyncio.to_thread(rag_store.search_many, user_id, queries, mode=mode, timings=timings)
+    body = {"results": {q: hits for (q, _limit), hits in zip(queries, results, strict=True)}}
+    return _with_timings(body, mode, timings, start)
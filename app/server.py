@@ -12,6 +12,7 @@ from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from app import rag_bulk
 from app.codex_runs import CodexRunStore
 from app.errors import normalize_error
 from app.indexing_jobs import IndexJobStore
@@ -102,6 +103,7 @@ async def lifespan(app: FastAPI):
             await app.state.codex_mcp_client.close()
         except Exception:
             pass
+        rag_bulk.shutdown()
 
 
 def create_app() -> FastAPI:
@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass, replace
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse
+
+import httpx
+
+from app.crawl_robots import RobotRules
+from app.net_safety import is_public_host
+
+# Concurrent crawl engine for `web_crawl` indexing jobs (`app/indexing_jobs.py`).
+#
+# URLs wait in a FIFO frontier (breadth-first, so depth limits hold) and are deduplicated when
+# they are enqueued, not when they come off the queue. `CRAWL_WORKERS` workers share one pooled
+# `httpx.AsyncClient`; politeness is a token bucket per host, so requests to a host start at most
+# once per interval however many workers are free, and fetch time counts toward the interval.
+# With auto-throttling the interval and the per-host concurrency follow the host's responses
+# instead (`AutoThrottle`). robots.txt rules (`app/crawl_robots.py`) filter links as they are
+# enqueued, and a `Crawl-delay` raises the host's interval (or the auto-throttle floor).
+# Recrawls start from a stored URL set instead and revalidate it with `If-None-Match` /
+# `If-Modified-Since`, so unchanged pages cost a 304 and no extraction.
+
+_DEFAULT_WORKERS = 4
+_MAX_WORKERS = 16
+_MAX_PAGE_CHARS = 1_000_000
+_REDIRECTS = {301, 302, 303, 307, 308}
+_BUSY = {429, 503}
+_GONE = {404, 410}
+_MAX_RETRIES = 2
+# Weight of the newest sample in the response latency moving average.
+_LATENCY_ALPHA = 0.3
+
+USER_AGENT = "autonomy-labs/1.0"
+
+
+def crawl_workers() -> int:
+    raw = (os.environ.get("CRAWL_WORKERS") or "").strip()
+    try:
+        n = int(raw) if raw else _DEFAULT_WORKERS
+    except ValueError:
+        n = _DEFAULT_WORKERS
+    return max(1, min(n, _MAX_WORKERS))
+
+
+def _retry_after(resp: httpx.Response) -> float | None:
+    raw = (resp.headers.get("retry-after") or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(raw) - datetime.now(UTC)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class ThrottleLimits:
+    """
+    Admin bounds for auto-throttled crawls (`app/crawl_settings.py`).
+    """
+
+    min_delay: float
+    max_delay: float
+    max_concurrency: int
+
+
+class TokenBucket:
+    """
+    `rate` requests per second with bursts of up to `burst`; `rate <= 0` means unlimited.
+    Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.latency: float | None = None
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+                self._tokens = 1.0
+                self._stamp = time.monotonic()
+            self._tokens -= 1.0
+
+    async def release(self, status: int | None, latency: float, retry_after: float | None = None) -> None:
+        """
+        Reports a finished request (`status` None for a transport error).
+        """
+        if status is not None:
+            self.latency = latency if self.latency is None else self.latency + _LATENCY_ALPHA * (latency - self.latency)
+
+    def effective_rate(self, concurrency: int) -> float | None:
+        """
+        Requests per second the host currently gets: capped by the rate and by how many
+        requests of the observed latency fit in flight.
+        """
+        caps = [self.rate] if self.rate > 0 else []
+        if self.latency:
+            caps.append(concurrency / self.latency)
+        return min(caps) if caps else None
+
+
+class AutoThrottle(TokenBucket):
+    """
+    Adaptive per-host pacing. The delay between requests tracks the latency average divided by
+    the concurrency, concurrency grows by one after a round of steady responses, and a 429/503
+    halves concurrency, doubles the delay and pauses for `Retry-After`. Everything stays inside
+    the admin `limits`.
+    """
+
+    def __init__(self, limits: ThrottleLimits, delay: float) -> None:
+        super().__init__(0.0)
+        self.limits = limits
+        self.concurrency = 1
+        self._active = 0
+        self._streak = 0
+        self._resume = 0.0
+        self._slots = asyncio.Condition()
+        self._set_delay(delay)
+
+    def _set_delay(self, delay: float) -> None:
+        self.delay = min(max(delay, self.limits.min_delay), self.limits.max_delay)
+        self.rate = 1.0 / self.delay if self.delay > 0 else 0.0
+
+    async def acquire(self) -> None:
+        async with self._slots:
+            while self._active >= self.concurrency:
+                await self._slots.wait()
+            self._active += 1
+        pause = self._resume - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await super().acquire()
+
+    async def release(self, status: int | None, latency: float, retry_after: float | None = None) -> None:
+        previous = self.latency
+        await super().release(status, latency)
+        if status in _BUSY:
+            wait = min(self.delay * 2 if retry_after is None else retry_after, self.limits.max_delay)
+            self._resume = max(self._resume, time.monotonic() + wait)
+            self._set_delay(max(self.delay * 2, wait))
+            self.concurrency = max(1, self.concurrency // 2)
+            self._streak = 0
+        elif status is None or status >= 500:
+            self._set_delay(max(self.delay * 2, self.limits.min_delay or 0.1))
+            self._streak = 0
+        elif self.latency is not None:
+            target = self.latency / self.concurrency
+            # Error pages say little about capacity: they may slow the pace, never speed it up.
+            if status < 400 or target > self.delay:
+                self._set_delay((self.delay + target) / 2)
+            if previous is not None and latency > 2 * previous:
+                self.concurrency = max(1, self.concurrency - 1)
+                self._streak = 0
+            elif status < 400:
+                self._streak += 1
+                if self._streak >= self.concurrency and self.concurrency < self.limits.max_concurrency:
+                    self.concurrency += 1
+                    self._streak = 0
+        async with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
+
+    def effective_rate(self, concurrency: int) -> float | None:
+        return super().effective_rate(self.concurrency)
+
+
+# Called with (url, depth, html) for every HTML page fetched; returns the page's raw hrefs.
+PageHandler = Callable[[str, int, str], Awaitable[Iterable[str]]]
+
+
+class Crawler:
+    """
+    Same-host crawl from `start_url` (or from `seeds`): at most `max_pages` URLs are fetched,
+    links are followed to `max_depth`. Counters (`visited`, `queued`, `errors`, `blocked`) can be
+    read while `run` is going.
+
+    `validators` maps URLs to the `etag` / `lastModified` of an earlier fetch; those URLs are
+    requested conditionally and end up in `unchanged` on a 304. Fresh validators of every page
+    handed to `on_page` are collected in `self.validators`. URLs answering 404/410 end up in
+    `gone`; transport failures and every other answer but 200/304 in `failed`.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        *,
+        start_url: str,
+        max_pages: int,
+        max_depth: int,
+        interval: float,
+        workers: int | None = None,
+        limits: ThrottleLimits | None = None,
+        robots: RobotRules | None = None,
+        seeds: Iterable[str] | None = None,
+        validators: dict[str, dict[str, str]] | None = None,
+    ) -> None:
+        self.client = client
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        self.robots = robots
+        delay = robots.crawl_delay if robots is not None else None
+        self.interval = max(interval, delay or 0.0)
+        if limits is not None and delay:
+            limits = replace(limits, min_delay=max(limits.min_delay, delay), max_delay=max(limits.max_delay, delay))
+        self.limits = limits
+        self.workers = workers or crawl_workers()
+        self.netloc = urlparse(start_url).netloc
+        self.visited = 0
+        self.errors = 0
+        self.blocked = 0
+        self.validators: dict[str, dict[str, str]] = {}
+        self.unchanged: list[str] = []
+        self.failed: list[str] = []
+        self.gone: list[str] = []
+        self._known = validators or {}
+        self._frontier: deque[tuple[str, int]] = deque()
+        self._seen: set[str] = set()
+        self._buckets: dict[str, TokenBucket] = {}
+        self._retries: dict[str, int] = {}
+        self._active = 0
+        self._cond = asyncio.Condition()
+        for url in seeds if seeds is not None else [start_url]:
+            self.enqueue(url, 0)
+
+    @property
+    def queued(self) -> int:
+        return len(self._frontier)
+
+    def enqueue(self, url: str, depth: int) -> None:
+        p = urlparse(url)
+        if p.scheme not in {"https", "http"} or p.netloc != self.netloc:
+            return
+        url = p._replace(fragment="").geturl()
+        if url in self._seen:
+            return
+        self._seen.add(url)
+        if self.robots is not None and not self.robots.allowed(url):
+            self.blocked += 1
+            return
+        self._frontier.append((url, depth))
+
+    def _bucket(self, host: str) -> TokenBucket:
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            if self.limits is not None:
+                bucket = AutoThrottle(self.limits, self.interval)
+            else:
+                bucket = TokenBucket(1.0 / self.interval if self.interval > 0 else 0.0)
+            self._buckets[host] = bucket
+        return bucket
+
+    def effective_rate(self) -> float | None:
+        """
+        Current requests per second summed over hosts; None until there is something to measure.
+        """
+        rates = [r for r in (b.effective_rate(self.workers) for b in self._buckets.values()) if r is not None]
+        return round(sum(rates), 2) if rates else None
+
+    def _conditional_headers(self, url: str) -> dict[str, str]:
+        known = self._known.get(url) or {}
+        headers = {}
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("lastModified"):
+            headers["If-Modified-Since"] = known["lastModified"]
+        return headers
+
+    async def run(self, on_page: PageHandler, on_progress: Callable[[], Awaitable[None]] | None = None) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(self.workers):
+                tg.create_task(self._worker(on_page, on_progress))
+
+    async def _worker(self, on_page: PageHandler, on_progress: Callable[[], Awaitable[None]] | None) -> None:
+        while True:
+            async with self._cond:
+                # An empty frontier is only final once no other worker can still add links.
+                while not self._frontier and self._active and self.visited < self.max_pages:
+                    await self._cond.wait()
+                if not self._frontier or self.visited >= self.max_pages:
+                    self._cond.notify_all()
+                    return
+                url, depth = self._frontier.popleft()
+                self.visited += 1
+                self._active += 1
+            try:
+                if on_progress is not None:
+                    await on_progress()
+                await self._visit(url, depth, on_page)
+            finally:
+                async with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+    async def _visit(self, url: str, depth: int, on_page: PageHandler) -> None:
+        host = urlparse(url).hostname or ""
+        if not await asyncio.to_thread(is_public_host, host):
+            return
+        bucket = self._bucket(host)
+        await bucket.acquire()
+        status, retry_after, start = None, None, time.monotonic()
+        try:
+            resp = await self.client.get(url, headers=self._conditional_headers(url))
+            status, retry_after = resp.status_code, _retry_after(resp)
+        except httpx.HTTPError:
+            self.errors += 1
+            self.failed.append(url)
+            return
+        finally:
+            await bucket.release(status, time.monotonic() - start, retry_after)
+        if resp.status_code in _BUSY and self.limits is not None:
+            # Throttled crawls come back to a busy URL later instead of losing it.
+            retries = self._retries.get(url, 0)
+            if retries < _MAX_RETRIES:
+                self._retries[url] = retries + 1
+                self.visited -= 1
+                self._frontier.append((url, depth))
+                return
+        if resp.status_code == 304 and url in self._known:
+            self.unchanged.append(url)
+            return
+        if resp.status_code in _REDIRECTS:
+            loc = resp.headers.get("location") or ""
+            if loc:
+                self.enqueue(urljoin(url, loc), depth)
+        if resp.status_code in _GONE:
+            self.gone.append(url)
+        elif resp.status_code != 200:
+            # Possibly transient (5xx, 429, a redirect, an auth wall): not proof the page is gone.
+            self.failed.append(url)
+        if resp.status_code != 200:
+            return
+        if "text/html" not in (resp.headers.get("content-type") or "").lower():
+            return
+        content = resp.text[:_MAX_PAGE_CHARS]
+        validators = {"etag": resp.headers.get("etag"), "lastModified": resp.headers.get("last-modified")}
+        self.validators[url] = {k: v for k, v in validators.items() if v}
+        hrefs = await on_page(url, depth, content)
+        if depth < self.max_depth:
+            for href in hrefs:
+                self.enqueue(urljoin(url, href), depth + 1)
@@ -0,0 +1,92 @@
+"""
+Benchmarks BM25 top-k retrieval over a synthetic corpus: exhaustive scoring + sort versus
+MaxScore pruning (`rag_index.bm25_top_k`), and checks both return identical results.
+
+    python -m scripts.bench_rag_topk --chunks 100000 --queries 200 --k 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from app import rag_analyzer, rag_binfile, rag_index
+
+
+def _build(root: Path, chunks: int, vocab: list[str], chunk_len: int, seed: int) -> rag_binfile.ArrayFile:
+    rng = np.random.default_rng(seed)
+    hashes = np.array([rag_analyzer.term_hash(w) for w in vocab], dtype=np.uint64)
+    # Zipf-like term frequencies, as in natural text.
+    weights = 1.0 / np.arange(1, len(vocab) + 1) ** 1.1
+    weights /= weights.sum()
+    postings = rag_index._empty_postings(1)
+    stats = []
+    for pos in range(chunks):
+        ids = hashes[rng.choice(len(vocab), size=chunk_len, p=weights)]
+        tfs = Counter(ids.tolist())
+        # Positions are irrelevant to scoring; store one placeholder triple per occurrence.
+        stats.append((pos, chunk_len, {int(h): bytes(12 * tf) for h, tf in tfs.items()}))
+    rag_index._add_postings(postings, "bench", stats)
+    path = root / "postings.bin"
+    rag_binfile.write_arrays(path, rag_index._postings_arrays(postings), generation=1)
+    f = rag_binfile.open_arrays(path)
+    assert f is not None
+    return f
+
+
+def _queries(vocab: list[str], n: int, seed: int) -> list[list[str]]:
+    # Mix one rarer term with common ones (vocab is ordered by frequency); that is where
+    # pruning pays off.
+    rng = np.random.default_rng(seed + 1)
+    out = []
+    for _ in range(n):
+        picks = [*rng.choice(50, size=int(rng.integers(1, 4))), rng.integers(50, 2000)]
+        out.append([vocab[int(i)] for i in picks])
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100_000)
+    parser.add_argument("--vocab", type=int, default=30_000)
+    parser.add_argument("--chunk-len", type=int, default=150)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vocab = [f"w{i}" for i in range(args.vocab)]
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        f = _build(Path(tmp), args.chunks, vocab, args.chunk_len, args.seed)
+        print(f"built {args.chunks} chunks, {len(f['post_slot'])} postings in {time.perf_counter() - t0:.1f}s")
+        texts = _queries(vocab, args.queries, args.seed)
+
+        t0 = time.perf_counter()
+        exhaustive = []
+        for terms in texts:
+            slots, scores = rag_index.bm25_scores(f, terms)
+            order = np.lexsort((slots, -scores))[: args.k]
+            exhaustive.append((slots[order], scores[order]))
+        t_full = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        pruned = [rag_index.bm25_top_k(f, terms, args.k) for terms in texts]
+        t_topk = time.perf_counter() - t0
+
+        for (a_slots, a_scores), (b_slots, b_scores) in zip(exhaustive, pruned, strict=True):
+            assert a_slots.tolist() == b_slots.tolist() and a_scores.tolist() == b_scores.tolist()
+
+        per = 1000.0 / len(texts)
+        print(f"exhaustive: {t_full * per:.2f} ms/query")
+        print(f"maxscore:   {t_topk * per:.2f} ms/query  ({t_full / t_topk:.1f}x)")
+        print("results identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -678,7 +678,7 @@ let supabase;
                 const indexed = p?.indexedPages ?? 0;
                 const params = j?.params || {};
                 const detail = (() => {
-                    if (j?.type === 'web_crawl') return params?.startUrl || '';
+                    if (j?.type === 'web_crawl' || j?.type === 'recrawl') return params?.startUrl || '';
                     if (j?.type === 'github_repo') {
                         const ref = params?.ref ? `@${params.ref}` : '';
                         const pref = params?.pathPrefix ? ` • ${params.pathPrefix}` : '';
@@ -703,10 +703,13 @@ let supabase;
                 } else if (j?.status === 'succeeded') {
                     const result = j?.result || {};
                     const ragDocId = result?.ragDoc?.id;
-                    if (ragDocId) {
+                    const summary = result?.collection
+                        ? `Indexed ${result?.pages ?? 0} pages into ${result.collection}`
+                        : ragDocId ? `Indexed into RAG doc: ${ragDocId}` : '';
+                    if (summary) {
                         const ok = document.createElement('div');
                         ok.className = 'text-xs text-green-300 mt-1';
-                        ok.textContent = `Indexed into RAG doc: ${ragDocId}`;
+                        ok.textContent = summary;
                         left.appendChild(ok);
                     }
                 }
@@ -0,0 +1,487 @@
+import json
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from app import rag_analyzer, rag_binfile, rag_dedup, rag_index, rag_segments, rag_store, rag_vectors
+
+
+@pytest.fixture()
+def user_dir(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Iterator[Path]:
+    monkeypatch.setattr(rag_index, "user_data_dir", lambda user_id: tmp_path / user_id)
+    rag_store.clear_search_cache()
+    yield tmp_path / "u1"
+    # Background compactions must finish before the next test swaps the data directory.
+    for user_id in list(rag_index._WRITERS):
+        rag_index.flush(user_id)
+
+
+def test_search_ranks_with_bm25_and_splits_multiword_queries(user_dir: Path):
+    rag_index.add_document("u1", name="a", text="The quick brown fox jumps over the lazy dog.")
+    rag_index.add_document("u1", name="b", text="Foxes are quick. A quick fox is a happy fox.")
+    rag_index.add_document("u1", name="c", text="Nothing relevant here at all.")
+
+    results = rag_index.search("u1", "quick fox", limit=5)
+    assert [r["document"]["name"] for r in results] == ["b", "a"]
+    assert results[0]["score"] > results[1]["score"] > 0
+    assert "fox" in results[0]["excerpt"].lower()
+
+
+def test_delete_removes_postings(user_dir: Path):
+    doc = rag_index.add_document("u1", name="a", text="alpha beta gamma")
+    rag_index.add_document("u1", name="b", text="beta delta")
+
+    assert rag_index.delete_document("u1", doc["id"])["deleted"] == 1
+    assert rag_index.search("u1", "alpha") == []
+    assert [r["document"]["name"] for r in rag_index.search("u1", "beta")] == ["b"]
+
+
+def test_deletes_tombstone_until_compaction(user_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("RAG_COMPACT_DEAD_FRACTION", "0.5")
+    docs = [rag_index.add_document("u1", name=str(i), text=f"shared term{i}") for i in range(4)]
+    stamp = rag_index.postings_path("u1").stat().st_mtime_ns
+
+    rag_index.delete_document("u1", docs[0]["id"])
+    rag_index.flush("u1")
+    assert rag_index.postings_path("u1").stat().st_mtime_ns == stamp
+    assert rag_index.load_manifest("u1")["tombstones"] == [docs[0]["id"]]
+    assert sorted(r["document"]["name"] for r in rag_index.search("u1", "shared", limit=3)) == ["1", "2", "3"]
+
+    rag_index.delete_document("u1", docs[1]["id"])
+    rag_index.delete_document("u1", docs[2]["id"])
+    rag_index.flush("u1")
+    f = rag_binfile.open_arrays(rag_index.postings_path("u1"))
+    assert len(f["slot_doc"]) == 1 and rag_index.load_manifest("u1")["tombstones"] == []
+    assert [r["document"]["name"] for r in rag_index.search("u1", "shared")] == ["3"]
+    assert rag_index.search("u1", "term1") == []
+    rebuilt = rag_index._postings_arrays(rag_index.build_postings("u1", rag_index.load_manifest("u1")))
+    for name, a in rebuilt.items():
+        assert np.array_equal(f[name], a), name
+
+
+def test_concurrent_writes_are_serialized(user_dir: Path):
+    threads = [
+        threading.Thread(target=rag_index.add_document, args=("u1",), kwargs={"name": str(i), "text": f"doc{i} common"})
+        for i in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    manifest = rag_index.load_manifest("u1")
+    assert len(manifest["documents"]) == 8 and manifest["generation"] == 8
+    assert len(rag_index.search("u1", "common", limit=10)) == 8
+
+
+def test_postings_are_rebuilt_for_existing_indexes(user_dir: Path):
+    rag_index.add_document("u1", name="a", text="legacy corpus text")
+    rag_index.postings_path("u1").unlink()
+
+    results = rag_index.search("u1", "corpus")
+    assert [r["document"]["name"] for r in results] == ["a"]
+    assert rag_index.postings_path("u1").exists()
+
+
+def test_index_cache_invalidates_on_external_write(user_dir: Path):
+    rag_index.add_document("u1", name="a", text="cached corpus")
+    first = rag_index.load_manifest("u1")
+    assert rag_index.load_manifest("u1") is first
+
+    path = rag_index.manifest_path("u1")
+    path.write_text('{"version": 2, "documents": []}\n', encoding="utf-8")
+    assert rag_index.list_documents("u1") == []
+    assert rag_index.search("u1", "cached") == []
+
+
+def test_index_cache_evicts_least_recently_used(user_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    rag_index.add_document("u1", name="a", text="first user")
+    rag_index.add_document("u2", name="b", text="second user")
+    rag_index.clear_cache()
+    monkeypatch.setenv("RAG_INDEX_CACHE_BYTES", str(rag_index.manifest_path("u2").stat().st_size))
+
+    rag_index.load_manifest("u1")
+    rag_index.load_manifest("u2")
+    assert list(rag_index._CACHE) == [str(rag_index.manifest_path("u2"))]
+
+    # Decoded postings are charged at their estimated in-memory size, not the file size.
+    monkeypatch.delenv("RAG_INDEX_CACHE_BYTES")
+    rag_index.add_document("u1", name="c", text=" ".join(f"word{i}" for i in range(500)))
+    path = rag_index.postings_path("u1")
+    assert rag_index._CACHE[str(path)][3] > 2 * path.stat().st_size
+
+
+def test_legacy_index_is_split_into_manifest_and_shards(user_dir: Path):
+    legacy = {
+        "version": 1,
+        "documents": [
+            {
+                "id": "d1",
+                "name": "old.txt",
+                "createdAt": "2025-01-01T00:00:00Z",
+                "bytes": 11,
+                "path": "d1.txt",
+                "chunks": [{"id": "c1", "text": "legacy text"}],
+            }
+        ],
+    }
+    rag_index.legacy_index_path("u1").write_text(json.dumps(legacy), encoding="utf-8")
+
+    # Concurrent first loads migrate once, and none of them sees an empty store.
+    seen: list[list[dict]] = []
+    threads = [threading.Thread(target=lambda: seen.append(rag_index.list_documents("u1"))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [[d["chunks"] for d in docs] for docs in seen] == [[1]] * 8
+    assert not rag_index.legacy_index_path("u1").exists()
+    manifest = json.loads(rag_index.manifest_path("u1").read_text(encoding="utf-8"))
+    assert manifest["documents"][0]["chunks"] == 1
+    assert rag_index.load_chunks("u1", "d1") == [{"id": "c1", "text": "legacy text"}]
+    assert rag_index.search("u1", "legacy")[0]["chunkId"] == "c1"
+
+
+def test_sqlite_backend_round_trip(user_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    rag_index.add_document("u1", name="json-doc", text="imported from the json store")
+    monkeypatch.setenv("RAG_BACKEND", "sqlite")
+
+    added = rag_store.add_document("u1", name="b", text="Foxes are quick. A quick fox is a happy fox.")
+    rag_store.add_document("u1", name="c", text="The quick brown fox.")
+    assert [d["name"] for d in rag_store.list_documents("u1")] == ["json-doc", "b", "c"]
+
+    results = rag_store.search("u1", "quick fox")
+    assert [r["document"]["name"] for r in results] == ["b", "c"]
+    assert rag_store.search("u1", "imported")[0]["document"]["name"] == "json-doc"
+    assert rag_store.search("u1", 'fox" OR *') != []
+
+    assert rag_store.delete_document("u1", added["id"])["deleted"] == 1
+    assert [r["document"]["name"] for r in rag_store.search("u1", "fox")] == ["c"]
+
+
+def test_sqlite_reads_do_not_wait_for_an_open_writer(user_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("RAG_BACKEND", "sqlite")
+    rag_store.add_document("u1", name="a", text="the quick brown fox")
+
+    writer = rag_store.begin_document("u1", name="b", source="b")
+    writer.write("a slow upload about foxes")
+    start = time.perf_counter()
+    assert [d["name"] for d in rag_store.list_documents("u1")] == ["a"]
+    assert [r["document"]["name"] for r in rag_store.search("u1", "fox")] == ["a"]
+    # A second database connection may even commit in between.
+    rag_store.add_document("u1", name="c", text="another fox")
+    assert time.perf_counter() - start < 1.0
+    writer.commit()
+    assert [d["name"] for d in rag_store.list_documents("u1")] == ["a", "c", "b"]
+
+
+def _reference_chunks(text: str, max_chars: int, overlap: int) -> list[str]:
+    t = text.strip()
+    out = []
+    i = 0
+    while i < len(t):
+        j = min(len(t), i + max_chars)
+        if t[i:j].strip():
+            out.append(t[i:j].strip())
+        if j >= len(t):
+            break
+        i = max(0, j - overlap)
+    return out
+
+
+@pytest.mark.parametrize("piece_size", [1, 7, 50, 10_000])
+def test_stream_chunker_matches_whole_text_chunking(piece_size: int):
+    text = "  \n" + " ".join(f"word{i}" + ("\n\n" if i % 17 == 0 else "") for i in range(400)) + "   \n\t "
+    chunker = rag_index.StreamChunker(max_chars=90, overlap=12)
+    out: list[str] = []
+    for i in range(0, len(text), piece_size):
+        out.extend(chunker.feed(text[i : i + piece_size]))
+    out.extend(chunker.finish())
+    assert out == _reference_chunks(text, 90, 12)
+
+
+def test_vector_search_uses_ingest_time_embeddings(user_dir: Path):
+    rag_store.add_document("u1", name="cats", text="Cats purr and chase mice around the house.")
+    rag_store.add_document("u1", name="rust", text="The borrow checker enforces ownership rules in Rust.")
+    legacy = rag_index.add_document("u1", name="legacy", text="Ownership and borrowing are Rust concepts.")
+
+    results = rag_store.search("u1", "rust ownership", limit=3, mode="vector")
+    assert {r["document"]["name"] for r in results[:2]} == {"rust", "legacy"}
+    assert results[0]["score"] <= 1.0
+
+    rag_store.delete_document("u1", legacy["id"])
+    names = [r["document"]["name"] for r in rag_store.search("u1", "rust ownership", mode="vector")]
+    assert "legacy" not in names and names[0] == "rust"
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_compressed_storage_stores_offsets_and_decompresses_lazily(
+    user_dir: Path, monkeypatch: pytest.MonkeyPatch, codec: str
+):
+    sections = [" ".join(f"s{n}w{i}" for i in range(4000)) + " zebra" for n in range(6)]
+
+    def ingest(user_id: str, sections: list[str]) -> dict:
+        writer = rag_store.begin_document(user_id, name="book", source="book")
+        for section in sections:
+            for i in range(0, len(section), 5000):
+                writer.write(section[i : i + 5000])
+            writer.end_section()
+        return writer.commit()
+
+    plain = ingest("u2", sections)
+    monkeypatch.setenv("RAG_STORAGE_COMPRESSION", codec)
+    doc = ingest("u1", sections)
+
+    shard = json.loads(rag_index.shard_path("u1", doc["id"], rag_index._current_shard("u1", doc["id"])).read_text())
+    assert all("text" not in c for c in shard["chunks"])
+    stored = rag_index.rag_dir("u1") / shard["text"]
+    assert stored.stat().st_size < sum(map(len, sections)) // 2
+    assert not (rag_index.rag_dir("u1") / f"{doc['id']}.txt").exists()
+    assert rag_index.list_documents("u1")[0]["bytes"] == sum(map(len, sections))
+    texts = [c["text"] for c in rag_index.load_chunks("u1", doc["id"])]
+    assert texts == [c["text"] for c in rag_index.load_chunks("u2", plain["id"])]
+
+    decompressed: list[int] = []
+    segment = rag_segments.SegmentFile.segment
+    monkeypatch.setattr(rag_segments.SegmentFile, "segment", lambda f, k: decompressed.append(k) or segment(f, k))
+    results = rag_index.search("u1", "s3w17", limit=1)
+    assert results[0]["excerpt"].startswith("s3w") and "s3w17" in results[0]["excerpt"]
+    assert len(decompressed) <= 2
+
+    # A re-ingest writes a new text file and drops the old one; a delete removes both.
+    ingest("u1", sections[:3])
+    shard = json.loads(rag_index.shard_path("u1", doc["id"], rag_index._current_shard("u1", doc["id"])).read_text())
+    assert not stored.exists() and (rag_index.rag_dir("u1") / shard["text"]).exists()
+    assert [r["document"]["name"] for r in rag_index.search("u1", "s2w5")] == ["book"]
+    assert rag_index.search("u1", "s4w5") == []
+    rag_index.delete_document("u1", doc["id"])
+    assert not list(rag_index.rag_dir("u1").glob("*.txtz"))
+
+    prepared = rag_index.prepare_document("notes", "  alpha beta gamma  ")
+    added = rag_store.add_documents("u1", [prepared])[0]
+    assert rag_index.load_chunk("u1", added["id"], 0) == {
+        "id": rag_index.ChunkIds(added["id"])("alpha beta gamma"),
+        "text": "alpha beta gamma",
+    }
+
+
+def test_array_file_round_trip_and_stale_postings_rebuild(user_dir: Path):
+    path = user_dir / "arrays.bin"
+    path.parent.mkdir(parents=True)
+    offsets, blob = rag_binfile.pack_strings(["a", "ünï", ""])
+    rag_binfile.write_arrays(path, {"off": offsets, "blob": blob, "f": np.arange(3.0)}, generation=7)
+    f = rag_binfile.open_arrays(path)
+    assert f is not None and f.generation == 7
+    assert rag_binfile.unpack_strings(f["off"], f["blob"]) == ["a", "ünï", ""]
+    assert f["f"].tolist() == [0.0, 1.0, 2.0]
+
+    # Concurrent writers each use a temp file of their own.
+    threads = [
+        threading.Thread(target=rag_binfile.write_arrays, args=(path, {"f": np.full(4096, float(i))})) for i in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    f = rag_binfile.open_arrays(path)
+    assert f is not None and len(set(f["f"].tolist())) == 1
+    assert not list(user_dir.glob("*.tmp"))
+
+    rag_index.add_document("u1", name="a", text="stale postings")
+    manifest = rag_index.load_manifest("u1")
+    manifest["postingsGeneration"] += 1
+    rag_index.save_manifest("u1", manifest)
+    assert [r["document"]["name"] for r in rag_index.search("u1", "stale")] == ["a"]
+    assert rag_binfile.open_arrays(rag_index.postings_path("u1")).generation == manifest["postingsGeneration"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_reingest_by_source_only_touches_changed_sections(
+    user_dir: Path, monkeypatch: pytest.MonkeyPatch, backend: str
+):
+    monkeypatch.setenv("RAG_BACKEND", backend)
+
+    def ingest(sections: list[str]) -> dict:
+        writer = rag_store.begin_document("u1", name="repo", source="https://example.com/repo")
+        for section in sections:
+            writer.write(section)
+            writer.end_section()
+        return writer.commit()
+
+    first = ingest(["alpha apples", "beta bananas", "gamma grapes"])
+    before = {c["text"]: c["id"] for c in rag_store._backend().load_chunks("u1", first["id"])}
+    second = ingest(["alpha apples", "delta dates", "gamma grapes"])
+
+    assert second["id"] == first["id"]
+    assert (second["added"], second["removed"]) == (1, 1)
+    after = {c["text"]: c["id"] for c in rag_store._backend().load_chunks("u1", first["id"])}
+    assert list(after) == ["alpha apples", "delta dates", "gamma grapes"]
+    assert after["gamma grapes"] == before["gamma grapes"]
+    assert len(rag_store.list_documents("u1")) == 1
+    assert rag_store.search("u1", "bananas") == []
+    assert rag_store.search("u1", "dates")[0]["chunkId"] == after["delta dates"]
+    assert rag_vectors.generation("u1") == rag_store.generation("u1")
+    assert rag_store.search("u1", "grapes", mode="vector")[0]["chunkId"] == after["gamma grapes"]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_second_writer_for_a_source_is_rejected_and_bad_shards_stay_local(
+    user_dir: Path, monkeypatch: pytest.MonkeyPatch, backend: str
+):
+    monkeypatch.setenv("RAG_BACKEND", backend)
+    rag_store.add_document("u1", name="page", text="first version", source="S")
+    rag_store.add_document("u1", name="other", text="unrelated otter notes")
+
+    writer = rag_store.begin_document("u1", name="page", source="S")
+    writer.write("second version")
+    with pytest.raises(HTTPException) as e:
+        rag_store.begin_document("u1", name="page", source="S")
+    assert e.value.status_code == 409
+    doc_id = writer.commit()["id"]
+    assert [c["text"] for c in rag_store.load_chunks("u1", doc_id)] == ["second version"]
+    # The claim is released on commit and on abort.
+    rag_store.begin_document("u1", name="page", source="S").abort()
+    rag_store.add_document("u1", name="page", text="third version", source="S")
+
+    if backend == "json":
+        rag_index.shard_path("u1", doc_id, rag_index._current_shard("u1", doc_id)).write_text(
+            '[{"id": "x" "text"', encoding="utf-8"
+        )
+        assert rag_store.load_chunks("u1", doc_id) == []
+        assert rag_store.search("u1", "otter")[0]["document"]["name"] == "other"
+    rag_index.flush("u1")
+    assert not list(user_dir.rglob("*.tmp"))
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_reingest_matches_source_within_its_collection(user_dir: Path, monkeypatch: pytest.MonkeyPatch, backend: str):
+    monkeypatch.setenv("RAG_BACKEND", backend)
+    url = "https://github.com/o/r"
+    repo = rag_store.add_document("u1", name="GitHub: o/r@main", text="repository files", source=url)
+    # A crawl page with the same URL is a document of its own, and both can be written at once.
+    writer = rag_store.begin_document("u1", name="page", source=url, collection="https://github.com/")
+    writer.write("crawled page")
+    rag_store.begin_document("u1", name="GitHub: o/r@main", source=url).abort()
+    page = writer.commit()
+    assert page["id"] != repo["id"]
+
+    again = rag_store.add_document(
+        "u1", name="page", text="crawled page v2", source=url, collection="https://github.com/"
+    )
+    assert again["id"] == page["id"]
+    assert [c["text"] for c in rag_store.load_chunks("u1", repo["id"])] == ["repository files"]
+
+
+def test_a_published_shard_stays_invisible_until_the_manifest_points_at_it(
+    user_dir: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setenv("RAG_BACKEND", "json")
+    rag_store.add_document("u1", name="page", text="zebra stripes", source="S")
+    writer = rag_store.begin_document("u1", name="page", source="S")
+    writer.write("okapi stripes")
+    writer._publish()
+    # The postings still describe the old shard, and searches keep reading it.
+    assert rag_store.search("u1", "zebra")[0]["excerpt"] == "zebra stripes"
+    writer.abort()
+    assert rag_store.search("u1", "zebra")[0]["excerpt"] == "zebra stripes"
+    assert len(list(user_dir.rglob("chunks/*.json"))) == 1
+
+
+def test_search_results_are_cached_until_the_generation_changes(user_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    rag_store.add_document("u1", name="a", text="cached fox")
+    first = rag_store.search("u1", "Fox cached")
+    calls = []
+    monkeypatch.setattr(rag_index, "search_many", lambda *a, **kw: calls.append(a) or [[]])
+
+    assert rag_store.search("u1", "fox   CACHED") is first
+    assert calls == []
+
+    rag_store.add_document("u1", name="b", text="another fox")
+    assert rag_store.search("u1", "fox cached") == []
+    assert len(calls) == 1
+
+    # So do analyzer and embedder changes.
+    monkeypatch.setenv("RAG_STEMMING", "1")
+    rag_store.search("u1", "fox cached")
+    assert len(calls) == 2
+    vector = rag_store.search("u1", "fox", mode="vector")
+    assert rag_store.search("u1", "fox", mode="vector") is vector
+    monkeypatch.setattr(rag_vectors, "embedder_key", lambda: "other:8:0")
+    assert rag_store.search("u1", "fox", mode="vector") is not vector
+
+
+def test_analyzer_folds_drops_stopwords_and_optionally_stems(user_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    assert rag_analyzer.tokenize("Ünïcode CAFÉ, naïve-text") == ["unicode", "cafe", "naive", "text"]
+    assert rag_analyzer.get_analyzer(stemming=False).terms("The foxes of the city") == ["foxes", "city"]
+    assert rag_analyzer.get_analyzer(stemming=True).terms("The foxes of the cities") == ["foxe", "city"]
+
+    rag_index.add_document("u1", name="a", text="A café with many cities nearby.")
+    assert rag_index.search("u1", "CAFE")[0]["document"]["name"] == "a"
+    assert rag_index.search("u1", "the of") == []
+    assert rag_index.search("u1", "city") == []
+
+    monkeypatch.setenv("RAG_STEMMING", "1")
+    assert rag_index.search("u1", "city")[0]["document"]["name"] == "a"
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_phrase_queries_and_highlights_come_from_positions(
+    user_dir: Path, monkeypatch: pytest.MonkeyPatch, backend: str
+):
+    monkeypatch.setenv("RAG_BACKEND", backend)
+    filler = "lorem ipsum dolor sit amet " * 30
+    rag_store.add_document("u1", name="far", text=f"The quick {filler} fox {filler}")
+    rag_store.add_document("u1", name="near", text=f"{filler} A quick brown fox jumps. {filler}")
+
+    results = rag_store.search("u1", "quick brown fox")
+    assert [r["document"]["name"] for r in results] == ["near", "far"]
+    top = results[0]
+    assert len(top["excerpt"]) <= 360
+    assert [top["excerpt"][a:b] for a, b in top["highlights"]] == ["quick", "brown", "fox"]
+    assert len(results[1]["highlights"]) == 1
+
+    phrase = rag_store.search("u1", '"quick brown" fox')
+    assert [r["document"]["name"] for r in phrase] == ["near"]
+    assert rag_store.search("u1", '"brown quick"') == []
+
+
+def test_top_k_pruning_matches_exhaustive_scoring(user_dir: Path):
+    rng = np.random.default_rng(7)
+    vocab = [f"w{i}" for i in range(400)]
+    weights = 1.0 / np.arange(1, len(vocab) + 1)
+    words = rng.choice(vocab, size=60_000, p=weights / weights.sum())
+    rag_index.add_document("u1", name="zipf", text=" ".join(words))
+    f = rag_index._open_postings("u1", rag_index.load_manifest("u1"))
+
+    for _ in range(50):
+        terms = list(rng.choice(vocab[:80], size=int(rng.integers(1, 6))))
+        k = int(rng.integers(1, 30))
+        slots, scores = rag_index.bm25_scores(f, terms)
+        order = np.lexsort((slots, -scores))[:k]
+        top_slots, top_scores = rag_index.bm25_top_k(f, terms, k)
+        assert top_slots.tolist() == slots[order].tolist()
+        assert top_scores.tolist() == scores[order].tolist()
+
+
+def test_near_duplicate_pages_are_dropped_across_crawls(user_dir: Path):
+    body = " ".join(f"paragraph {i} explains how the widget frobnicates its inputs" for i in range(40))
+    pages = [
+        ("https://a.test/post", body),
+        ("https://a.test/post?print=1", body + " printed on paper"),
+        ("https://a.test/other", "an entirely different article about gardening tomatoes " * 20),
+        ("https://a.test/short", "tiny page"),
+    ]
+    kept, dropped = rag_dedup.PageFilter("u1", collection="https://a.test/").filter(pages)
+    assert [url for url, _text in kept] == ["https://a.test/post", "https://a.test/other", "https://a.test/short"]
+    assert dropped == [{"url": "https://a.test/post?print=1", "duplicateOf": "https://a.test/post"}]
+
+    # Signatures of live collections carry over to other crawls; re-crawling a collection replaces its own.
+    rag_store.add_document("u1", name="site", text=body, source="https://a.test/")
+    kept, dropped = rag_dedup.PageFilter("u1", collection="https://b.test/").filter([("https://b.test/copy", body)])
+    assert kept == [] and dropped[0]["duplicateOf"] == "https://a.test/post"
+    kept, _dropped = rag_dedup.PageFilter("u1", collection="https://a.test/").filter(pages[:1])
+    assert kept == pages[:1]
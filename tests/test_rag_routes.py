@@ -0,0 +1,302 @@
+import asyncio
+import io
+import tarfile
+import time
+import zipfile
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import rag_bulk, rag_index, rag_store, rag_vectors
+from app.routes import chat as chat_routes
+from app.routes import rag as rag_routes
+from app.server import create_app
+
+
+@pytest.fixture()
+def client(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> TestClient:
+    monkeypatch.setenv("SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.setenv("SUPABASE_KEY", "dummy")
+    monkeypatch.setenv("ENABLE_INDEXING", "1")
+    monkeypatch.setattr(rag_index, "user_data_dir", lambda user_id: tmp_path / user_id)
+    rag_store.clear_search_cache()
+
+    async def _user(_request):
+        return {"id": "u1"}
+
+    monkeypatch.setattr(rag_routes, "require_user_from_request", _user)
+    return TestClient(create_app())
+
+
+def test_upload_streams_into_index(client: TestClient):
+    body = ("héllo streaming world " * 400).encode("utf-8")
+    res = client.post("/api/rag/documents/upload", files={"file": ("a.txt", body, "text/plain")})
+    assert res.status_code == 200
+    assert res.json()["chunks"] == len(rag_index.chunk_text(body.decode("utf-8")))
+
+    docs = client.get("/api/rag/documents").json()["documents"]
+    assert docs[0]["bytes"] == len(body)
+    res = client.post("/api/rag/search", json={"query": "streaming"})
+    assert res.json()["results"][0]["document"]["name"] == "a.txt"
+
+
+def test_upload_falls_back_to_latin1(client: TestClient):
+    res = client.post("/api/rag/documents/upload", files={"file": ("b.txt", b"caf\xe9 au lait", "text/plain")})
+    assert res.status_code == 200
+    assert client.post("/api/rag/search", json={"query": "café"}).json()["results"]
+
+
+def test_upload_rejects_oversized_and_blank_files(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("RAG_MAX_UPLOAD_BYTES", "16")
+    res = client.post("/api/rag/documents/upload", files={"file": ("c.txt", b"x" * 17, "text/plain")})
+    assert res.status_code == 413
+
+    res = client.post("/api/rag/documents/upload", files={"file": ("d.txt", b"   \n ", "text/plain")})
+    assert res.status_code == 400
+    assert client.get("/api/rag/documents").json()["documents"] == []
+
+
+def test_oversized_upload_bodies_are_not_read_in_full(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("RAG_MAX_UPLOAD_BYTES", "16")
+    sent: list[int] = []
+
+    async def body():
+        yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="big.txt"\r\n\r\n'
+        for _ in range(64):
+            sent.append(1)
+            yield b"x" * 16 * 1024
+        yield b"\r\n--b--\r\n"
+
+    async def post(**kwargs) -> httpx.Response:
+        transport = httpx.ASGITransport(app=client.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.post("/api/rag/documents/upload", **kwargs)
+
+    headers = {"content-type": "multipart/form-data; boundary=b"}
+    # No Content-Length: reading stops once the cap is crossed.
+    res = asyncio.run(post(content=body(), headers=headers))
+    assert res.status_code == 413
+    assert len(sent) < 64
+
+    # A declared length over the cap is refused before the body is read.
+    sent.clear()
+    res = asyncio.run(post(content=body(), headers={**headers, "content-length": str(1024 * 1024)}))
+    assert res.status_code == 413
+    assert sent == []
+
+
+def _archive(kind: str, files: dict[str, bytes]) -> bytes:
+    buf = io.BytesIO()
+    if kind == "zip":
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for path, data in files.items():
+                zf.writestr(path, data)
+    else:
+        with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+            for path, data in files.items():
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize(("kind", "workers"), [("zip", "0"), ("tar.gz", "0"), ("zip", "2")])
+def test_bulk_upload_indexes_archive_in_one_commit(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch, kind: str, workers: str
+):
+    monkeypatch.setenv("RAG_BULK_WORKERS", workers)
+    client.post("/api/rag/documents/upload", files={"file": ("cat.txt", b"a lazy sleeping cat", "text/plain")})
+    saves = []
+    save_postings = rag_index._save_postings
+    monkeypatch.setattr(rag_index, "_save_postings", lambda *a, **kw: saves.append(1) or save_postings(*a, **kw))
+    files = {
+        "docs/fox.txt": b"the quick brown fox",
+        "docs/cafe.txt": b"caf\xe9 au lait",
+        "docs/logo.png": b"\x89PNG\r\n\x00\x00binary",
+        ".hidden/notes.txt": b"ignored entirely",
+    }
+    try:
+        res = client.post("/api/rag/documents/bulk", files={"file": (f"site.{kind}", _archive(kind, files))})
+    finally:
+        rag_bulk.shutdown()
+    assert res.status_code == 200
+    body = res.json()
+    assert len(body["documents"]) == 2 and body["skipped"] == ["docs/logo.png"]
+    assert len(saves) == 1
+
+    docs = client.get("/api/rag/documents").json()["documents"]
+    assert sorted(d["source"] or "" for d in docs) == [
+        "",
+        f"archive:site.{kind}/docs/cafe.txt",
+        f"archive:site.{kind}/docs/fox.txt",
+    ]
+    hits = client.post("/api/rag/search", json={"query": "café"}).json()["results"]
+    assert hits[0]["document"]["name"] == "docs/cafe.txt"
+
+
+def test_bulk_upload_rejects_bad_archives(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("RAG_BULK_WORKERS", "0")
+    res = client.post("/api/rag/documents/bulk", files={"file": ("a.zip", b"not an archive")})
+    assert res.status_code == 400
+
+    monkeypatch.setenv("RAG_BULK_MAX_FILES", "1")
+    data = _archive("zip", {"a.txt": b"alpha", "b.txt": b"beta"})
+    res = client.post("/api/rag/documents/bulk", files={"file": ("b.zip", data)})
+    assert res.status_code == 400
+    assert client.get("/api/rag/documents").json()["documents"] == []
+
+
+def _as_user(monkeypatch: pytest.MonkeyPatch, user_id: str) -> None:
+    async def _user(_request):
+        return {"id": user_id}
+
+    monkeypatch.setattr(rag_routes, "require_user_from_request", _user)
+
+
+def test_export_restores_into_empty_store_without_reindexing(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    for name, body in (("fox.txt", b"the quick brown fox"), ("den.txt", b"a fox den"), ("cat.txt", b"a lazy cat")):
+        client.post("/api/rag/documents/upload", files={"file": (name, body, "text/plain")})
+    docs = client.get("/api/rag/documents").json()["documents"]
+    client.delete(f"/api/rag/documents/{docs[2]['id']}")
+    docs = docs[:2]
+
+    exported = client.get("/api/rag/export")
+    assert exported.status_code == 200 and exported.content[:4] == b"RAGX"
+
+    _as_user(monkeypatch, "u2")
+    builds = []
+    build_postings = rag_index.build_postings
+    monkeypatch.setattr(rag_index, "build_postings", lambda *a, **kw: builds.append(1) or build_postings(*a, **kw))
+    res = client.post("/api/rag/import", content=exported.content)
+    assert res.status_code == 200
+    assert res.json()["mode"] == "restore" and res.json()["documents"] == 2
+    assert client.get("/api/rag/documents").json()["documents"] == docs
+
+    hits = client.post("/api/rag/search", json={"query": "quick fox"}).json()["results"]
+    assert [h["document"]["name"] for h in hits] == ["fox.txt", "den.txt"]
+    assert client.post("/api/rag/search", json={"query": "fox", "mode": "vector"}).json()["results"]
+    assert builds == []
+    assert rag_vectors.generation("u2") == rag_store.generation("u2")
+
+    # A store that already has documents gets the export's documents added.
+    res = client.post("/api/rag/import", content=exported.content)
+    assert res.json()["mode"] == "merge" and res.json()["documents"] == 2
+    assert len(client.get("/api/rag/documents").json()["documents"]) == 4
+
+
+def test_import_rejects_corrupt_exports(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    client.post("/api/rag/documents/upload", files={"file": ("fox.txt", b"the quick brown fox", "text/plain")})
+    exported = client.get("/api/rag/export").content
+
+    _as_user(monkeypatch, "u2")
+    assert client.post("/api/rag/import", content=b"PK\x03\x04 not an export").status_code == 400
+    assert client.post("/api/rag/import", content=exported[: len(exported) // 2]).status_code == 400
+    assert client.get("/api/rag/documents").json()["documents"] == []
+    assert not any(p.name.endswith(".txt") for p in rag_index.rag_dir("u2").iterdir())
+
+
+@pytest.mark.parametrize("mode", ["keyword", "vector", "hybrid"])
+def test_batch_search_keys_results_by_query(client: TestClient, mode: str):
+    client.post("/api/rag/documents/upload", files={"file": ("fox.txt", b"the quick brown fox", "text/plain")})
+    client.post("/api/rag/documents/upload", files={"file": ("cat.txt", b"a lazy sleeping cat", "text/plain")})
+
+    body = {"mode": mode, "queries": [{"query": "fox"}, {"query": "cat", "limit": 1}, {"query": "zebra"}]}
+    res = client.post("/api/rag/search/batch", json=body)
+    assert res.status_code == 200
+    results = res.json()["results"]
+    assert results["fox"][0]["document"]["name"] == "fox.txt"
+    assert [r["document"]["name"] for r in results["cat"]] == ["cat.txt"]
+    assert results["zebra"] == []
+    assert results["fox"] == client.post("/api/rag/search", json={"query": "fox", "mode": mode}).json()["results"]
+
+    res = client.post("/api/rag/search/batch", json={"queries": [{"query": "fox"}, {"query": "  "}]})
+    assert res.status_code == 400
+
+
+def test_hybrid_search_fuses_rankings_and_reports_timings(client: TestClient):
+    client.post("/api/rag/documents/upload", files={"file": ("fox.txt", b"the quick brown fox", "text/plain")})
+    client.post("/api/rag/documents/upload", files={"file": ("den.txt", b"a fox den in the woods", "text/plain")})
+    client.post("/api/rag/documents/upload", files={"file": ("cat.txt", b"a lazy sleeping cat", "text/plain")})
+
+    body = client.post("/api/rag/search", json={"query": "quick fox", "mode": "hybrid"}).json()
+    assert set(body["timings"]) == {"keywordMs", "vectorMs", "fusionMs", "totalMs"}
+    assert [r["document"]["name"] for r in body["results"]] == ["fox.txt", "den.txt"]
+    assert body["results"][0]["ranks"] == {"keyword": 1, "vector": 1}
+    assert body["results"][0]["score"] == round(2 / 61, 6)
+    assert body["results"][0]["highlights"]
+
+    cached = client.post("/api/rag/search", json={"query": "quick fox", "mode": "hybrid"}).json()
+    assert cached["results"] == body["results"] and set(cached["timings"]) == {"totalMs"}
+
+
+def test_hybrid_search_runs_off_the_event_loop(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    client.post("/api/rag/documents/upload", files={"file": ("fox.txt", b"the quick brown fox", "text/plain")})
+    on_loop: list[bool] = []
+    vector_search = rag_store._vector_search_many
+
+    def spy(*args):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return vector_search(*args)
+
+    monkeypatch.setattr(rag_store, "_vector_search_many", spy)
+    assert client.post("/api/rag/search", json={"query": "fox", "mode": "hybrid"}).json()["results"]
+    res = client.post("/api/rag/search/batch", json={"queries": [{"query": "brown"}], "mode": "hybrid"})
+    assert res.status_code == 200
+    assert on_loop == [False, False]
+
+
+class _FakeOpenAI:
+    def __init__(self, calls: list, **_kwargs):
+        self.calls = calls
+        self.chat = self.completions = self
+
+    def create(self, *, model, messages, stream):
+        self.calls.append(messages)
+        return iter(())
+
+
+def test_chat_rag_injects_context_within_budget(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    calls: list = []
+    monkeypatch.setattr(chat_routes, "OpenAI", lambda **kw: _FakeOpenAI(calls, **kw))
+    monkeypatch.setattr(chat_routes, "require_user_from_request", rag_routes.require_user_from_request)
+    client.post("/api/rag/documents/upload", files={"file": ("cats.txt", b"cats purr when content", "text/plain")})
+    messages = [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": [{"type": "text", "text": "why do cats purr"}]},
+    ]
+
+    res = client.post("/api/chat/rag", json={"messages": messages, "apiKey": "k"})
+    assert res.status_code == 200
+    assert res.headers["X-RAG-Chunks"] == "1"
+    # No provider request besides the completion itself.
+    assert len(calls) == 1
+    sent = calls[0]
+    assert [m["role"] for m in sent] == ["system", "system", "user"]
+    assert "[1] cats.txt: cats purr when content" in sent[1]["content"]
+
+    # A search slower than the budget is dropped rather than delaying the answer.
+    rag_store.clear_search_cache()
+    monkeypatch.setenv("RAG_CHAT_BUDGET_MS", "20")
+    search = rag_store.search
+    monkeypatch.setattr(rag_store, "search", lambda *a, **kw: time.sleep(0.5) or search(*a, **kw))
+    res = client.post("/api/chat/rag", json={"messages": messages, "apiKey": "k"})
+    assert res.headers["X-RAG-Retrieval"] == "timeout"
+    assert [m["role"] for m in calls[-1]] == ["system", "user"]
+
+    # So is a failing index.
+    def broken(*_args, **_kwargs):
+        raise OSError("disk gone")
+
+    monkeypatch.setattr(rag_store, "search", broken)
+    res = client.post("/api/chat/rag", json={"messages": messages, "apiKey": "k"})
+    assert res.status_code == 200
+    assert res.headers["X-RAG-Retrieval"] == "error"
+    assert [m["role"] for m in calls[-1]] == ["system", "user"]
+
+    assert client.post("/api/chat/rag", json={"messages": messages, "apiKey": "k", "mode": "x"}).status_code == 400
@@ -0,0 +1,297 @@
+import asyncio
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import httpx
+import pytest
+
+from app import crawl_robots, crawl_state, indexing_jobs, rag_index, rag_store, web_crawler
+
+
+@pytest.fixture(autouse=True)
+def _public_hosts(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(web_crawler, "is_public_host", lambda host: True)
+    crawl_robots.clear_cache()
+
+
+def _site(pages: dict[str, str], fetched: list[str], delay: float = 0.0) -> httpx.MockTransport:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        fetched.append(request.url.path)
+        await asyncio.sleep(delay)
+        body = pages.get(request.url.path)
+        if body is None:
+            return httpx.Response(404)
+        return httpx.Response(200, text=body, headers={"content-type": "text/html"})
+
+    return httpx.MockTransport(handler)
+
+
+async def _crawl(transport: httpx.MockTransport, **kwargs) -> tuple[web_crawler.Crawler, list[str]]:
+    seen: list[str] = []
+
+    async def on_page(url: str, depth: int, html: str) -> list[str]:
+        seen.append(url)
+        return [part.split('"')[0] for part in html.split('href="')[1:]]
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        crawler = web_crawler.Crawler(client, start_url="https://docs.example.com/", **kwargs)
+        await crawler.run(on_page)
+    return crawler, seen
+
+
+def test_crawler_fetches_each_url_once_within_limits():
+    pages = {
+        "/": '<a href="/a">a</a> <a href="/b#top">b</a> <a href="https://other.example.com/">x</a>',
+        "/a": '<a href="/">home</a> <a href="/b">b</a> <a href="/a/deep">deep</a>',
+        "/b": '<a href="/a">a</a>',
+        "/a/deep": '<a href="/a/deeper">deeper</a>',
+    }
+    fetched: list[str] = []
+    crawler, seen = asyncio.run(_crawl(_site(pages, fetched), max_pages=10, max_depth=1, interval=0, workers=3))
+
+    assert sorted(fetched) == ["/", "/a", "/b"]
+    assert len(seen) == crawler.visited == 3
+
+    fetched.clear()
+    crawler, _seen = asyncio.run(_crawl(_site(pages, fetched), max_pages=2, max_depth=5, interval=0, workers=3))
+    assert len(fetched) == crawler.visited == 2
+
+
+def test_crawler_overlaps_fetches_but_paces_each_host():
+    pages = {"/": "".join(f'<a href="/p{i}">p</a>' for i in range(8))}
+    pages.update({f"/p{i}": "leaf" for i in range(8)})
+
+    fetched: list[str] = []
+    start = time.perf_counter()
+    asyncio.run(_crawl(_site(pages, fetched, delay=0.1), max_pages=9, max_depth=1, interval=0, workers=4))
+    # Nine 100 ms fetches, four at a time.
+    assert len(fetched) == 9
+    assert time.perf_counter() - start < 0.6
+
+    fetched.clear()
+    start = time.perf_counter()
+    asyncio.run(_crawl(_site(pages, fetched), max_pages=5, max_depth=1, interval=0.05, workers=4))
+    # The host's bucket admits one request per 50 ms however many workers wait.
+    assert time.perf_counter() - start >= 0.19
+
+
+def test_auto_throttle_backs_off_on_busy_host_and_speeds_up_on_steady_one():
+    limits = web_crawler.ThrottleLimits(min_delay=0.0, max_delay=0.5, max_concurrency=3)
+    pages = {"/": "".join(f'<a href="/p{i}">p</a>' for i in range(12))}
+    pages.update({f"/p{i}": "leaf" for i in range(12)})
+    fetched: list[str] = []
+    busy = {"/p3"}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        fetched.append(request.url.path)
+        await asyncio.sleep(0.01)
+        if request.url.path in busy:
+            busy.discard(request.url.path)
+            return httpx.Response(429, headers={"retry-after": "0.2"})
+        return httpx.Response(200, text=pages[request.url.path], headers={"content-type": "text/html"})
+
+    async def crawl() -> tuple[web_crawler.Crawler, float]:
+        start = time.perf_counter()
+        crawler, _seen = await _crawl(
+            httpx.MockTransport(handler), max_pages=13, max_depth=1, interval=0.1, workers=4, limits=limits
+        )
+        return crawler, time.perf_counter() - start
+
+    crawler, elapsed = asyncio.run(crawl())
+    # The 429'd page was retried after Retry-After rather than dropped, and still counts once.
+    assert fetched.count("/p3") == 2
+    assert crawler.visited == 13
+    assert elapsed >= 0.2
+    bucket = crawler._buckets["docs.example.com"]
+    assert bucket.concurrency >= 2
+    assert crawler.effective_rate() > 0
+
+    # A Retry-After beyond the admin ceiling is cut to it.
+    async def overloaded() -> web_crawler.AutoThrottle:
+        throttle = web_crawler.AutoThrottle(limits, 0.1)
+        await throttle.acquire()
+        await throttle.release(503, 0.01, 60.0)
+        return throttle
+
+    throttle = asyncio.run(overloaded())
+    assert throttle.delay == limits.max_delay
+    assert throttle.concurrency == 1
+
+
+def test_robots_rules_filter_links_set_crawl_delay_and_are_cached_per_origin():
+    robots_txt = "User-agent: *\nAllow: /private/open\nDisallow: /private\nRequest-rate: 20/1\n"
+    pages = {"/": '<a href="/private/x">x</a> <a href="/private/open">o</a> <a href="/a">a</a> <a href="/b">b</a>'}
+    pages.update({"/private/open": "open", "/a": "a", "/b": "b", "/robots.txt": robots_txt})
+    fetched: list[str] = []
+    transport = _site(pages, fetched)
+
+    async def crawl() -> tuple[web_crawler.Crawler, float]:
+        async with httpx.AsyncClient(transport=transport) as client:
+            rules = await crawl_robots.rules_for(client, "https://docs.example.com/")
+            again = await crawl_robots.rules_for(client, "https://docs.example.com/a?q=1")
+            assert again is rules
+            assert rules.crawl_delay == 0.05
+
+            async def on_page(url: str, depth: int, html: str) -> list[str]:
+                return [part.split('"')[0] for part in html.split('href="')[1:]]
+
+            crawler = web_crawler.Crawler(
+                client,
+                start_url="https://docs.example.com/",
+                max_pages=10,
+                max_depth=1,
+                interval=0,
+                workers=4,
+                robots=rules,
+            )
+            start = time.perf_counter()
+            await crawler.run(on_page)
+            return crawler, time.perf_counter() - start
+
+    crawler, elapsed = asyncio.run(crawl())
+    assert fetched.count("/robots.txt") == 1
+    assert sorted(fetched) == ["/", "/a", "/b", "/private/open", "/robots.txt"]
+    assert crawler.blocked == 1
+    # Four requests paced by the site's rate even though the job asked for no delay.
+    assert elapsed >= 0.14
+
+
+def test_robots_fetch_failures_follow_robotparser_semantics():
+    async def rules(status: int) -> crawl_robots.RobotRules:
+        transport = httpx.MockTransport(lambda request: httpx.Response(status))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await crawl_robots.rules_for(client, f"https://s{status}.example.com/")
+
+    assert not asyncio.run(rules(403)).allowed("https://s403.example.com/page")
+    assert asyncio.run(rules(404)).allowed("https://s404.example.com/page")
+    assert asyncio.run(rules(500)).allowed("https://s500.example.com/page")
+
+
+@pytest.fixture()
+def site_jobs(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Iterator[tuple[dict[str, str | int], list[tuple]]]:
+    """
+    Runs crawl jobs against an in-memory site that honors If-None-Match (ETag = page body); an
+    int instead of a body is answered as that status.
+    """
+    (tmp_path / "u1").mkdir()
+    for module in (rag_index, indexing_jobs, crawl_state):
+        monkeypatch.setattr(module, "user_data_dir", lambda user_id: tmp_path / user_id)
+    monkeypatch.setattr(indexing_jobs, "validate_public_http_url", lambda url: url)
+    rag_store.clear_search_cache()
+    pages: dict[str, str | int] = {}
+    requests: list[tuple] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.url.path, request.headers.get("if-none-match")))
+        body = pages.get(request.url.path)
+        if body is None or isinstance(body, int):
+            return httpx.Response(body or 404)
+        etag = f'"{hash(body)}"'
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, text=body, headers={"content-type": "text/html", "etag": etag})
+
+    client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, "AsyncClient", lambda **kw: client(transport=httpx.MockTransport(handler), **kw))
+    yield pages, requests
+    for user_id in list(rag_index._WRITERS):
+        rag_index.flush(user_id)
+
+
+def _run_job(kind: str, **kwargs) -> dict:
+    async def run() -> dict:
+        store = indexing_jobs.IndexJobStore()
+        create = store.create_web_crawl_job if kind == "web_crawl" else store.create_recrawl_job
+        job = await create("u1", start_url="https://docs.example.com/", respect_robots=False, **kwargs)
+        await store._task_map("u1")[job.id]
+        return await store.get_job("u1", job.id)
+
+    return asyncio.run(run())
+
+
+def test_recrawl_revalidates_stored_urls_and_reindexes_only_changes(site_jobs):
+    pages, requests = site_jobs
+    pages.update(
+        {
+            "/": '<p>welcome home</p> <a href="/a">a</a> <a href="/b">b</a>',
+            "/a": "<p>alpha page about apples</p>",
+            "/b": "<p>beta page about bananas</p>",
+        }
+    )
+    first = _run_job("web_crawl", rate_limit_sec=0)
+    assert first["status"] == "succeeded"
+    assert first["result"]["pages"] == 3
+
+    pages["/b"] = "<p>beta page about blueberries now</p>"
+    del pages["/a"]
+    requests.clear()
+    job = _run_job("recrawl", rate_limit_sec=0)
+    assert job["status"] == "succeeded"
+    assert job["params"]["sourceJobId"] == first["id"]
+    # Only the stored URL set is requested, each with its validator.
+    assert sorted(path for path, _etag in requests) == ["/", "/a", "/b"]
+    assert all(etag for _path, etag in requests)
+    assert (job["result"]["changedPages"], job["result"]["unchangedPages"], job["result"]["removedPages"]) == (1, 1, 1)
+    assert rag_store.search("u1", "blueberries") and rag_store.search("u1", "welcome")
+    assert not rag_store.search("u1", "apples") and not rag_store.search("u1", "bananas")
+
+    # Nothing changed: the index is left alone.
+    gen = rag_store.generation("u1")
+    job = _run_job("recrawl", rate_limit_sec=0)
+    assert job["result"]["unchangedPages"] == 2
+    assert job["result"]["changedPages"] == 0
+    assert rag_store.generation("u1") == gen
+
+    # A page that fails for now keeps its document and stays in the URL set.
+    pages["/b"] = 503
+    job = _run_job("recrawl", rate_limit_sec=0)
+    assert (job["result"]["unchangedPages"], job["result"]["removedPages"]) == (1, 0)
+    assert rag_store.search("u1", "blueberries")
+    assert "https://docs.example.com/b" in crawl_state.load("u1", "https://docs.example.com/")["pages"]
+
+
+def test_crawl_streams_pages_as_documents_in_batches_that_survive_cancel(site_jobs, monkeypatch):
+    pages, _requests = site_jobs
+    monkeypatch.setenv("CRAWL_COMMIT_PAGES", "2")
+    pages["/"] = "<title>Home</title><p>home page</p>" + "".join(f'<a href="/p{i}">p</a>' for i in range(6))
+    pages.update({f"/p{i}": f"<p>page {i} about topic{i}</p>" for i in range(6)})
+
+    job = _run_job("web_crawl", rate_limit_sec=0)
+    assert job["status"] == "succeeded"
+    assert (job["result"]["pages"], job["result"]["collection"]) == (7, "https://docs.example.com/")
+    docs = {d["source"]: d for d in rag_store.list_documents("u1")}
+    assert len(docs) == 7
+    assert {d["collection"] for d in docs.values()} == {"https://docs.example.com/"}
+    assert docs["https://docs.example.com/"]["name"] == "Home"
+    assert rag_store.search("u1", "topic4")[0]["document"]["id"] == docs["https://docs.example.com/p4"]["id"]
+
+    # The next crawl drops a page that answers 404, but not one that fails for now or is no longer linked.
+    del pages["/p5"]
+    pages["/p4"] = 500
+    pages["/"] = str(pages["/"]).replace('<a href="/p3">p</a>', "")
+    assert _run_job("web_crawl", rate_limit_sec=0)["result"]["removedDocuments"] == 1
+    sources = {d["source"] for d in rag_store.list_documents("u1")}
+    assert "https://docs.example.com/p5" not in sources
+    assert {"https://docs.example.com/p3", "https://docs.example.com/p4"} <= sources
+    assert "https://docs.example.com/p3" in crawl_state.load("u1", "https://docs.example.com/")["pages"]
+
+    async def cancel_midway() -> dict:
+        store = indexing_jobs.IndexJobStore()
+        job = await store.create_web_crawl_job(
+            "u1", start_url="https://docs.example.com/", respect_robots=False, rate_limit_sec=0.1, max_pages=50
+        )
+        while ((await store.get_job("u1", job.id))["progress"].get("indexedPages") or 0) < 2:
+            await asyncio.sleep(0.02)
+        await store.cancel_job("u1", job.id)
+        await asyncio.gather(store._task_map("u1")[job.id], return_exceptions=True)
+        return await store.get_job("u1", job.id)
+
+    for d in rag_store.list_documents("u1"):
+        rag_store.delete_document("u1", d["id"])
+    job = asyncio.run(cancel_midway())
+    assert job["status"] == "canceled"
+    # Committed batches stay indexed; pages are never half-written.
+    indexed = [d for d in rag_store.list_documents("u1") if d.get("collection") == "https://docs.example.com/"]
+    assert 2 <= len(indexed) < 6
+    assert job["progress"]["indexedPages"] == len(indexed)